@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times persisting PDUs into an in-memory sqlite database using the real
+schema, to show how the cost of keeping the backward extremities up to date
+changes as the database grows.
+
+The PDUs are spread round-robin over a number of rooms, each a linear chain.
+Every so often a PDU also references a remote PDU we don't have, which stays
+a backward extremity.
+
+Run from the root of the repository:
+
+    python scripts/benchmark_backward_extremities.py [--table-wide]
+
+With --table-wide each PDU is followed by the statements the store used to
+run instead: inserting every prev_pdu as a backward extremity and then
+deleting those we have seen across the whole table.
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from synapse.server import HomeServer
+from synapse.storage import read_schema
+from synapse.storage.pdu import (
+    PduStore, PdusTable, PduBackwardExtremitiesTable
+)
+
+
+TABLE_WIDE_DELETE = (
+    "DELETE FROM %(back)s WHERE EXISTS ("
+    "SELECT 1 FROM %(pdus)s AS pdus WHERE "
+    "%(back)s.pdu_id = pdus.pdu_id "
+    "AND %(back)s.origin = pdus.origin "
+    "AND NOT pdus.outlier"
+    ")"
+) % {
+    "back": PduBackwardExtremitiesTable.table_name,
+    "pdus": PdusTable.table_name,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdus", type=int, default=100000)
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--missing-every", type=int, default=100,
+                        help="Every Nth PDU also references a missing PDU")
+    parser.add_argument("--table-wide", action="store_true")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(read_schema("pdu"))
+    txn = conn.cursor()
+
+    store = PduStore(HomeServer("bench", db_pool=None))
+
+    last = {}
+    block = args.pdus // 10
+    start = time.time()
+
+    for i in range(args.pdus):
+        context = "!room%d:bench" % (i % args.rooms,)
+        pdu_id = "pdu%d" % (i,)
+
+        prev_pdus = []
+        if context in last:
+            prev_pdus.append((last[context], "bench"))
+        if i % args.missing_every == 0:
+            prev_pdus.append(("missing%d" % (i,), "remote"))
+
+        store._persist_pdu(txn, prev_pdus, {
+            "pdu_id": pdu_id,
+            "origin": "bench",
+            "context": context,
+            "pdu_type": "m.room.message",
+            "ts": i,
+            "depth": i // args.rooms + 1,
+            "is_state": False,
+            "content_json": "{}",
+            "unrecognized_keys": "{}",
+            "outlier": False,
+            "have_processed": True,
+        })
+
+        if args.table_wide:
+            txn.executemany(
+                PduBackwardExtremitiesTable.insert_statement(),
+                [(p, o, context) for p, o in prev_pdus]
+            )
+            txn.execute(TABLE_WIDE_DELETE)
+
+        conn.commit()
+        last[context] = pdu_id
+
+        if (i + 1) % block == 0:
+            now = time.time()
+            txn.execute(
+                "SELECT COUNT(*) FROM %s"
+                % PduBackwardExtremitiesTable.table_name
+            )
+            print "%7d PDUs: %6.1f us/PDU, %d backward extremities" % (
+                i + 1, (now - start) / block * 1e6, txn.fetchone()[0]
+            )
+            start = now
+
+
+if __name__ == "__main__":
+    main()
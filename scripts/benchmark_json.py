@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times encoding and decoding of typical federation and client payloads
+with `synapse.util.jsonutil`, against the stdlib `json` module it replaces.
+
+Run from the root of the repository:
+
+    python scripts/benchmark_json.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from synapse.util import jsonutil
+
+
+def make_pdu(i):
+    return {
+        "pdu_id": "pdu%dabcdef" % (i,),
+        "origin": "example.org",
+        "context": "!abcdefghijklmnop:example.org",
+        "pdu_type": "m.room.message",
+        "ts": 1409000000000 + i,
+        "depth": 1000 + i,
+        "is_state": False,
+        "prev_pdus": [["pdu%dabcdef" % (i - 1,), "example.org"]],
+        "content": {
+            "msgtype": "m.text",
+            "body": u"Hello there, this is message number %d ☃" % (i,),
+            "hsob_ts": 1409000000000 + i,
+        },
+    }
+
+
+def make_transaction(n):
+    return {
+        "origin": "example.org",
+        "destination": "remote.org",
+        "ts": 1409000000000,
+        "prev_ids": ["1408999999"],
+        "pdus": [make_pdu(i) for i in range(n)],
+    }
+
+
+def make_events_response(n):
+    return {
+        "start": "1000",
+        "end": str(1000 + n),
+        "chunk": [
+            {
+                "type": "m.room.message",
+                "room_id": "!abcdefghijklmnop:example.org",
+                "user_id": "@alice:example.org",
+                "msg_id": "m%d" % (i,),
+                "content": {"msgtype": "m.text", "body": u"Hi %d" % (i,)},
+            }
+            for i in range(n)
+        ],
+    }
+
+
+def stdlib_canonical(obj):
+    return json.dumps(
+        obj, ensure_ascii=False, separators=(',', ':'), sort_keys=True
+    ).encode("UTF-8")
+
+
+def bench(name, func, arg, number):
+    seconds = min(timeit.repeat(lambda: func(arg), number=number, repeat=3))
+    print "  %-28s %8.1f us" % (name, seconds / number * 1e6)
+
+
+def main():
+    print "Backend: %s" % (jsonutil.backend_name,)
+
+    payloads = [
+        ("PDU", make_pdu(1), 20000),
+        ("transaction (50 PDUs)", make_transaction(50), 400),
+        ("/events (100 events)", make_events_response(100), 200),
+    ]
+
+    for name, payload, number in payloads:
+        canonical = jsonutil.encode_canonical_json(payload)
+        assert canonical == stdlib_canonical(payload)
+        encoded = jsonutil.encode_json(payload)
+
+        print "%s, %d bytes:" % (name, len(canonical))
+        bench("stdlib canonical encode", stdlib_canonical, payload, number)
+        bench("jsonutil canonical encode",
+              jsonutil.encode_canonical_json, payload, number)
+        bench("stdlib encode", json.dumps, payload, number)
+        bench("jsonutil encode", jsonutil.encode_json, payload, number)
+        bench("stdlib decode", json.loads, encoded, number)
+        bench("jsonutil decode", jsonutil.decode_json, encoded, number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times the per-call overhead of `synapse.util.logutils.log_function` with
+function logging turned on and off, against calling the function directly.
+
+Run from the root of the repository:
+
+    python scripts/benchmark_log_function.py
+"""
+
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from synapse.util.logutils import log_function, set_function_logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def add(a, b):
+    return a + b
+
+
+@log_function
+def logged_add(a, b):
+    return a + b
+
+
+class Adder(object):
+    def add(self, a, b):
+        return a + b
+
+    @log_function
+    def logged_add(self, a, b):
+        return a + b
+
+
+def bench(name, stmt, number):
+    seconds = min(timeit.repeat(stmt, number=number, repeat=3))
+    print "  %-40s %6.3f us/call" % (name, seconds / number * 1e6)
+
+
+def run(label, number=200000):
+    adder = Adder()
+
+    print label
+    bench("undecorated function", lambda: add(1, 2), number)
+    bench("decorated function", lambda: logged_add(1, 2), number)
+    bench("undecorated method", lambda: adder.add(1, 2), number)
+    bench("decorated method", lambda: adder.logged_add(1, 2), number)
+
+
+def main():
+    logger.setLevel(logging.INFO)
+
+    run("Function logging on, logger below DEBUG:")
+
+    # The module-level names are swapped for the undecorated functions.
+    set_function_logging(__name__, False)
+    run("Function logging off:")
+
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.NullHandler())
+    set_function_logging(__name__, True)
+    run("Function logging on, logging at DEBUG:", number=20000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Times persisting deep chains of state PDUs, and finding the branches
+between two of their PDUs with the state chain index, against walking the
+prev_state links one PDU at a time.
+
+A topic chain and a membership chain are built in the same room, with their
+PDUs interleaved. The lookups model catching up on a gap, where the new state
+PDU descends from the current one through many PDUs we were missing.
+
+Run from the root of the repository:
+
+    python scripts/benchmark_state_chains.py [--depth N]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from synapse.server import HomeServer
+from synapse.storage import read_schema
+from synapse.storage.pdu import (
+    StatePduStore, PduStore, PdusTable, StatePdusTable, PduEntry,
+    _pdu_state_joiner,
+)
+
+
+class BenchStore(StatePduStore, PduStore):
+    pass
+
+
+def get_state_pdu(txn, pdu_id, origin):
+    txn.execute(
+        "SELECT %(fields)s FROM %(pdus)s AS p "
+        "LEFT JOIN %(state)s AS s "
+        "ON p.pdu_id = s.pdu_id AND p.origin = s.origin "
+        "WHERE p.pdu_id = ? AND p.origin = ?" % {
+            "fields": _pdu_state_joiner.get_fields(
+                PdusTable="p", StatePdusTable="s"),
+            "pdus": PdusTable.table_name,
+            "state": StatePdusTable.table_name,
+        },
+        (pdu_id, origin)
+    )
+    return PduEntry(*txn.fetchone())
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, (time.time() - start) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--depth", type=int, default=10000)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(read_schema("pdu"))
+    txn = conn.cursor()
+
+    store = BenchStore(HomeServer("bench", db_pool=None))
+
+    chains = [
+        ("m.room.topic", ""),
+        ("m.room.member", "@alice:bench"),
+    ]
+    ids = dict((chain, []) for chain in chains)
+    last = None
+    depth = 0
+    block = args.depth // 5
+    start = time.time()
+
+    for i in range(args.depth):
+        for pdu_type, state_key in chains:
+            chain_ids = ids[(pdu_type, state_key)]
+            pdu_id = "%s%d" % (pdu_type, i)
+            prev_state_id = chain_ids[-1] if chain_ids else None
+
+            store._persist_state(txn, [last] if last else [], {
+                "pdu_id": pdu_id,
+                "origin": "bench",
+                "context": "!room:bench",
+                "pdu_type": pdu_type,
+                "ts": i,
+                "depth": depth,
+                "is_state": True,
+                "content_json": "{}",
+                "unrecognized_keys": "{}",
+                "outlier": False,
+                "have_processed": True,
+                "state_key": state_key,
+                "power_level": 0,
+                "prev_state_id": prev_state_id,
+                "prev_state_origin": "bench" if prev_state_id else None,
+            })
+            conn.commit()
+
+            chain_ids.append(pdu_id)
+            last = (pdu_id, "bench")
+            depth += 1
+
+        if (i + 1) % block == 0:
+            now = time.time()
+            print "%6d deep: %6.1f us per state PDU persisted" % (
+                i + 1, (now - start) / (2 * block) * 1e6
+            )
+            start = now
+
+    for pdu_type, state_key in chains:
+        chain_ids = ids[(pdu_type, state_key)]
+        tip = get_state_pdu(txn, chain_ids[-1], "bench")
+
+        for back in (10, 100, len(chain_ids) - 1):
+            current = get_state_pdu(txn, chain_ids[-1 - back], "bench")
+
+            ancestor, finding = timed(
+                store._find_common_state_ancestor, txn,
+                store._get_state_chain_position(txn, tip.pdu_id, tip.origin),
+                store._get_state_chain_position(
+                    txn, current.pdu_id, current.origin
+                ),
+            )
+            branches, indexed = timed(
+                store._get_state_branches, txn, tip, current
+            )
+            walked, walking = timed(
+                lambda: list(store._enumerate_state_branches(
+                    txn, tip, current
+                ))
+            )
+            assert ancestor is not None
+            assert len(branches[0]) == len(walked) + 1
+
+            print (
+                "%s, %5d back: common ancestor %5.2f ms, "
+                "branches by index %7.2f ms, by walking %7.2f ms"
+            ) % (pdu_type, back, finding, indexed, walking)
+
+
+if __name__ == "__main__":
+    main()
@@ -48,6 +48,13 @@ class StoreError(SynapseError):
     pass
 
 
+class LimitExceededError(SynapseError):
+    """An error raised when the server is too busy to handle a request."""
+
+    def __init__(self, code=429, msg="Too many requests"):
+        super(LimitExceededError, self).__init__(code, msg)
+
+
 def cs_error(msg, code=0, **kwargs):
     """ Utility method for constructing an error response for client-server
     interactions.
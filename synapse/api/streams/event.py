@@ -34,6 +34,24 @@ class MessagesStreamData(StreamData):
         )
         defer.returnValue((data, latest_ver))
 
+    @defer.inlineCallbacks
+    def get_rows_for_rooms(self, user_id, room_ids, from_key, to_key, limit):
+        """ Like `get_rows`, but for each of the given rooms at once.
+
+        Returns:
+            A dict mapping room IDs to tuples of the list of event stream data
+            and the last pkey.
+        """
+        rows = yield self.store.get_message_streams_for_rooms(
+            user_id=user_id,
+            from_key=from_key,
+            to_key=to_key,
+            room_ids=room_ids,
+            limit=limit,
+            with_feedback=self.with_feedback
+        )
+        defer.returnValue(rows)
+
     @defer.inlineCallbacks
     def max_token(self):
         val = yield self.store.get_max_message_id()
@@ -173,6 +191,50 @@ class EventStream(PaginationStream):
             "end": next_tok
         })
 
+    @defer.inlineCallbacks
+    def get_room_chunks(self, room_ids, config=None):
+        """ Gets a chunk for each of the given rooms, as `get_chunk` would
+        for a stream limited to that room, but with all the rooms fetched
+        together.
+
+        The stream must consist of a single StreamData which supports
+        `get_rows_for_rooms`.
+
+        Args:
+            room_ids (list): The rooms to get chunks for.
+            config (PaginationConfig): The tokens must already be fixed.
+        Returns:
+            A dict mapping each room ID to its chunk.
+        """
+        if len(self.stream_data) > 1:
+            raise EventStreamError(
+                400, "Room chunks not supported on multiplexed streams."
+            )
+
+        from_pkeys = self._split_token(config.from_tok)
+        to_pkeys = self._split_token(config.to_tok)
+        if len(from_pkeys) != 1 or len(to_pkeys) != 1:
+            raise EventStreamError(400, "Token lengths don't match.")
+
+        from_pkey, to_pkey = from_pkeys[0], to_pkeys[0]
+
+        if from_pkey == to_pkey:
+            # tokens are the same, we have nothing to do.
+            rows = {room_id: ([], to_pkey) for room_id in room_ids}
+        else:
+            rows = yield self.stream_data[0].get_rows_for_rooms(
+                self.user_id, room_ids, from_pkey, to_pkey, config.limit
+            )
+
+        defer.returnValue({
+            room_id: {
+                "chunk": event_chunk,
+                "start": config.from_tok,
+                "end": str(max_pkey),
+            }
+            for room_id, (event_chunk, max_pkey) in rows.items()
+        })
+
     @defer.inlineCallbacks
     def _get_chunk_data(self, from_tok, to_tok, limit):
         """ Get event data between the two tokens.
@@ -10,6 +10,7 @@ from twisted.enterprise import adbapi
 from twisted.python.log import PythonLoggingObserver
 from synapse.http.server import TwistedHttpServer
 from synapse.http.client import TwistedHttpClient
+from synapse.util.logutils import set_function_logging
 
 from daemonize import Daemonize
 
@@ -23,7 +24,7 @@ logger = logging.getLogger(__name__)
 
 class SynapseHomeServer(HomeServer):
     def build_http_server(self):
-        return TwistedHttpServer()
+        return TwistedHttpServer(clock=self.get_clock())
 
     def build_http_client(self):
         return TwistedHttpClient()
@@ -82,6 +83,11 @@ def setup_logging(verbosity=0, filename=None, config_path=None):
             level = logging.DEBUG
 
         logging.basicConfig(level=level, filename=filename, format=log_format)
+
+        # Skip the per-call checks made by @log_function unless we're going
+        # to log at DEBUG anyway. It can be turned back on at runtime.
+        if level > logging.DEBUG:
+            set_function_logging("synapse", False)
     else:
         logging.config.fileConfig(config_path)
 
@@ -112,6 +118,37 @@ def setup():
     parser.add_argument('--pid-file', dest="pid", help="When running as a "
                         "daemon, the file to store the pid in",
                         default="hs.pid")
+    parser.add_argument("--federation-max-body-size",
+                        dest="federation_max_body_size", type=int,
+                        default=HomeServer.federation_max_body_size,
+                        help="The largest federation transaction, in bytes, "
+                        "that we will accept.")
+    parser.add_argument("--federation-threaded-decode-size",
+                        dest="federation_threaded_decode_size", type=int,
+                        default=HomeServer.federation_threaded_decode_size,
+                        help="Federation transactions bigger than this many "
+                        "bytes are decoded in a thread.")
+    parser.add_argument("--federation-edu-coalesce-window",
+                        dest="federation_edu_coalesce_window", type=float,
+                        default=HomeServer.federation_edu_coalesce_window,
+                        help="How long, in seconds, to hold back federation "
+                        "EDUs such as presence updates so that later updates "
+                        "can be merged into them.")
+    parser.add_argument("--password-hash-threads",
+                        dest="password_hash_threads", type=int,
+                        default=HomeServer.password_hash_threads,
+                        help="The number of threads to hash passwords on.")
+    parser.add_argument("--password-hash-queue-size",
+                        dest="password_hash_queue_size", type=int,
+                        default=HomeServer.password_hash_queue_size,
+                        help="The number of password hashing requests that "
+                        "may wait for a thread before further requests are "
+                        "rejected.")
+    parser.add_argument("--presence-flush-interval",
+                        dest="presence_flush_interval", type=float,
+                        default=HomeServer.presence_flush_interval,
+                        help="How often, in seconds, to write changes to "
+                        "users' presence state to the database.")
     args = parser.parse_args()
 
     verbosity = int(args.verbose) if args.verbose else None
@@ -126,7 +163,13 @@ def setup():
 
     hs = SynapseHomeServer(
         args.host,
-        db_name=args.db
+        db_name=args.db,
+        federation_max_body_size=args.federation_max_body_size,
+        federation_threaded_decode_size=args.federation_threaded_decode_size,
+        federation_edu_coalesce_window=args.federation_edu_coalesce_window,
+        password_hash_threads=args.password_hash_threads,
+        password_hash_queue_size=args.password_hash_queue_size,
+        presence_flush_interval=args.presence_flush_interval,
     )
 
     # This object doesn't need to be saved because it's set as the handler for
@@ -139,6 +182,11 @@ def setup():
 
     hs.build_db_pool()
 
+    # Write out any buffered presence state before the database is closed.
+    reactor.addSystemEventTrigger(
+        "before", "shutdown", hs.get_handlers().presence_handler.flush_presence
+    )
+
     if args.daemonize:
         daemon = Daemonize(
             app="synapse-homeserver",
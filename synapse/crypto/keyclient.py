@@ -4,7 +4,7 @@ from twisted.web.http import HTTPClient
 from twisted.internet import defer, reactor
 from twisted.internet.protocol import ClientFactory
 from twisted.names.srvconnect import SRVConnector
-import json
+from synapse.util.jsonutil import decode_json
 import logging
 
 
@@ -54,7 +54,7 @@ class SynapseKeyClientProtocol(HTTPClient):
 
     def handleResponse(self, response_body_bytes):
         try:
-            json_response = json.loads(response_body_bytes)
+            json_response = decode_json(response_body_bytes)
         except ValueError:
             logger.info("Invalid JSON response from %s",
                         self.transport.getHost())
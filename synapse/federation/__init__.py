@@ -10,7 +10,9 @@ def initialize_http_replication(homeserver):
     transport = TransportLayer(
         homeserver.hostname,
         server=homeserver.get_http_server(),
-        client=homeserver.get_http_client()
+        client=homeserver.get_http_client(),
+        max_body_size=homeserver.federation_max_body_size,
+        threaded_decode_size=homeserver.federation_threaded_decode_size,
     )
 
     return ReplicationLayer(homeserver, transport)
@@ -37,13 +37,16 @@ class FederationEventHandler(object):
 
     @log_function
     @defer.inlineCallbacks
-    def handle_new_event(self, event):
+    def handle_new_event(self, event, send_after=None):
         """ Takes in an event from the client to server side, that has already
         been authed and handled by the state module, and sends it to any
         remote home servers that may be interested.
 
         Args:
             event
+            send_after (Deferred): If given, the event is placed in the
+                context's graph of PDUs straight away, but only sent to
+                remote home servers once this has succeeded.
 
         Returns:
             Deferred: Resolved when it has successfully been queued for
@@ -56,7 +59,7 @@ class FederationEventHandler(object):
         if not hasattr(pdu, "destinations") or not pdu.destinations:
             pdu.destinations = []
 
-        yield self.replication_layer.send_pdu(pdu)
+        yield self.replication_layer.send_pdu(pdu, send_after=send_after)
 
     @log_function
     @defer.inlineCallbacks
@@ -10,9 +10,10 @@ from twisted.internet import defer
 from .units import Pdu
 
 from synapse.util.logutils import log_function
+from synapse.util.lrucache import LruCache
+from synapse.util.jsonutil import decode_json, encode_json
 
 import copy
-import json
 import logging
 
 
@@ -44,7 +45,8 @@ class PduActions(object):
         Returns:
             Deferred
         """
-        ret = yield self._persist(pdu)
+        # We created it, so there is nothing left to do to process it.
+        ret = yield self._persist(pdu, have_processed=True)
 
         defer.returnValue(ret)
 
@@ -92,11 +94,29 @@ class PduActions(object):
 
         defer.returnValue([Pdu.from_pdu_tuple(p) for p in results])
 
-    @defer.inlineCallbacks
-    @log_function
-    def get_all_pdus_from_context(self, context):
-        results = yield self.store.get_all_pdus_from_context(context)
-        defer.returnValue([Pdu.from_pdu_tuple(p) for p in results])
+    def iter_pdus_from_context(self, context, batch_size):
+        """ Fetches all the `Pdu`s in a given context a batch at a time, as
+        they are needed.
+
+        Each batch must have been received before asking for the next one.
+
+        Returns:
+            iterator: Of Deferreds, each resulting in a list of up to
+            `batch_size` `Pdu`s.
+        """
+        state = {"position": 0, "finished": False}
+
+        def on_batch(result):
+            state["position"], pdu_tuples = result
+            if len(pdu_tuples) < batch_size:
+                state["finished"] = True
+            return [Pdu.from_pdu_tuple(p) for p in pdu_tuples]
+
+        while not state["finished"]:
+            d = self.store.get_pdus_from_context_after(
+                context, state["position"], batch_size
+            )
+            yield d.addCallback(on_batch)
 
     @defer.inlineCallbacks
     @log_function
@@ -131,34 +151,51 @@ class PduActions(object):
 
     @defer.inlineCallbacks
     @log_function
-    def _persist(self, pdu):
+    def _persist(self, pdu, have_processed=False):
         kwargs = copy.copy(pdu.__dict__)
         unrec_keys = copy.copy(pdu.unrecognized_keys)
         del kwargs["content"]
-        kwargs["content_json"] = json.dumps(pdu.content)
-        kwargs["unrecognized_keys"] = json.dumps(unrec_keys)
+        kwargs["content_json"] = encode_json(pdu.content)
+        kwargs["unrecognized_keys"] = encode_json(unrec_keys)
+        kwargs["have_processed"] = have_processed
 
-        logger.debug("Persisting: %s", repr(kwargs))
+        logger.debug("Persisting: %r", kwargs)
 
+        # This also updates the context's minimum depth.
         if pdu.is_state:
             ret = yield self.store.persist_state(**kwargs)
         else:
             ret = yield self.store.persist_pdu(**kwargs)
 
-        yield self.store.update_min_depth_for_context(
-            pdu.context, pdu.depth
-        )
-
         defer.returnValue(ret)
 
 
 class TransactionActions(object):
     """ Defines persistence actions that relate to handling Transactions.
+
+    Remote home servers retry transactions aggressively, so the responses to
+    recently received transactions are also kept in memory, letting us answer
+    duplicates without going to the database.
+
+    Attributes:
+        response_cache (synapse.util.lrucache.LruCache): Maps
+            (origin, transaction_id) to (response code, response body). Its
+            hit and miss counts show how often this happens.
     """
 
-    def __init__(self, datastore):
+    # How many responses to keep in memory, and for how many seconds.
+    RESPONSE_CACHE_SIZE = 5000
+    RESPONSE_CACHE_AGE = 30 * 60
+
+    def __init__(self, datastore, clock):
         self.store = datastore
+        self.response_cache = LruCache(
+            self.RESPONSE_CACHE_SIZE,
+            max_age=self.RESPONSE_CACHE_AGE,
+            clock=clock,
+        )
 
+    @defer.inlineCallbacks
     @log_function
     def have_responded(self, transaction):
         """ Have we already responded to a transaction with the same id and
@@ -173,10 +210,22 @@ class TransactionActions(object):
             raise RuntimeError("Cannot persist a transaction with no "
                                "transaction_id")
 
-        return self.store.get_received_txn_response(
+        key = (transaction.origin, transaction.transaction_id)
+        response = self.response_cache.get(key)
+        if response:
+            defer.returnValue(response)
+
+        response = yield self.store.get_received_txn_response(
             transaction.transaction_id, transaction.origin
         )
 
+        if response:
+            code, response_json = response
+            response = (code, decode_json(response_json))
+            self.response_cache.set(key, response)
+
+        defer.returnValue(response)
+
     @log_function
     def set_response(self, transaction, code, response):
         """ Persist how we responded to a transaction.
@@ -188,11 +237,17 @@ class TransactionActions(object):
             raise RuntimeError("Cannot persist a transaction with no "
                                "transaction_id")
 
+        self.response_cache.set(
+            (transaction.origin, transaction.transaction_id),
+            (code, response)
+        )
+
         return self.store.set_received_txn_response(
             transaction.transaction_id,
             transaction.origin,
+            transaction.ts,
             code,
-            json.dumps(response)
+            encode_json(response)
         )
 
     @defer.inlineCallbacks
@@ -223,5 +278,5 @@ class TransactionActions(object):
             transaction.transaction_id,
             transaction.destination,
             response_code,
-            json.dumps(response_dict)
+            encode_json(response_dict)
         )
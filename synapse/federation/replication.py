@@ -4,12 +4,15 @@ a given transport.
 """
 
 from twisted.internet import defer
+from twisted.python import failure
 
 from .units import Transaction, Pdu, Edu
 
 from .persistence import PduActions, TransactionActions
 
+from synapse.http.server import JsonStreamResponse
 from synapse.util.logutils import log_function
+from synapse.util.lrucache import LruCache
 
 import logging
 
@@ -17,6 +20,50 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# The number of contexts to keep the serialisable current state of, for
+# answering /state/ requests.
+CONTEXT_STATE_CACHE_SIZE = 1000
+
+# The most state pdus we return in answer to a single /state_ancestors/
+# request.
+MAX_STATE_ANCESTORS = 1000
+
+# The number of pdus to fetch from the database at a time when answering
+# /context/ requests.
+CONTEXT_PDUS_BATCH_SIZE = 200
+
+
+class EduCoalescer(object):
+    """Merges EDUs of one type which are waiting to be sent to the same
+    destination.
+
+    The first pending EDU of the type is turned into a buffer by `start`,
+    later EDUs are merged into that buffer by `merge`, and `finish` turns it
+    back into the content which is sent.
+    """
+
+    def start(self, content):
+        """Returns a buffer which later EDUs can be merged into, or None if
+        they can't be merged into this one.
+        """
+        return None
+
+    def merge(self, buffer, content):
+        """Merges the content of a later EDU into the buffer in place.
+
+        Returns:
+            bool: False if the EDU couldn't be merged, in which case the
+            buffer must be left untouched.
+        """
+        return False
+
+    def finish(self, buffer):
+        """Returns the content of a single EDU equivalent to sending all the
+        merged EDUs in order.
+        """
+        raise NotImplementedError()
+
+
 class ReplicationLayer(object):
     """This layer is responsible for replicating with remote home servers over
     the given transport. I.e., does the sending and receiving of PDUs to
@@ -44,7 +91,9 @@ class ReplicationLayer(object):
 
         self.store = hs.get_datastore()
         self.pdu_actions = PduActions(self.store)
-        self.transaction_actions = TransactionActions(self.store)
+        self.transaction_actions = TransactionActions(
+            self.store, hs.get_clock()
+        )
 
         self._transaction_queue = _TransactionQueue(
             hs, self.transaction_actions, transport_layer
@@ -57,6 +106,15 @@ class ReplicationLayer(object):
 
         self._clock = hs.get_clock()
 
+        # Maps context to a 2-tuple of the list of PduTuples last returned by
+        # the store for its current state, and the PDU dicts we built from it.
+        self._context_state_dicts = LruCache(CONTEXT_STATE_CACHE_SIZE)
+
+        # Maps (origin, transaction_id) of the transactions we're currently
+        # processing to a list of deferreds waiting for the response, so that
+        # a retry which arrives in the meantime isn't processed again.
+        self._incoming_transactions = {}
+
     def set_handler(self, handler):
         """Sets the handler that the replication layer will use to communicate
         receipt of new PDUs from other home servers. The required methods are
@@ -70,9 +128,24 @@ class ReplicationLayer(object):
 
         self.edu_handlers[edu_type] = handler
 
+    def register_edu_coalescer(self, edu_type, coalescer):
+        """Allows EDUs of the given type to be merged while they wait to be
+        sent.
+
+        An EDU of this type is held back for a short window before it is
+        sent, unless a transaction to its destination goes out first. If
+        another EDU of the same type is sent to the same destination in the
+        meantime, it is merged into the last pending EDU of that type.
+
+        Args:
+            edu_type (str): The type of EDU.
+            coalescer (EduCoalescer): Merges the EDUs.
+        """
+        self._transaction_queue.register_edu_coalescer(edu_type, coalescer)
+
     @defer.inlineCallbacks
     @log_function
-    def send_pdu(self, pdu):
+    def send_pdu(self, pdu, send_after=None):
         """Informs the replication layer about a new PDU generated within the
         home server that should be transmitted to others.
 
@@ -88,6 +161,8 @@ class ReplicationLayer(object):
 
         Args:
             pdu (Pdu): The new Pdu.
+            send_after (Deferred): If given, the PDU is only queued to be
+                sent once this has succeeded, and not at all if it fails.
 
         Returns:
             Deferred: Completes when we have successfully processed the PDU
@@ -104,12 +179,24 @@ class ReplicationLayer(object):
         yield self.pdu_actions.persist_outgoing(pdu)
 
         logger.debug("[%s] Persisted PDU", pdu.pdu_id)
-        logger.debug("[%s] transaction_layer.enqueue_pdu... ", pdu.pdu_id)
 
-        # TODO, add errback, etc.
-        self._transaction_queue.enqueue_pdu(pdu, order)
+        def enqueue(result):
+            logger.debug(
+                "[%s] transaction_layer.enqueue_pdu... ", pdu.pdu_id
+            )
+
+            # TODO, add errback, etc.
+            self._transaction_queue.enqueue_pdu(pdu, order)
 
-        logger.debug("[%s] transaction_layer.enqueue_pdu... done", pdu.pdu_id)
+            logger.debug(
+                "[%s] transaction_layer.enqueue_pdu... done", pdu.pdu_id
+            )
+            return result
+
+        if send_after is None:
+            enqueue(None)
+        else:
+            send_after.addCallback(enqueue)
 
     @log_function
     def send_edu(self, destination, edu_type, content):
@@ -148,7 +235,7 @@ class ReplicationLayer(object):
         transaction_data = yield self.transport_layer.paginate(
             dest, context, extremities, limit)
 
-        logger.debug("paginate transaction_data=%s", repr(transaction_data))
+        logger.debug("paginate transaction_data=%r", transaction_data)
 
         transaction = Transaction(**transaction_data)
 
@@ -192,6 +279,42 @@ class ReplicationLayer(object):
 
         defer.returnValue(pdu)
 
+    @defer.inlineCallbacks
+    @log_function
+    def get_state_ancestors(self, destination, pdu_origin, pdu_id, min_depth):
+        """Requests the state PDU with given origin and ID from the remote home
+        server, along with its chain of previous state PDUs back to the given
+        depth.
+
+        The PDUs we don't already have are persisted locally as outliers.
+
+        Args:
+            destination (str): Which home server to query
+            pdu_origin (str): The home server that originally sent the pdu.
+            pdu_id (str)
+            min_depth (int): The depth to stop at.
+
+        Returns:
+            Deferred: Results in the list of received PDUs, newest first.
+        """
+        transaction_data = yield self.transport_layer.get_state_ancestors(
+            destination, pdu_origin, pdu_id, min_depth)
+
+        transaction = Transaction(**transaction_data)
+
+        pdus = [Pdu(outlier=True, **p) for p in transaction.pdus]
+
+        # We persist the oldest first, so that each PDU's previous state is
+        # already there when it arrives. These are only needed to resolve
+        # state conflicts, so unlike `get_pdu` we don't pass them on to the
+        # handler one by one.
+        for pdu in reversed(pdus):
+            existing = yield self._get_persisted_pdu(pdu.pdu_id, pdu.origin)
+            if not existing:
+                yield self.pdu_actions.persist_received(pdu)
+
+        defer.returnValue(pdus)
+
     @defer.inlineCallbacks
     @log_function
     def get_state_for_context(self, destination, context):
@@ -217,13 +340,20 @@ class ReplicationLayer(object):
 
         defer.returnValue(pdus)
 
-    @defer.inlineCallbacks
     @log_function
     def on_context_pdus_request(self, context):
-        pdus = yield self.pdu_actions.get_all_pdus_from_context(
-            context
+        # Rooms can have a great many pdus, so rather than loading them all we
+        # stream them out, fetching more as the remote server reads them.
+        batches = self.pdu_actions.iter_pdus_from_context(
+            context, CONTEXT_PDUS_BATCH_SIZE
         )
-        defer.returnValue((200, self._transaction_from_pdus(pdus).get_dict()))
+
+        def get_dicts(pdus):
+            return [p.get_dict() for p in pdus]
+
+        pdu_dicts = (d.addCallback(get_dicts) for d in batches)
+
+        return defer.succeed((200, self._stream_transaction(pdu_dicts)))
 
     @defer.inlineCallbacks
     @log_function
@@ -231,7 +361,9 @@ class ReplicationLayer(object):
 
         pdus = yield self.pdu_actions.paginate(context, versions, limit)
 
-        defer.returnValue((200, self._transaction_from_pdus(pdus).get_dict()))
+        pdu_dicts = (p.get_dict() for p in pdus)
+
+        defer.returnValue((200, self._stream_transaction(pdu_dicts)))
 
     @defer.inlineCallbacks
     @log_function
@@ -240,6 +372,35 @@ class ReplicationLayer(object):
 
         logger.debug("[%s] Got transaction", transaction.transaction_id)
 
+        key = (transaction.origin, transaction.transaction_id)
+        if key in self._incoming_transactions:
+            logger.debug("[%s] Waiting for the response to the retried "
+                         "transaction", transaction.transaction_id)
+            deferred = defer.Deferred()
+            self._incoming_transactions[key].append(deferred)
+            response = yield deferred
+            defer.returnValue(response)
+            return
+
+        waiting = self._incoming_transactions[key] = []
+
+        def fire(result):
+            del self._incoming_transactions[key]
+            for deferred in waiting:
+                if isinstance(result, failure.Failure):
+                    deferred.errback(result)
+                else:
+                    deferred.callback(result)
+            return result
+
+        response = yield self._process_incoming_transaction(
+            transaction
+        ).addBoth(fire)
+
+        defer.returnValue(response)
+
+    @defer.inlineCallbacks
+    def _process_incoming_transaction(self, transaction):
         response = yield self.transaction_actions.have_responded(transaction)
 
         if response:
@@ -250,27 +411,24 @@ class ReplicationLayer(object):
 
         logger.debug("[%s] Transacition is new", transaction.transaction_id)
 
-        pdu_list = [Pdu(**p) for p in transaction.pdus]
-
-        dl = []
-        for pdu in pdu_list:
-            dl.append(self._handle_new_pdu(pdu))
-
         if hasattr(transaction, "edus"):
             for edu in [Edu(**x) for x in transaction.edus]:
                 self.received_edu(edu.origin, edu.edu_type, edu.content)
 
-        results = yield defer.DeferredList(dl)
-
+        # `transaction.pdus` may be a lazily decoded iterator, so we take the
+        # PDUs one at a time rather than decoding them all up front.
         ret = []
-        for r in results:
-            if r[0]:
+        for p in transaction.pdus:
+            try:
+                yield self._handle_new_pdu(Pdu(**p))
                 ret.append({})
-            else:
-                logger.exception(r[1])
-                ret.append({"error": str(r[1])})
+            except Exception as e:
+                logger.exception(e)
+                ret.append({"error": str(e)})
 
-        logger.debug("Returning: %s", str(ret))
+        logger.debug("Returning: %r", ret)
+
+        response = {"pdus": ret}
 
         yield self.transaction_actions.set_response(
             transaction,
@@ -293,8 +451,21 @@ class ReplicationLayer(object):
 
         logger.debug("Context returning %d results", len(results))
 
-        pdus = [Pdu.from_pdu_tuple(p) for p in results]
-        defer.returnValue((200, self._transaction_from_pdus(pdus).get_dict()))
+        # The store hands back the same list for as long as the context's
+        # state is unchanged, in which case we can reuse the dicts we built
+        # last time rather than decoding every PDU again.
+        cached = self._context_state_dicts.get(context)
+        if cached and cached[0] is results:
+            pdu_dicts = cached[1]
+        else:
+            pdu_dicts = [Pdu.from_pdu_tuple(p).get_dict() for p in results]
+            self._context_state_dicts.set(context, (results, pdu_dicts))
+
+        # We add the PDUs after calling get_dict, which would otherwise make a
+        # deep copy of them all.
+        response = self._transaction_from_pdus([]).get_dict()
+        response["pdus"] = pdu_dicts
+        defer.returnValue((200, response))
 
     @defer.inlineCallbacks
     @log_function
@@ -308,6 +479,19 @@ class ReplicationLayer(object):
         else:
             defer.returnValue((404, ""))
 
+    @defer.inlineCallbacks
+    @log_function
+    def on_state_ancestors_request(self, pdu_origin, pdu_id, min_depth):
+        results = yield self.store.get_state_ancestors(
+            pdu_id, pdu_origin, min_depth, MAX_STATE_ANCESTORS
+        )
+
+        if not results:
+            defer.returnValue((404, ""))
+
+        pdus = [Pdu.from_pdu_tuple(p) for p in results]
+        defer.returnValue((200, self._transaction_from_pdus(pdus).get_dict()))
+
     @defer.inlineCallbacks
     @log_function
     def on_pull_request(self, origin, versions):
@@ -349,6 +533,21 @@ class ReplicationLayer(object):
             destination=None,
         )
 
+    def _stream_transaction(self, pdu_dicts):
+        """Returns a JsonStreamResponse for a new transaction containing the
+        given PDUs, which are only encoded as they're sent.
+
+        Args:
+            pdu_dicts (iterable): The dicts of the PDUs, or Deferreds which
+                result in lists of them.
+        """
+        transaction = self._transaction_from_pdus([])
+        return JsonStreamResponse(
+            pdu_dicts,
+            json_object=transaction.get_dict(),
+            list_key="pdus",
+        )
+
     @defer.inlineCallbacks
     @log_function
     def _handle_new_pdu(self, pdu):
@@ -431,9 +630,29 @@ class _TransactionQueue(object):
         # destination -> list of tuple(edu, deferred)
         self.pending_edus_by_dest = {}
 
+        # Maps EDU types to the EduCoalescer which merges them.
+        self.edu_coalescers = {}
+
+        # destination -> edu type -> tuple(edu, deferred, buffer) for the
+        # last pending EDU of each type which has a coalescer. The buffer is
+        # None if nothing can be merged into that EDU.
+        self.edu_buffers_by_dest = {}
+
+        # How long, in seconds, EDUs which may be merged wait to be sent.
+        self.edu_coalesce_window = hs.federation_edu_coalesce_window
+
+        # destination -> the timer which will send its held back EDUs
+        self.edu_timers = {}
+
+        # The number of EDUs which were merged into another pending EDU.
+        self.coalesced_edus = 0
+
         # HACK to get unique tx id
         self._next_txn_id = int(self._clock.time_msec())
 
+    def register_edu_coalescer(self, edu_type, coalescer):
+        self.edu_coalescers[edu_type] = coalescer
+
     @defer.inlineCallbacks
     @log_function
     def enqueue_pdu(self, pdu, order):
@@ -446,7 +665,7 @@ class _TransactionQueue(object):
             if d != self.server_name
         ]
 
-        logger.debug("Sending to: %s", str(destinations))
+        logger.debug("Sending to: %s", destinations)
 
         if not destinations:
             return
@@ -469,14 +688,70 @@ class _TransactionQueue(object):
     def enqueue_edu(self, edu):
         destination = edu.destination
 
+        coalescer = self.edu_coalescers.get(edu.edu_type)
+        if coalescer:
+            deferred = self._coalesce_edu(edu, coalescer)
+            if deferred:
+                return deferred
+
         deferred = defer.Deferred()
         self.pending_edus_by_dest.setdefault(destination, []).append(
             (edu, deferred)
         )
 
+        if coalescer:
+            self.edu_buffers_by_dest.setdefault(destination, {})[
+                edu.edu_type
+            ] = (edu, deferred, coalescer.start(edu.content))
+
         def eb(failure):
             deferred.errback(failure)
-        self._attempt_new_transaction(destination).addErrback(eb)
+
+        if coalescer and self.edu_coalesce_window:
+            # Hold the EDU back, so that later ones can be merged into it.
+            if destination not in self.edu_timers:
+                def send():
+                    del self.edu_timers[destination]
+                    self._attempt_new_transaction(destination).addErrback(eb)
+
+                self.edu_timers[destination] = self._clock.call_later(
+                    self.edu_coalesce_window, send
+                )
+        else:
+            self._attempt_new_transaction(destination).addErrback(eb)
+
+        return deferred
+
+    def _coalesce_edu(self, edu, coalescer):
+        """Tries to merge an EDU into the last pending EDU of the same type to
+        the same destination. Earlier ones aren't tried, since that would
+        reorder the EDU with the ones queued after them.
+
+        Returns:
+            Deferred: Which fires when the merged EDU has been sent, or None
+            if the EDU couldn't be merged.
+        """
+        pending = self.edu_buffers_by_dest.get(edu.destination, {}).get(
+            edu.edu_type
+        )
+        if not pending:
+            return None
+
+        _, pending_deferred, buffer = pending
+        if buffer is None or not coalescer.merge(buffer, edu.content):
+            return None
+
+        self.coalesced_edus += 1
+
+        deferred = defer.Deferred()
+
+        def fire(result):
+            if isinstance(result, failure.Failure):
+                deferred.errback(result)
+            else:
+                deferred.callback(result)
+            return result
+        pending_deferred.addBoth(fire)
 
         return deferred
 
@@ -486,10 +761,20 @@ class _TransactionQueue(object):
         if destination in self.pending_transactions:
             return
 
+        # Any held back EDUs are sent now, along with everything else.
+        timer = self.edu_timers.pop(destination, None)
+        if timer:
+            self._clock.cancel_call_later(timer)
+
         #  list of (pending_pdu, deferred, order)
         pending_pdus = self.pending_pdus_by_dest.pop(destination, [])
         pending_edus = self.pending_edus_by_dest.pop(destination, [])
 
+        edu_buffers = self.edu_buffers_by_dest.pop(destination, {})
+        for edu_type, (edu, _, buffer) in edu_buffers.items():
+            if buffer is not None:
+                edu.content = self.edu_coalescers[edu_type].finish(buffer)
+
         if not pending_pdus and not pending_edus:
             return
 
@@ -7,12 +7,12 @@ support HTTP), however individual pairings of servers may decide to communicate
 over a different (albeit still reliable) protocol.
 """
 
-from twisted.internet import defer
+from twisted.internet import defer, threads
 
 from synapse.util.logutils import log_function
+from synapse.util.jsonutil import decode_json_with_list_iter
 
 import logging
-import json
 import re
 
 
@@ -37,9 +37,16 @@ class TransportLayer(object):
 
         received_handler (TransportReceivedHandler): The handler to fire when
             we receive data.
+
+        max_body_size (int): The largest transaction body, in bytes, that we
+            will accept.
+
+        threaded_decode_size (int): Transaction bodies bigger than this
+            many bytes are decoded in a thread.
     """
 
-    def __init__(self, server_name, server, client):
+    def __init__(self, server_name, server, client, max_body_size,
+                 threaded_decode_size):
         """
         Args:
             server_name (str): Local home server host
@@ -47,10 +54,16 @@ class TransportLayer(object):
                 register listeners on
             client (synapse.protocol.http.HttpClient): the http client used to
                 send requests
+            max_body_size (int): The largest transaction body, in bytes, that
+                we will accept.
+            threaded_decode_size (int): Transaction bodies bigger than
+                this many bytes are decoded in a thread.
         """
         self.server_name = server_name
         self.server = server
         self.client = client
+        self.max_body_size = max_body_size
+        self.threaded_decode_size = threaded_decode_size
         self.request_handler = None
         self.received_handler = None
 
@@ -94,6 +107,35 @@ class TransportLayer(object):
 
         return self._do_request_for_transaction(destination, path)
 
+    @log_function
+    def get_state_ancestors(self, destination, pdu_origin, pdu_id, min_depth):
+        """ Requests the state pdu with the given id and origin, along with
+        its chain of previous state pdus back to the given depth.
+
+        Args:
+            destination (str): The host name of the remote home server we want
+                to get the pdus from.
+            pdu_origin (str): The home server which created the PDU.
+            pdu_id (str): The id of the PDU being requested.
+            min_depth (int): The depth to stop at.
+
+        Returns:
+            Deferred: Results in a dict received from the remote homeserver.
+        """
+        logger.debug(
+            "get_state_ancestors dest=%s, pdu_origin=%s, pdu_id=%s, "
+            "min_depth=%s",
+            destination, pdu_origin, pdu_id, min_depth
+        )
+
+        path = "/state_ancestors/%s/%s/" % (pdu_origin, pdu_id)
+
+        return self._do_request_for_transaction(
+            destination,
+            path,
+            args={"min_depth": min_depth},
+        )
+
     @log_function
     def paginate(self, dest, context, pdu_tuples, limit):
         """ Requests `limit` previous PDUs in a given context before list of
@@ -109,8 +151,8 @@ class TransportLayer(object):
             Deferred: Results in a dict received from the remote homeserver.
         """
         logger.debug(
-            "paginate dest=%s, context=%s, pdu_tuples=%s, limit=%s",
-            dest, context, repr(pdu_tuples), str(limit)
+            "paginate dest=%s, context=%s, pdu_tuples=%r, limit=%s",
+            dest, context, pdu_tuples, limit
         )
 
         if not pdu_tuples:
@@ -210,6 +252,17 @@ class TransportLayer(object):
             )
         )
 
+        # This is when someone asks for a state pdu and its ancestors.
+        self.server.register_path(
+            "GET",
+            re.compile("^/state_ancestors/([^/]*)/([^/]*)/$"),
+            lambda request, pdu_origin, pdu_id: (
+                self._on_state_ancestors_request(
+                    pdu_origin, pdu_id, request.args.get("min_depth")
+                )
+            )
+        )
+
         # This is when someone asks for all data for a given context.
         self.server.register_path(
             "GET",
@@ -249,18 +302,35 @@ class TransportLayer(object):
             `response` is a python dict to be converted into JSON that is
             used as the response body.
         """
+        data = request.content.read(self.max_body_size + 1)
+
+        if len(data) > self.max_body_size:
+            logger.warn(
+                "Transaction %s is larger than %d bytes",
+                transaction_id, self.max_body_size
+            )
+            defer.returnValue((413, {"error": "Transaction too large"}))
+            return
+
         # Parse the request
         try:
-            data = request.content.read()
-
             l = data[:20].encode("string_escape")
             logger.debug("Got data: \"%s\"", l)
 
-            transaction_data = json.loads(data)
+            # The PDUs are handed to the replication layer one at a time, so
+            # each can be freed once it has been handled.
+            if len(data) > self.threaded_decode_size:
+                transaction_data, pdus = yield threads.deferToThread(
+                    decode_json_with_list_iter, data, "pdus"
+                )
+            else:
+                transaction_data, pdus = decode_json_with_list_iter(
+                    data, "pdus"
+                )
 
             logger.debug(
-                "Decoded %s: %s",
-                transaction_id, str(transaction_data)
+                "Decoded %s: %d bytes from %s",
+                transaction_id, len(data), transaction_data.get("origin")
             )
 
             # We should ideally be getting this from the security layer.
@@ -270,7 +340,8 @@ class TransportLayer(object):
             # in the request body.
             transaction_data.update(
                 transaction_id=transaction_id,
-                destination=self.server_name
+                destination=self.server_name,
+                pdus=pdus,
             )
 
         except Exception as e:
@@ -326,6 +397,23 @@ class TransportLayer(object):
         return self.request_handler.on_paginate_request(
             context, versions, limit)
 
+    @log_function
+    def _on_state_ancestors_request(self, pdu_origin, pdu_id, min_depths):
+        if not min_depths:
+            return defer.succeed(
+                (400, {"error": "Did not include min_depth param"})
+            )
+
+        try:
+            min_depth = int(min_depths[-1])
+        except ValueError:
+            return defer.succeed(
+                (400, {"error": "min_depth param must be an integer"})
+            )
+
+        return self.request_handler.on_state_ancestors_request(
+            pdu_origin, pdu_id, min_depth)
+
 
 class TransportReceivedHandler(object):
     """ Callbacks used when we receive a transaction
@@ -396,6 +484,27 @@ class TransportRequestHandler(object):
         """
         pass
 
+    def on_state_ancestors_request(self, pdu_origin, pdu_id, min_depth):
+        """ Called on GET /state_ancestors/<pdu_origin>/<pdu_id>/?min_depth=...
+
+        Someone wants a particular state PDU along with its chain of previous
+        state PDUs, back to the given depth.
+
+        Args:
+            pdu_origin (str)
+            pdu_id (str)
+            min_depth (int): The depth to stop at.
+
+        Returns:
+            Deferred: Resultsin a tuple in the form of
+            `(response_code, respond_body)`, where `response_body` is a python
+            dict that will get serialized to JSON.
+
+            On errors, the dict should have an `error` key with a brief message
+            of what went wrong.
+        """
+        pass
+
     def on_context_state_request(self, context):
         """ Called on GET /state/<context>/
 
@@ -433,7 +542,8 @@ class TransportRequestHandler(object):
         Returns:
             Deferred: Resultsin a tuple in the form of
             `(response_code, respond_body)`, where `response_body` is a python
-            dict that will get serialized to JSON.
+            dict that will get serialized to JSON, or a
+            `synapse.http.server.JsonStreamResponse`.
 
             On errors, the dict should have an `error` key with a brief message
             of what went wrong.
@@ -4,9 +4,9 @@ server protocol.
 """
 
 from synapse.util.jsonobject import JsonEncodedObject
+from synapse.util.jsonutil import decode_json
 
 import logging
-import json
 import copy
 
 
@@ -103,12 +103,12 @@ class Pdu(JsonEncodedObject):
         if pdu_tuple:
             d = copy.copy(pdu_tuple.pdu_entry._asdict())
 
-            d["content"] = json.loads(d["content_json"])
+            d["content"] = decode_json(d["content_json"])
             del d["content_json"]
 
             args = {f: d[f] for f in cls.valid_keys if f in d}
             if "unrecognized_keys" in d and d["unrecognized_keys"]:
-                args.update(json.loads(d["unrecognized_keys"]))
+                args.update(decode_json(d["unrecognized_keys"]))
 
             return Pdu(
                 prev_pdus=pdu_tuple.prev_pdu_list,
@@ -4,7 +4,6 @@ from twisted.internet import defer
 from ._base import BaseHandler
 
 import logging
-import json
 
 logger = logging.getLogger(__name__)
 
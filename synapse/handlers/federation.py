@@ -56,6 +56,15 @@ class FederationHandler(BaseHandler):
 
         else:
             with (yield self.room_lock.lock(event.room_id)):
-                store_id = yield self.store.persist_event(event)
+                persisted = self.store.persist_event(event)
+
+            store_id = yield persisted
+
+            if event.type == RoomMemberEvent.TYPE:
+                rm_handler = self.hs.get_handlers().room_member_handler
+                rm_handler.on_membership_changed(
+                    event.room_id, self.hs.parse_userid(event.target_user_id),
+                    event.content["membership"]
+                )
 
             yield self.notifier.on_new_room_event(event, store_id)
@@ -4,7 +4,6 @@ from twisted.internet import defer
 from ._base import BaseHandler
 from synapse.api.errors import LoginError
 
-import bcrypt
 import logging
 
 logger = logging.getLogger(__name__)
@@ -15,6 +14,7 @@ class LoginHandler(BaseHandler):
     def __init__(self, hs):
         super(LoginHandler, self).__init__(hs)
         self.hs = hs
+        self.password_hasher = hs.get_password_hasher()
 
     @defer.inlineCallbacks
     def login(self, user, password):
@@ -28,6 +28,8 @@ class LoginHandler(BaseHandler):
         Raises:
             StoreError if there was a problem storing the token.
             LoginError if there was an authentication problem.
+            LimitExceededError if too many passwords are waiting to be
+            checked.
         """
         # TODO do this better, it can't go in __init__ else it cyclic loops
         if not hasattr(self, "reg_handler"):
@@ -40,7 +42,8 @@ class LoginHandler(BaseHandler):
             raise LoginError(403, "")
 
         stored_hash = user_info[0]["password_hash"]
-        if bcrypt.checkpw(password, stored_hash):
+        matches = yield self.password_hasher.check(password, stored_hash)
+        if matches:
             # generate an access token and store it.
             token = self.reg_handler._generate_token(user)
             logger.info("Adding token %s for user %s", token, user)
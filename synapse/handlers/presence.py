@@ -4,15 +4,22 @@ from twisted.internet import defer
 from synapse.api.errors import SynapseError, AuthError
 from synapse.api.constants import PresenceState
 from synapse.api.streams import StreamData
+from synapse.federation.replication import EduCoalescer
 
 from ._base import BaseHandler
 
+import bisect
+import collections
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
+# The presence change log is never compacted while it is shorter than this.
+CHANGE_LOG_MIN_COMPACT_SIZE = 1000
+
+
 # TODO(paul): Maybe there's one of these I can steal from somewhere
 def partition(l, func):
     """Partition the list by the result of func applied to each element."""
@@ -35,6 +42,37 @@ def partitionbool(l, func):
     return ret.get(True, []), ret.get(False, [])
 
 
+class PresenceEduCoalescer(EduCoalescer):
+    """Merges m.presence EDUs to the same destination, so that only the
+    latest push for each user is sent.
+
+    Only EDUs which just push state are merged, since reordering polls and
+    unpolls could change their meaning.
+    """
+
+    def start(self, content):
+        if set(content.keys()) != set(["push"]):
+            return None
+
+        # Each push carries the user's whole state, so a later push for a
+        # user replaces the earlier one.
+        return collections.OrderedDict(
+            (push["user_id"], push) for push in content["push"]
+        )
+
+    def merge(self, pushes, content):
+        if set(content.keys()) != set(["push"]):
+            return False
+
+        for push in content["push"]:
+            pushes[push["user_id"]] = push
+
+        return True
+
+    def finish(self, pushes):
+        return {"push": pushes.values()}
+
+
 class PresenceHandler(BaseHandler):
 
     def __init__(self, hs):
@@ -42,6 +80,8 @@ class PresenceHandler(BaseHandler):
 
         self.homeserver = hs
 
+        self.clock = hs.get_clock()
+
         distributor = hs.get_distributor()
         distributor.observe("registered_user", self.registered_user)
 
@@ -70,6 +110,9 @@ class PresenceHandler(BaseHandler):
         self.federation.register_edu_handler(
             "m.presence", self.incoming_presence
         )
+        self.federation.register_edu_coalescer(
+            "m.presence", PresenceEduCoalescer()
+        )
         self.federation.register_edu_handler(
             "m.presence_invite",
             lambda origin, content: self.invite_presence(
@@ -105,6 +148,19 @@ class PresenceHandler(BaseHandler):
         self._user_cachemap = {}
         self._user_cachemap_latest_serial = 0
 
+        # Maps the localparts of local users to presence state which has been
+        # set but not yet written to the store. Reads check this first, so
+        # it is authoritative until flush_presence writes it out.
+        self._dirty_presence = {}
+        self._presence_flush_timer = None
+
+        # A log of the changes to _user_cachemap, in order of serial, kept as
+        # parallel lists of serials and users so that it can be bisected. A
+        # user's entry is superseded by any later change to them, and is
+        # compacted away once enough entries are.
+        self._user_cachemap_change_serials = []
+        self._user_cachemap_change_users = []
+
     def _get_or_make_usercache(self, user):
         """If the cache entry doesn't exist, initialise a new one."""
         if user not in self._user_cachemap:
@@ -121,6 +177,134 @@ class PresenceHandler(BaseHandler):
             statuscache.update({"state": PresenceState.OFFLINE}, user)
             return statuscache
 
+    def _update_usercache(self, user, statuscache, state):
+        """Applies a change to a user's cached presence, giving it the next
+        serial and recording it in the change log."""
+        self._user_cachemap_latest_serial += 1
+        serial = self._user_cachemap_latest_serial
+
+        statuscache.update(state, serial=serial)
+
+        self._user_cachemap_change_serials.append(serial)
+        self._user_cachemap_change_users.append(user)
+
+        # Only the latest entry for each user in the cachemap is needed, so
+        # once at least half the log is superseded, drop those entries.
+        if len(self._user_cachemap_change_serials) > max(
+                CHANGE_LOG_MIN_COMPACT_SIZE, 2 * len(self._user_cachemap)):
+            self._compact_change_log()
+
+    def _compact_change_log(self):
+        live = [
+            (serial, user) for serial, user in zip(
+                self._user_cachemap_change_serials,
+                self._user_cachemap_change_users,
+            )
+            if self._is_latest_change(serial, user)
+        ]
+
+        self._user_cachemap_change_serials = [x[0] for x in live]
+        self._user_cachemap_change_users = [x[1] for x in live]
+
+    def _is_latest_change(self, serial, user):
+        statuscache = self._user_cachemap.get(user)
+        return statuscache is not None and statuscache.serial == serial
+
+    def get_changes(self, from_key, to_key, limit=0):
+        """Gets the users whose cached presence changed after `from_key`, up
+        to and including `to_key`. Only the latest change to each user is
+        returned.
+
+        This costs time proportional to the number of changes in the range,
+        not the number of users in the cache.
+
+        Args:
+            from_key (int): The serial to start after.
+            to_key (int): The serial to end at.
+            limit (int): The most users to return, or 0 for no limit.
+        Returns:
+            list: 2-tuples of user and their UserPresenceCache, in order of
+            serial.
+        """
+        serials = self._user_cachemap_change_serials
+        users = self._user_cachemap_change_users
+
+        changes = []
+        for i in xrange(bisect.bisect_right(serials, from_key), len(serials)):
+            serial = serials[i]
+            if serial > to_key:
+                break
+
+            user = users[i]
+            if self._is_latest_change(serial, user):
+                changes.append((user, self._user_cachemap[user]))
+                if limit and len(changes) >= limit:
+                    break
+
+        return changes
+
+    def _get_presence_state(self, user_localpart):
+        """Gets a local user's presence state, including any changes which
+        have not been written to the store yet.
+
+        Returns:
+            Deferred: Resolves to a dict of their state and status_msg.
+        """
+        if user_localpart in self._dirty_presence:
+            return defer.succeed(dict(self._dirty_presence[user_localpart]))
+        return self.store.get_presence_state(user_localpart)
+
+    def _set_presence_state(self, user_localpart, state):
+        """Records a local user's new presence state, to be written to the
+        store by the next flush."""
+        self._dirty_presence[user_localpart] = {
+            "state": state["state"],
+            "status_msg": state["status_msg"],
+        }
+
+        if self._presence_flush_timer is None:
+            self._presence_flush_timer = self.clock.call_later(
+                self.hs.presence_flush_interval, self._on_presence_flush_timer
+            )
+
+    def _on_presence_flush_timer(self):
+        self._presence_flush_timer = None
+        self.flush_presence()
+
+    def flush_presence(self):
+        """Writes all the presence state which has been set since the last
+        flush to the store, in one batch.
+
+        Returns:
+            Deferred: Fires once the state has been written.
+        """
+        if self._presence_flush_timer is not None:
+            self.clock.cancel_call_later(self._presence_flush_timer)
+            self._presence_flush_timer = None
+
+        if not self._dirty_presence:
+            return defer.succeed(None)
+
+        states = self._dirty_presence
+        self._dirty_presence = {}
+
+        logger.debug("Flushing presence state of %d users", len(states))
+
+        def eb(failure):
+            logger.error(
+                "Failed to store presence state of %d users: %s",
+                len(states), failure.getErrorMessage()
+            )
+
+            # Try again later, unless the state has changed again since.
+            for user_localpart, state in states.items():
+                if user_localpart not in self._dirty_presence:
+                    self._set_presence_state(user_localpart, state)
+
+        d = self.store.set_presence_states(states)
+        d.addErrback(eb)
+        return d
+
     def registered_user(self, user):
         self.store.create_presence(user.localpart)
 
@@ -151,9 +335,7 @@ class PresenceHandler(BaseHandler):
             )
 
             if visible:
-                state = yield self.store.get_presence_state(
-                    target_user.localpart
-                )
+                state = yield self._get_presence_state(target_user.localpart)
                 defer.returnValue(state)
             else:
                 raise SynapseError(404, "Presence information not visible")
@@ -184,16 +366,11 @@ class PresenceHandler(BaseHandler):
         logger.debug("Updating presence state of %s to %s",
                      target_user.localpart, state["state"])
 
-        state_to_store = dict(state)
+        self._set_presence_state(target_user.localpart, state)
 
-        yield defer.DeferredList([
-            self.store.set_presence_state(
-                target_user.localpart, state_to_store
-            ),
-            self.distributor.fire(
-                "collect_presencelike_data", target_user, state
-            ),
-        ])
+        yield self.distributor.fire(
+            "collect_presencelike_data", target_user, state
+        )
 
         now_online = state["state"] != PresenceState.OFFLINE
         was_polling = target_user in self._user_cachemap
@@ -213,8 +390,7 @@ class PresenceHandler(BaseHandler):
     def changed_presencelike_data(self, user, state):
         statuscache = self._get_or_make_usercache(user)
 
-        self._user_cachemap_latest_serial += 1
-        statuscache.update(state, serial=self._user_cachemap_latest_serial)
+        self._update_usercache(user, statuscache, state)
 
         self.push_presence(user, statuscache=statuscache)
 
@@ -365,7 +541,7 @@ class PresenceHandler(BaseHandler):
             ]
 
         if state is None:
-            state = yield self.store.get_presence_state(user.localpart)
+            state = yield self._get_presence_state(user.localpart)
 
         localusers, remoteusers = partitionbool(
             target_users,
@@ -479,13 +655,9 @@ class PresenceHandler(BaseHandler):
         localusers.add(user)
 
         rm_handler = self.homeserver.get_handlers().room_member_handler
-        room_ids = yield rm_handler.get_rooms_for_user(user)
-
-        for room_id in room_ids:
-            yield rm_handler.fetch_room_distributions_into(
-                room_id, localusers=localusers, remotedomains=remotedomains,
-                ignore_user=user,
-            )
+        yield rm_handler.fetch_co_member_distributions_into(
+            user, localusers=localusers, remotedomains=remotedomains
+        )
 
         if not localusers and not remotedomains:
             defer.returnValue(None)
@@ -531,7 +703,7 @@ class PresenceHandler(BaseHandler):
     @defer.inlineCallbacks
     def _push_presence_remote(self, user, destination, state=None):
         if state is None:
-            state = yield self.store.get_presence_state(user.localpart)
+            state = yield self._get_presence_state(user.localpart)
             yield self.distributor.fire(
                 "collect_presencelike_data", user, state
             )
@@ -558,23 +730,19 @@ class PresenceHandler(BaseHandler):
             observers = set(self._remote_recvmap.get(user, set()))
 
             rm_handler = self.homeserver.get_handlers().room_member_handler
-            room_ids = yield rm_handler.get_rooms_for_user(user)
-
-            for room_id in room_ids:
-                yield rm_handler.fetch_room_distributions_into(
-                    room_id, localusers=observers, ignore_user=user
-                )
+            yield rm_handler.fetch_co_member_distributions_into(
+                user, localusers=observers
+            )
 
             if not observers:
-                break
+                continue
 
             state = dict(push)
             del state["user_id"]
 
             statuscache = self._get_or_make_usercache(user)
 
-            self._user_cachemap_latest_serial += 1
-            statuscache.update(state, serial=self._user_cachemap_latest_serial)
+            self._update_usercache(user, statuscache, state)
 
             for observer_user in observers:
                 self.push_update_to_clients(
@@ -631,14 +799,11 @@ class PresenceStreamData(StreamData):
         self.presence = hs.get_handlers().presence_handler
 
     def get_rows(self, user_id, from_key, to_key, limit):
-        cachemap = self.presence._user_cachemap
-
-        # TODO(paul): limit, and filter by visibility
-        updates = [(k, cachemap[k]) for k in cachemap
-                   if from_key < cachemap[k].serial <= to_key]
+        # TODO(paul): filter by visibility
+        updates = self.presence.get_changes(from_key, to_key, limit)
 
         if updates:
-            latest_serial = max([x[1].serial for x in updates])
+            latest_serial = updates[-1][1].serial
             data = [x[1].make_event(user=x[0]) for x in updates]
             return ((data, latest_serial))
         else:
@@ -8,7 +8,6 @@ from ._base import BaseHandler
 import synapse.util.stringutils as stringutils
 
 import base64
-import bcrypt
 
 
 class RegistrationHandler(BaseHandler):
@@ -19,6 +18,8 @@ class RegistrationHandler(BaseHandler):
         self.distributor = hs.get_distributor()
         self.distributor.declare("registered_user")
 
+        self.password_hasher = hs.get_password_hasher()
+
     @defer.inlineCallbacks
     def register(self, localpart=None, password=None):
         """Registers a new client on the server.
@@ -32,10 +33,11 @@ class RegistrationHandler(BaseHandler):
             A tuple of (user_id, access_token).
         Raises:
             RegistrationError if there was a problem registering.
+            LimitExceededError if too many passwords are waiting to be hashed.
         """
         password_hash = None
         if password:
-            password_hash = bcrypt.hashpw(password, bcrypt.gensalt())
+            password_hash = yield self.password_hasher.hash(password)
 
         if localpart:
             user = UserID(localpart, self.hs.hostname, True)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Contains functions for performing events on rooms."""
 from twisted.internet import defer
+from twisted.python import failure
 
 from synapse.types import UserID, RoomName
 from synapse.api.constants import Membership
@@ -9,12 +10,14 @@ from synapse.api.events.room import (
     RoomTopicEvent, MessageEvent, InviteJoinEvent, RoomMemberEvent,
     RoomConfigEvent
 )
+from synapse.api.streams import PaginationStream
 from synapse.api.streams.event import EventStream, MessagesStreamData
 from synapse.util import stringutils
 from ._base import BaseHandler
+from synapse.util.jsonutil import encode_json
 
+import bisect
 import logging
-import json
 
 logger = logging.getLogger(__name__)
 
@@ -69,20 +72,40 @@ class MessageHandler(BaseHandler):
         if stamp_event:
             event.content["hsob_ts"] = int(self.clock.time_msec())
 
-        with (yield self.room_lock.lock(event.room_id)):
-            if not suppress_auth:
-                yield self.auth.check(event, raises=True)
+        # Only the steps that need to be ordered relative to other events in
+        # the room are done under the room lock.
+        if not suppress_auth:
+            yield self.auth.check(event, raises=True)
 
-            # store message in db
-            store_id = yield self.store.persist_event(event)
+        event.destinations = yield self.store.get_joined_hosts_for_room(
+            event.room_id
+        )
 
-            event.destinations = yield self.store.get_joined_hosts_for_room(
-                event.room_id
-            )
+        with (yield self.room_lock.lock(event.room_id)):
+            # store message in db. Queueing the write allocates its stream id,
+            # which is all that needs ordering, so we wait for it to be
+            # committed after releasing the lock.
+            persisted = self.store.persist_event(event)
 
-            yield self.hs.get_federation().handle_new_event(event)
+            # The PDU is ordered among the room's PDUs under the lock too, but
+            # isn't sent until the event has been stored.
+            try:
+                yield self.hs.get_federation().handle_new_event(
+                    event, send_after=persisted
+                )
+            except:
+                # Don't leave a failure to store the event unhandled.
+                f = failure.Failure()
+                persisted.addErrback(
+                    lambda e: logger.error(
+                        "Failed to store event: %s", e.getErrorMessage()
+                    )
+                )
+                f.raiseException()
+
+        store_id = yield persisted
 
-            self.notifier.on_new_room_event(event, store_id)
+        self.notifier.on_new_room_event(event, store_id)
 
     @defer.inlineCallbacks
     def get_messages(self, user_id=None, room_id=None, pagin_config=None,
@@ -118,26 +141,31 @@ class MessageHandler(BaseHandler):
             SynapseError if something went wrong.
         """
 
-        with (yield self.room_lock.lock(event.room_id)):
-            yield self.auth.check(event, raises=True)
+        yield self.auth.check(event, raises=True)
 
-            if stamp_event:
-                event.content["hsob_ts"] = int(self.clock.time_msec())
+        if stamp_event:
+            event.content["hsob_ts"] = int(self.clock.time_msec())
 
+        event.destinations = yield self.store.get_joined_hosts_for_room(
+            event.room_id
+        )
+
+        with (yield self.room_lock.lock(event.room_id)):
+            # This works out the event's place in the room's state, so needs
+            # to be ordered along with storing it.
             yield self.state_handler.handle_new_event(event)
 
             # store in db
-            store_id = yield self.store.store_room_data(
+            persisted = self.store.store_room_data(
                 room_id=event.room_id,
                 etype=event.type,
                 state_key=event.state_key,
-                content=json.dumps(event.content)
+                content=encode_json(event.content)
             )
 
-            event.destinations = yield self.store.get_joined_hosts_for_room(
-                event.room_id
-            )
-            self.notifier.on_new_room_event(event, store_id)
+        store_id = yield persisted
+
+        self.notifier.on_new_room_event(event, store_id)
 
         yield self.hs.get_federation().handle_new_event(event)
 
@@ -210,15 +238,18 @@ class MessageHandler(BaseHandler):
         if stamp_event:
             event.content["hsob_ts"] = int(self.clock.time_msec())
 
-        with (yield self.room_lock.lock(event.room_id)):
-            yield self.auth.check(event, raises=True)
+        yield self.auth.check(event, raises=True)
 
+        event.destinations = yield self.store.get_joined_hosts_for_room(
+            event.room_id
+        )
+
+        with (yield self.room_lock.lock(event.room_id)):
             # store message in db
-            store_id = yield self.store.persist_event(event)
+            persisted = self.store.persist_event(event)
+
+        store_id = yield persisted
 
-            event.destinations = yield self.store.get_joined_hosts_for_room(
-                event.room_id
-            )
         yield self.hs.get_federation().handle_new_event(event)
 
         self.notifier.on_new_room_event(event, store_id)
@@ -246,19 +277,27 @@ class MessageHandler(BaseHandler):
             user_id=user_id,
             membership_list=[Membership.INVITE, Membership.JOIN]
         )
-        for room_info in room_list:
-            if room_info["membership"] != Membership.JOIN:
-                continue
-            try:
-                event_chunk = yield self.get_messages(
-                    user_id=user_id,
-                    pagin_config=pagin_config,
-                    feedback=feedback,
-                    room_id=room_info["room_id"]
-                )
-                room_info["messages"] = event_chunk
-            except:
-                pass
+
+        # We already know which rooms the user is joined to, so rather than
+        # calling get_messages for each in turn we fetch the messages for all
+        # of them at once.
+        joined_room_ids = [
+            room_info["room_id"] for room_info in room_list
+            if room_info["membership"] == Membership.JOIN
+        ]
+
+        if joined_room_ids:
+            data_source = [MessagesStreamData(self.hs, feedback=feedback)]
+            event_stream = EventStream(user_id, data_source)
+            pagin_config = yield event_stream.fix_tokens(pagin_config)
+            chunks = yield event_stream.get_room_chunks(
+                joined_room_ids, config=pagin_config
+            )
+
+            for room_info in room_list:
+                if room_info["room_id"] in chunks:
+                    room_info["messages"] = chunks[room_info["room_id"]]
+
         defer.returnValue(room_list)
 
 
@@ -352,6 +391,17 @@ class RoomMemberHandler(BaseHandler):
         self.distributor = hs.get_distributor()
         self.distributor.declare("user_joined_room")
 
+        # In memory index of joined members. Maps room IDs to the set of
+        # users joined to them, and users to the set of rooms they are joined
+        # to. Each entry is loaded from the store when first needed, and then
+        # kept up to date by on_membership_changed.
+        self._joined_members = {}
+        self._joined_rooms = {}
+
+        # Incremented on every membership change, so that a load which raced
+        # with a change doesn't get cached.
+        self._membership_sequence = 0
+
     @defer.inlineCallbacks
     def get_room_members(self, room_id, membership=Membership.JOIN):
         hs = self.hs
@@ -362,6 +412,74 @@ class RoomMemberHandler(BaseHandler):
 
         defer.returnValue([hs.parse_userid(m.user_id) for m in memberships])
 
+    def get_joined_members(self, room_id):
+        """Get the users joined to a room, from the in memory index.
+
+        Args:
+            room_id (str): The room to get the members of.
+        Returns:
+            Deferred: Resolves to the set of UserIDs joined to the room, which
+            must not be modified.
+        """
+        if room_id in self._joined_members:
+            return defer.succeed(self._joined_members[room_id])
+
+        return self._load_into_index(
+            self._joined_members, room_id, self.get_room_members(room_id)
+        )
+
+    def get_joined_rooms(self, user):
+        """Get the rooms a user is joined to, from the in memory index.
+
+        Args:
+            user (UserID): The user to get the rooms of.
+        Returns:
+            Deferred: Resolves to the set of room IDs the user is joined to,
+            which must not be modified.
+        """
+        if user in self._joined_rooms:
+            return defer.succeed(self._joined_rooms[user])
+
+        return self._load_into_index(
+            self._joined_rooms, user, self.get_rooms_for_user(user)
+        )
+
+    def _load_into_index(self, index, key, d):
+        sequence = self._membership_sequence
+
+        def cache(values):
+            values = set(values)
+            if sequence == self._membership_sequence:
+                index[key] = values
+            return values
+
+        return d.addCallback(cache)
+
+    def on_membership_changed(self, room_id, user, membership):
+        """Updates the in memory index of joined members after a membership
+        change has been stored.
+
+        Args:
+            room_id (str): The room the membership changed in.
+            user (UserID): The user whose membership changed.
+            membership (str): The new membership.
+        """
+        self._membership_sequence += 1
+
+        members = self._joined_members.get(room_id)
+        rooms = self._joined_rooms.get(user)
+
+        if membership == Membership.JOIN:
+            if members is not None:
+                members.add(user)
+            if rooms is not None:
+                rooms.add(room_id)
+        else:
+            if members is not None:
+                members.discard(user)
+            if rooms is not None:
+                rooms.discard(room_id)
+
     @defer.inlineCallbacks
     def fetch_room_distributions_into(self, room_id, localusers=None,
                                       remotedomains=None, ignore_user=None):
@@ -373,7 +491,27 @@ class RoomMemberHandler(BaseHandler):
         side-effect on the two passed sets. This allows easy accumulation of
         member lists of multiple rooms at once if required.
         """
-        members = yield self.get_room_members(room_id)
+        members = yield self.get_joined_members(room_id)
+        self._add_distribution(
+            members, localusers, remotedomains, ignore_user
+        )
+
+    @defer.inlineCallbacks
+    def fetch_co_member_distributions_into(self, user, localusers=None,
+                                           remotedomains=None):
+        """Like `fetch_room_distributions_into`, but for every room the given
+        user is joined to, ignoring the user themselves.
+
+        Once the user's rooms and their members are in the in memory index,
+        this doesn't touch the store.
+        """
+        room_ids = yield self.get_joined_rooms(user)
+        for room_id in list(room_ids):
+            members = yield self.get_joined_members(room_id)
+            self._add_distribution(members, localusers, remotedomains, user)
+
+    def _add_distribution(self, members, localusers, remotedomains,
+                          ignore_user):
         for member in members:
             if ignore_user is not None and member == ignore_user:
                 continue
@@ -620,6 +758,11 @@ class RoomMemberHandler(BaseHandler):
             membership=membership
         )
 
+        self.on_membership_changed(
+            event.room_id, self.hs.parse_userid(event.target_user_id),
+            membership
+        )
+
         # Send a PDU to all hosts who have joined the room.
         destinations = yield self.store.get_joined_hosts_for_room(
             event.room_id
@@ -718,6 +861,42 @@ class RoomMemberHandler(BaseHandler):
 class RoomListHandler(BaseHandler):
 
     @defer.inlineCallbacks
-    def get_public_room_list(self):
-        chunk = yield self.store.get_rooms(is_public=True, with_topics=True)
-        defer.returnValue({"start": "START", "end": "END", "chunk": chunk})
+    def get_public_room_list(self, pagin_config=None):
+        """Get a page of the public rooms, in order of room ID.
+
+        Args:
+            pagin_config (synapse.api.streams.PaginationConfig): The `from_tok`
+            is either START or the room ID to return the rooms after, and
+            `limit` is the most rooms to return, or 0 for all of them.
+        Returns:
+            A 2-tuple of the ETag of the room directory and the pagination API
+            results.
+        """
+        directory = yield self.store.get_room_directory()
+
+        from_tok = PaginationStream.TOK_START
+        limit = 0
+        if pagin_config:
+            from_tok = pagin_config.from_tok
+            limit = int(pagin_config.limit)
+
+        start = 0
+        if from_tok != PaginationStream.TOK_START:
+            start = bisect.bisect_right(directory.room_ids, from_tok)
+
+        end = len(directory.rooms)
+        if limit:
+            end = min(end, start + limit)
+
+        chunk = directory.rooms[start:end]
+
+        if end < len(directory.rooms):
+            end_tok = chunk[-1]["room_id"]
+        else:
+            end_tok = PaginationStream.TOK_END
+
+        defer.returnValue((directory.etag, {
+            "start": from_tok,
+            "end": end_tok,
+            "chunk": chunk,
+        }))
@@ -7,11 +7,9 @@ from twisted.web.http_headers import Headers
 from synapse.http.endpoint import matrix_endpoint
 from synapse.util.async import sleep
 
-from syutil.jsonutil import encode_canonical_json
-
 from synapse.api.errors import CodeMessageException
+from synapse.util.jsonutil import decode_json, encode_canonical_json
 
-import json
 import logging
 import urllib
 
@@ -139,7 +137,7 @@ class TwistedHttpClient(HttpClient):
 
         body = yield readBody(response)
 
-        defer.returnValue(json.loads(body))
+        defer.returnValue(decode_json(body))
 
     @defer.inlineCallbacks
     def _create_request(self, destination, method, path_bytes, param_bytes=b"",
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+from synapse.util.histogram import Histogram
+
+import re
+
+
+# The upper bounds, in milliseconds, of the buckets used to record how long
+# each route takes to handle requests.
+LATENCY_BUCKETS = [1, 5, 10, 50, 100, 500, 1000, 5000, 30000]
+
+# Characters which end the literal prefix of a regex.
+_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
+
+# Characters which make the character before them optional or repeated.
+_QUANTIFIERS = set("*+?{")
+
+
+def literal_prefix(pattern):
+    """Works out the longest string that every path matched by a regex must
+    start with.
+
+    Args:
+        pattern (str): The regex.
+    Returns:
+        str: The literal prefix, which may be empty.
+    """
+    if "|" in pattern:
+        # Alternations could start with anything.
+        return ""
+
+    if pattern.startswith("^"):
+        pattern = pattern[1:]
+
+    prefix = []
+    for char in pattern:
+        if char in _SPECIAL_CHARS:
+            if char in _QUANTIFIERS and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+
+    return "".join(prefix)
+
+
+class Route(object):
+    """A registered path regex and its callback.
+
+    Attributes:
+        pattern: The compiled regex.
+        callback (function): The function to call for matching requests.
+        latencies (Histogram): How long, in milliseconds, the callback took
+            to handle each matched request.
+    """
+
+    def __init__(self, pattern, callback, index):
+        self.pattern = pattern
+        self.callback = callback
+        self.latencies = Histogram(LATENCY_BUCKETS)
+
+        # The order the route was registered in, which decides which route
+        # wins when more than one matches.
+        self.index = index
+
+
+class _Node(object):
+    __slots__ = ("routes", "children")
+
+    def __init__(self):
+        self.routes = []
+        self.children = {}
+
+
+class PathRouter(object):
+    """Finds the first registered regex that matches a request.
+
+    Routes are kept in a trie keyed on the path segments of the literal
+    prefix of their regex, so finding a match only tries the regexes which
+    could possibly match the path, rather than every one registered for the
+    method. Regexes are still tried in the order they were registered.
+    """
+
+    def __init__(self):
+        # Maps methods to the root _Node of their trie.
+        self._tries = {}
+        self._count = 0
+
+    def add(self, method, pattern, callback):
+        """Registers a regex.
+
+        Args:
+            method (str): The HTTP method the route is for.
+            pattern: The compiled regex paths must match.
+            callback (function): The function to call for matching requests.
+        Returns:
+            Route: The new route.
+        """
+        route = Route(pattern, callback, self._count)
+        self._count += 1
+
+        node = self._tries.setdefault(method, _Node())
+        for segment in self._prefix_segments(pattern):
+            node = node.children.setdefault(segment, _Node())
+        node.routes.append(route)
+
+        return route
+
+    def match(self, method, path):
+        """Finds the first registered route which matches the given path.
+
+        Args:
+            method (str): The HTTP method of the request.
+            path (str): The path of the request.
+        Returns:
+            A 2-tuple of the Route and the regex match object, or None if no
+            route matches.
+        """
+        node = self._tries.get(method)
+        if node is None:
+            return None
+
+        candidates = list(node.routes)
+        for segment in path.split("/")[:-1]:
+            node = node.children.get(segment)
+            if node is None:
+                break
+            candidates.extend(node.routes)
+
+        candidates.sort(key=lambda route: route.index)
+
+        for route in candidates:
+            m = route.pattern.match(path)
+            if m:
+                return route, m
+
+        return None
+
+    def routes(self):
+        """Returns:
+            list: 2-tuples of method and Route for every registered route, in
+            the order they were registered.
+        """
+        result = []
+        for method, root in self._tries.items():
+            nodes = [root]
+            while nodes:
+                node = nodes.pop()
+                result.extend((method, route) for route in node.routes)
+                nodes.extend(node.children.values())
+
+        result.sort(key=lambda entry: entry[1].index)
+        return result
+
+    @staticmethod
+    def _prefix_segments(pattern):
+        """Splits the literal prefix of a regex into the complete path
+        segments it contains. The segment following the last "/" is left out,
+        since a path may have more characters in that segment.
+        """
+        if pattern.flags & re.IGNORECASE:
+            return []
+        return literal_prefix(pattern.pattern).split("/")[:-1]
@@ -1,15 +1,18 @@
 # -*- coding: utf-8 -*-
 
-from syutil.jsonutil import (
+from synapse.api.errors import cs_error, CodeMessageException
+from synapse.http.router import PathRouter
+from synapse.util import Clock
+from synapse.util.jsonutil import (
     encode_canonical_json, encode_pretty_printed_json
 )
-from synapse.api.errors import cs_error, CodeMessageException
+from synapse.util.stringutils import random_string
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, interfaces, reactor
 from twisted.web import server, resource
 from twisted.web.server import NOT_DONE_YET
+from zope.interface import implementer
 
-import collections
 import logging
 
 
@@ -48,17 +51,34 @@ class TwistedHttpServer(HttpServer, resource.Resource):
 
     isLeaf = True
 
-    _PathEntry = collections.namedtuple("_PathEntry", ["pattern", "callback"])
-
-    def __init__(self):
+    def __init__(self, clock=None):
+        """
+        Args:
+            clock (synapse.util.Clock): Used to time how long requests take.
+        """
         resource.Resource.__init__(self)
 
-        self.path_regexs = {}
+        self.clock = clock or Clock()
+        self.router = PathRouter()
+
+        # The number of requests which didn't match any registered path.
+        self.unrecognized_requests = 0
 
     def register_path(self, method, path_pattern, callback):
-        self.path_regexs.setdefault(method, []).append(
-            self._PathEntry(path_pattern, callback)
-        )
+        self.router.add(method, path_pattern, callback)
+
+    def get_route_stats(self):
+        """Returns:
+            list: A dict for each registered path, giving its method and
+            regex along with a summary of the time taken to handle the
+            requests it matched, in milliseconds.
+        """
+        stats = []
+        for method, route in self.router.routes():
+            entry = route.latencies.get_dict()
+            entry.update(method=method, path=route.pattern.pattern)
+            stats.append(entry)
+        return stats
 
     def start_listening(self, port):
         """ Registers the http server with the twisted reactor.
@@ -83,23 +103,29 @@ class TwistedHttpServer(HttpServer, resource.Resource):
             path.
         """
         try:
-            # Loop through all the registered callbacks to check if the method
-            # and path regex match
-            for path_entry in self.path_regexs.get(request.method, []):
-                m = path_entry.pattern.match(request.path)
-                if m:
-                    # We found a match! Trigger callback and then return the
-                    # returned response. We pass both the request and any
-                    # matched groups from the regex to the callback.
-                    code, response = yield path_entry.callback(
+            # Find the first registered callback whose method and path regex
+            # match
+            matched = self.router.match(request.method, request.path)
+            if matched:
+                route, m = matched
+
+                # We found a match! Trigger callback and then return the
+                # returned response. We pass both the request and any
+                # matched groups from the regex to the callback.
+                start = self.clock.time_msec()
+                try:
+                    code, response = yield route.callback(
                         request,
                         *m.groups()
                     )
+                finally:
+                    route.latencies.add(self.clock.time_msec() - start)
 
-                    self._send_response(request, code, response)
-                    return
+                self._send_response(request, code, response)
+                return
 
             # Huh. No one wanted to handle that? Fiiiiiine. Send 400.
+            self.unrecognized_requests += 1
             self._send_response(
                 request,
                 400,
@@ -122,6 +148,10 @@ class TwistedHttpServer(HttpServer, resource.Resource):
 
     def _send_response(self, request, code, response_json_object):
 
+        if isinstance(response_json_object, JsonStreamResponse):
+            response_json_object.send(request, code, send_cors=True)
+            return
+
         if not self._request_user_agent_is_curl(request):
             json_bytes = encode_canonical_json(response_json_object)
         else:
@@ -153,6 +183,14 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False):
     Returns:
         twisted.web.server.NOT_DONE_YET"""
 
+    _set_json_headers(request, code, send_cors)
+
+    request.write(json_bytes)
+    request.finish()
+    return NOT_DONE_YET
+
+
+def _set_json_headers(request, code, send_cors):
     request.setResponseCode(code)
     request.setHeader(b"Content-Type", b"application/json")
 
@@ -163,6 +201,167 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False):
         request.setHeader("Access-Control-Allow-Headers",
                           "Origin, X-Requested-With, Content-Type, Accept")
 
-    request.write(json_bytes)
-    request.finish()
-    return NOT_DONE_YET
+
+# The number of list items to encode each time the connection is ready for
+# more of a streamed response.
+STREAM_CHUNK_ITEMS = 100
+
+
+class JsonStreamResponse(object):
+    """A JSON response containing a list which is encoded and sent a chunk
+    of items at a time, as fast as the client reads them, rather than all at
+    once. Callbacks registered with `TwistedHttpServer.register_path` may
+    return one of these in place of a dict.
+
+    The bytes sent are the same as `encode_canonical_json` would give for the
+    whole object.
+
+    `items` is an iterable of the JSON serialisable items of the list, which
+    is only consumed as the response is sent. It may also produce Deferreds,
+    each of which must resolve to a list of items to send in its place, so
+    that items can be fetched from the database in batches as they're
+    needed.
+    """
+
+    def __init__(self, items, json_object=None, list_key=None):
+        """
+        Args:
+            items (iterable): The items of the list.
+            json_object (dict): The rest of the response, if the list is to be
+                sent as the value of `list_key` in an object rather than on
+                its own.
+            list_key (str): The key to send the list under.
+        """
+        self.items = items
+        self.json_object = json_object
+        self.list_key = list_key
+
+    def encode_parts(self):
+        """Returns:
+            A 2-tuple of the bytes to send before and after the items.
+        """
+        if self.json_object is None:
+            return "[", "]"
+
+        # Encode the rest of the object with a marker where the list goes,
+        # and split around it.
+        marker = "stream-" + random_string(24)
+        json_object = dict(self.json_object)
+        json_object[self.list_key] = [marker]
+
+        json_bytes = encode_canonical_json(json_object)
+        prefix, suffix = json_bytes.split('"%s"' % (marker,), 1)
+        return prefix, suffix
+
+    def send(self, request, code, send_cors=False):
+        """Starts sending the response.
+
+        Args:
+            request (twisted.web.http.Request): The http request to respond to.
+            code (int): The HTTP response code.
+            send_cors (bool): Whether to send Cross-Origin Resource Sharing
+                headers
+        """
+        _set_json_headers(request, code, send_cors)
+
+        prefix, suffix = self.encode_parts()
+        producer = _JsonStreamProducer(request, prefix, self.items, suffix)
+        request.registerProducer(producer, False)
+
+
+@implementer(interfaces.IPullProducer)
+class _JsonStreamProducer(object):
+    """Writes a JsonStreamResponse to a request. The request asks for more
+    by calling `resumeProducing` whenever it has sent what we last wrote.
+    """
+
+    def __init__(self, request, prefix, items, suffix):
+        self.request = request
+        self.suffix = suffix
+
+        self._items = iter(items)
+        self._pending = []
+        self._next_chunk = [prefix]
+        self._separator = ""
+
+        self._waiting = False
+        self._finished = False
+
+    def resumeProducing(self):
+        if self._waiting or self._finished:
+            return
+
+        chunk = self._next_chunk
+        self._next_chunk = []
+
+        count = 0
+        while count < STREAM_CHUNK_ITEMS:
+            try:
+                if self._pending:
+                    item = self._pending.pop()
+                else:
+                    item = next(self._items)
+
+                if not isinstance(item, defer.Deferred):
+                    encoded = encode_canonical_json(item)
+            except StopIteration:
+                chunk.append(self.suffix)
+                self._write("".join(chunk))
+                self._finish()
+                return
+            except Exception:
+                logger.exception("Failed to stream response")
+                self._fail()
+                return
+
+            if isinstance(item, defer.Deferred):
+                # Send what we have so far while we wait for the batch.
+                if chunk:
+                    self._write("".join(chunk))
+                self._waiting = True
+                item.addCallbacks(self._on_batch, self._on_batch_failed)
+                return
+
+            chunk.append(self._separator)
+            chunk.append(encoded)
+            self._separator = ","
+            count += 1
+
+        self._write("".join(chunk))
+
+    def stopProducing(self):
+        # The connection has gone away.
+        self._finished = True
+
+    def _on_batch(self, batch):
+        self._waiting = False
+        self._pending = list(reversed(batch))
+        self.resumeProducing()
+
+    def _on_batch_failed(self, failure):
+        self._waiting = False
+        logger.error(
+            "Failed to fetch items for streamed response: %s",
+            failure.getTraceback()
+        )
+        self._fail()
+
+    def _write(self, data):
+        if not self._finished:
+            self.request.write(data)
+
+    def _finish(self):
+        if not self._finished:
+            self._finished = True
+            self.request.unregisterProducer()
+            self.request.finish()
+
+    def _fail(self):
+        if self._finished:
+            return
+        # We've already sent the status code, so the best we can do is cut
+        # the response short so that the client can't mistake it for a
+        # complete one.
+        self._finished = True
+        self.request.unregisterProducer()
+        self.request.loseConnection()
@@ -4,6 +4,7 @@ from twisted.internet import defer
 
 from synapse.types import RoomName
 from base import RestServlet, InvalidHttpRequestError
+from synapse.util.jsonutil import decode_json
 
 
 class ClientDirectoryServer(RestServlet):
@@ -15,7 +16,7 @@ class ClientDirectoryServer(RestServlet):
 
     def on_PUT(self, request, room_name):
         # TODO(erikj): Exceptions
-        content = json.loads(request.content.read())
+        content = decode_json(request.content.read())
 
         room_name_obj = RoomName.from_string(room_name, self.hs)
 
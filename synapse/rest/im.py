@@ -2,6 +2,7 @@
 from twisted.internet import defer
 
 from synapse.api.streams import PaginationConfig
+from synapse.http.server import JsonStreamResponse
 from base import RestServlet, client_path_pattern
 
 
@@ -19,7 +20,9 @@ class ImSyncRestServlet(RestServlet):
             pagin_config=pagination_config,
             feedback=with_feedback)
 
-        defer.returnValue((200, content))
+        # The snapshot can be large, so encode it a room at a time as it's
+        # sent rather than all at once.
+        defer.returnValue((200, JsonStreamResponse(content)))
 
 
 def register_servlets(hs, http_server):
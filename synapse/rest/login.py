@@ -3,8 +3,8 @@ from twisted.internet import defer
 
 from synapse.api.errors import SynapseError
 from base import RestServlet, client_path_pattern
+from synapse.util.jsonutil import decode_json
 
-import json
 
 
 class LoginRestServlet(RestServlet):
@@ -46,7 +46,7 @@ class LoginFallbackRestServlet(RestServlet):
 
 def _parse_json(request):
     try:
-        content = json.loads(request.content.read())
+        content = decode_json(request.content.read())
         if type(content) != dict:
             raise SynapseError(400, "Content must be a JSON object.")
         return content
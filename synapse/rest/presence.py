@@ -4,8 +4,8 @@
 from twisted.internet import defer
 
 from base import RestServlet, client_path_pattern
+from synapse.util.jsonutil import decode_json
 
-import json
 import logging
 
 
@@ -32,7 +32,7 @@ class PresenceStatusRestServlet(RestServlet):
 
         state = {}
         try:
-            content = json.loads(request.content.read())
+            content = decode_json(request.content.read())
 
             state["state"] = content.pop("state")
 
@@ -89,7 +89,7 @@ class PresenceListRestServlet(RestServlet):
                 400, "Cannot modify another user's presence list"))
 
         try:
-            content = json.loads(request.content.read())
+            content = decode_json(request.content.read())
         except:
             logger.exception("JSON parse error")
             defer.returnValue((400, "Unable to parse content"))
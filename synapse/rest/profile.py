@@ -3,8 +3,8 @@
 from twisted.internet import defer
 
 from base import RestServlet, client_path_pattern
+from synapse.util.jsonutil import decode_json
 
-import json
 
 
 class ProfileDisplaynameRestServlet(RestServlet):
@@ -27,7 +27,7 @@ class ProfileDisplaynameRestServlet(RestServlet):
         user = self.hs.parse_userid(user_id)
 
         try:
-            content = json.loads(request.content.read())
+            content = decode_json(request.content.read())
             new_name = content["displayname"]
         except:
             defer.returnValue((400, "Unable to parse name"))
@@ -61,7 +61,7 @@ class ProfileAvatarURLRestServlet(RestServlet):
         user = self.hs.parse_userid(user_id)
 
         try:
-            content = json.loads(request.content.read())
+            content = decode_json(request.content.read())
             new_name = content["avatar_url"]
         except:
             defer.returnValue((400, "Unable to parse name"))
@@ -2,6 +2,7 @@
 """This module contains REST servlets to do with public paths: /public"""
 from twisted.internet import defer
 
+from synapse.api.streams import PaginationConfig
 from base import RestServlet, client_path_pattern
 
 
@@ -10,8 +11,16 @@ class PublicRoomListRestServlet(RestServlet):
 
     @defer.inlineCallbacks
     def on_GET(self, request):
+        pagination_config = PaginationConfig.from_request(request)
         handler = self.handlers.room_list_handler
-        data = yield handler.get_public_room_list()
+        etag, data = yield handler.get_public_room_list(
+            pagin_config=pagination_config
+        )
+
+        request.setHeader("ETag", etag)
+        if request.getHeader("If-None-Match") == etag:
+            defer.returnValue((304, {}))
+
         defer.returnValue((200, data))
 
 
@@ -3,8 +3,8 @@
 from twisted.internet import defer
 
 from base import RestServlet, InvalidHttpRequestError, client_path_pattern
+from synapse.util.jsonutil import decode_json
 
-import json
 import urllib
 
 
@@ -16,7 +16,7 @@ class RegisterRestServlet(RestServlet):
         desired_user_id = None
         password = None
         try:
-            register_json = json.loads(request.content.read())
+            register_json = decode_json(request.content.read())
             if "password" in register_json:
                 password = register_json["password"]
 
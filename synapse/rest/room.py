@@ -8,8 +8,8 @@ from synapse.api.events.room import (RoomTopicEvent, MessageEvent,
                                      RoomMemberEvent, FeedbackEvent)
 from synapse.api.constants import Feedback, Membership
 from synapse.api.streams import PaginationConfig
+from synapse.util.jsonutil import decode_json
 
-import json
 import urllib
 
 
@@ -77,7 +77,7 @@ class RoomCreateRestServlet(RestServlet):
 
     def get_room_config(self, request):
         try:
-            user_supplied_config = json.loads(request.content.read())
+            user_supplied_config = decode_json(request.content.read())
             if "visibility" not in user_supplied_config:
                 # default visibility
                 user_supplied_config["visibility"] = "public"
@@ -109,7 +109,7 @@ class RoomTopicRestServlet(RestServlet):
 
         if not data:
             defer.returnValue((404, cs_error("Topic not found.")))
-        defer.returnValue((200, json.loads(data.content)))
+        defer.returnValue((200, decode_json(data.content)))
 
     @defer.inlineCallbacks
     def on_PUT(self, request, room_id):
@@ -148,7 +148,7 @@ class RoomMemberRestServlet(RestServlet):
                                                user.to_string())
         if not member:
             defer.returnValue((404, cs_error("Member not found.")))
-        defer.returnValue((200, json.loads(member.content)))
+        defer.returnValue((200, decode_json(member.content)))
 
     @defer.inlineCallbacks
     def on_DELETE(self, request, roomid, target_user_id):
@@ -218,7 +218,7 @@ class MessageRestServlet(RestServlet):
         if not msg:
             defer.returnValue((404, cs_error("Message not found.")))
 
-        defer.returnValue((200, json.loads(msg.content)))
+        defer.returnValue((200, decode_json(msg.content)))
 
     @defer.inlineCallbacks
     def on_PUT(self, request, room_id, sender_id, msg_id):
@@ -274,7 +274,7 @@ class FeedbackRestServlet(RestServlet):
         if not feedback:
             defer.returnValue((404, cs_error("Feedback not found.")))
 
-        defer.returnValue((200, json.loads(feedback.content)))
+        defer.returnValue((200, decode_json(feedback.content)))
 
     @defer.inlineCallbacks
     def on_PUT(self, request, room_id, sender_id, msg_id, fb_sender_id,
@@ -340,7 +340,7 @@ class RoomMessageListRestServlet(RestServlet):
 
 def _parse_json(request):
     try:
-        content = json.loads(request.content.read())
+        content = decode_json(request.content.read())
         if type(content) != dict:
             raise SynapseError(400, "Content must be a JSON object.")
         return content
@@ -18,6 +18,7 @@ from synapse.types import UserID
 from synapse.util import Clock
 from synapse.util.distributor import Distributor
 from synapse.util.lockutils import LockManager
+from synapse.util.password import PasswordHasher
 
 
 class BaseHomeServer(object):
@@ -56,8 +57,32 @@ class BaseHomeServer(object):
         'room_lock_manager',
         'notifier',
         'distributor',
+        'password_hasher',
     ]
 
+    # Settings which may be overridden by passing them as keyword arguments
+    # to the constructor.
+
+    # The largest federation transaction, in bytes, that we will accept.
+    federation_max_body_size = 10 * 1024 * 1024
+
+    # Federation transactions bigger than this many bytes are decoded in a
+    # thread, so that decoding them doesn't hold up the reactor.
+    federation_threaded_decode_size = 512 * 1024
+
+    # How long, in seconds, federation EDUs which may be merged, such as
+    # presence updates, are held back before being sent.
+    federation_edu_coalesce_window = 0.1
+
+    # The number of threads passwords are hashed on, and how many requests
+    # may wait for one before further requests are rejected.
+    password_hash_threads = 4
+    password_hash_queue_size = 50
+
+    # How often, in seconds, changes to users' presence state are written
+    # to the database.
+    presence_flush_interval = 5
+
     def __init__(self, hostname, **kwargs):
         """
         Args:
@@ -152,11 +177,18 @@ class HomeServer(BaseHomeServer):
         return StateHandler(self)
 
     def build_room_lock_manager(self):
-        return LockManager()
+        return LockManager(name="Room lock", clock=self.get_clock())
 
     def build_distributor(self):
         return Distributor()
 
+    def build_password_hasher(self):
+        return PasswordHasher(
+            clock=self.get_clock(),
+            threads=self.password_hash_threads,
+            queue_size=self.password_hash_queue_size,
+        )
+
     def register_servlets(self):
         """Simply building the ServletFactory is sufficient to have it
         register."""
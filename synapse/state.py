@@ -174,16 +174,43 @@ class StateHandler(object):
                 key=lambda x: x.depth
             )
 
-            yield self._replication.get_pdu(
-                destination=missing_prev.origin,
-                pdu_origin=missing_prev.prev_state_origin,
-                pdu_id=missing_prev.prev_state_id,
-                outlier=True
+            # The branches can't meet above the shallower of the two, so we
+            # ask for everything back to there in one go.
+            min_depth = min(
+                int(new_branch[-1].depth), int(current_branch[-1].depth)
             )
 
+            yield self._get_missing_state(missing_prev, min_depth)
+
             updated_current = yield self._handle_new_state(new_pdu)
             defer.returnValue(updated_current)
 
+    @defer.inlineCallbacks
+    def _get_missing_state(self, missing_prev, min_depth):
+        """Fetches the previous state of `missing_prev`, and as much of its
+        chain of previous state back to `min_depth` as the remote server will
+        give us.
+        """
+        try:
+            pdus = yield self._replication.get_state_ancestors(
+                destination=missing_prev.origin,
+                pdu_origin=missing_prev.prev_state_origin,
+                pdu_id=missing_prev.prev_state_id,
+                min_depth=min_depth
+            )
+            if pdus:
+                return
+        except Exception:
+            # The remote server may not support fetching state ancestors.
+            logger.exception("Failed to get state ancestors")
+
+        yield self._replication.get_pdu(
+            destination=missing_prev.origin,
+            pdu_origin=missing_prev.prev_state_origin,
+            pdu_id=missing_prev.prev_state_id,
+            outlier=True
+        )
+
     def _do_power_level_conflict_res(self, new_branch, current_branch):
         max_power_new = max(
             new_branch[:-1],
@@ -16,8 +16,8 @@ from .roomdata import RoomDataStore
 from .stream import StreamStore
 from .pdu import StatePduStore, PduStore
 from .transactions import TransactionStore
+from synapse.util.jsonutil import encode_json
 
-import json
 import os
 
 
@@ -36,7 +36,7 @@ class DataStore(RoomDataStore, RoomMemberStore, MessageStore, RoomStore,
                 user_id=event.user_id,
                 room_id=event.room_id,
                 msg_id=event.msg_id,
-                content=json.dumps(event.content)
+                content=encode_json(event.content)
             )
         elif event.type == RoomMemberEvent.TYPE:
             return self.store_room_member(
@@ -53,14 +53,14 @@ class DataStore(RoomDataStore, RoomMemberStore, MessageStore, RoomStore,
                 msg_sender_id=event.msg_sender_id,
                 fb_sender_id=event.user_id,
                 fb_type=event.feedback_type,
-                content=json.dumps(event.content)
+                content=encode_json(event.content)
             )
         elif event.type == RoomTopicEvent.TYPE:
             return self.store_room_data(
                 room_id=event.room_id,
                 etype=event.type,
                 state_key=event.state_key,
-                content=json.dumps(event.content)
+                content=encode_json(event.content)
             )
         elif event.type == RoomConfigEvent.TYPE:
             if "visibility" in event.content:
@@ -3,17 +3,217 @@ import logging
 from twisted.internet import defer
 
 from synapse.api.errors import StoreError
+from synapse.util.lrucache import LruCache
 
 import collections
+import copy
 
 logger = logging.getLogger(__name__)
 
 
+# The maximum number of decoded events to keep in memory.
+EVENT_CACHE_SIZE = 10000
+
+# How long, in seconds, to wait for more inserts to arrive before committing
+# a batch of them.
+INSERT_BATCH_WINDOW = 0.005
+
+
+class _InteractionBatcher(object):
+    """Runs database interactions in batches, committing each batch as a
+    single database transaction.
+
+    Interactions are held back for up to `window` seconds, and for as long as
+    the previous batch is still being committed, so that a burst of writes
+    costs one commit rather than one each.
+
+    If a batch fails it is rolled back and each of its interactions is run
+    again on its own, so that one bad write doesn't fail the others. This
+    means the functions given must not have side effects outside of the
+    database.
+
+    Attributes:
+        batches (int): The number of batches committed so far.
+        interactions (int): The number of interactions in those batches.
+    """
+
+    def __init__(self, db_pool, clock, window):
+        self._db_pool = db_pool
+        self._clock = clock
+        self._window = window
+
+        self._queue = []
+        self._timer = None
+        self._in_flight = False
+
+        self.batches = 0
+        self.interactions = 0
+
+    def run_interaction(self, func, *args):
+        """Queues `func(txn, *args)` to be run in the next batch.
+
+        Returns:
+            Deferred: Resolves with the result of `func`.
+        """
+        d = defer.Deferred()
+        self._queue.append((func, args, d))
+
+        if not self._in_flight and not self._timer:
+            self._timer = self._clock.call_later(self._window, self._flush)
+
+        return d
+
+    def _flush(self):
+        self._timer = None
+
+        batch = self._queue
+        self._queue = []
+
+        self._in_flight = True
+        self.batches += 1
+        self.interactions += len(batch)
+
+        def on_success(results):
+            for (_, _, d), result in zip(batch, results):
+                d.callback(result)
+
+        def on_failure(failure):
+            logger.warn(
+                "Batch of %d interactions failed, retrying individually: %s",
+                len(batch), failure.getErrorMessage()
+            )
+            for func, args, d in batch:
+                self._db_pool.runInteraction(func, *args).chainDeferred(d)
+
+        def on_done(_):
+            self._in_flight = False
+
+            # Anything that arrived while we were busy has already waited
+            # long enough.
+            if self._queue:
+                self._flush()
+
+        d = self._db_pool.runInteraction(self._run_batch, batch)
+        d.addCallbacks(on_success, on_failure)
+        d.addBoth(on_done)
+
+    @staticmethod
+    def _run_batch(txn, batch):
+        return [func(txn, *args) for func, args, _ in batch]
+
+
+class StreamIdGenerator(object):
+    """Allocates the ids of new rows in a table whose ids are used as stream
+    positions, so that the current position can be found without running a
+    `SELECT MAX(id)` each time.
+
+    The maximum id is loaded from the table the first time it is needed, and
+    then advanced in memory as ids are handed out. Since an id is handed out
+    before its row is written, the position reported always stays below any
+    id whose row hasn't yet been committed. Otherwise someone could be told
+    about a position, read up to it before that row is visible, and so never
+    see the row.
+
+    Must only be used from the reactor thread.
+    """
+
+    def __init__(self, store, table):
+        """
+        Args:
+            store (SQLBaseStore): The store to load the maximum id with.
+            table (str): The name of the table.
+        """
+        self._store = store
+        self._table = table
+
+        # The largest id handed out so far, or None until it's been loaded.
+        self._current = None
+
+        # Deferreds waiting for the maximum id to be loaded, or None if it
+        # isn't being loaded.
+        self._waiting_for_load = None
+
+        # The ids handed out whose rows haven't been committed yet, in the
+        # order they were handed out.
+        self._unfinished_ids = []
+
+    def get_next(self):
+        """Allocates a new id. `finish` must be called with the id once the
+        row has been written, whether or not that succeeded.
+
+        Returns:
+            Deferred: Resolves to the id.
+        """
+        def allocate(_):
+            self._current += 1
+            self._unfinished_ids.append(self._current)
+            return self._current
+
+        return self._load().addCallback(allocate)
+
+    def finish(self, stream_id):
+        """Marks the row with the given id as having been committed, or as
+        having failed to be written.
+        """
+        self._unfinished_ids.remove(stream_id)
+
+    def get_max_token(self):
+        """Returns:
+            Deferred: Resolves to the largest id below which all rows have
+            been committed.
+        """
+        def max_token(_):
+            if self._unfinished_ids:
+                return self._unfinished_ids[0] - 1
+            return self._current
+
+        return self._load().addCallback(max_token)
+
+    def _load(self):
+        if self._current is not None:
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+
+        if self._waiting_for_load is not None:
+            self._waiting_for_load.append(d)
+        else:
+            self._waiting_for_load = [d]
+
+            def on_load(max_id):
+                self._current = max_id
+
+                waiting = self._waiting_for_load
+                self._waiting_for_load = None
+                for w in waiting:
+                    w.callback(None)
+
+            def on_failure(failure):
+                waiting = self._waiting_for_load
+                self._waiting_for_load = None
+                for w in waiting:
+                    w.errback(failure)
+
+            self._store._simple_max_id(self._table).addCallbacks(
+                on_load, on_failure
+            )
+
+        return d
+
+
 class SQLBaseStore(object):
 
     def __init__(self, hs):
         self._db_pool = hs.get_db_pool()
 
+        # Maps (table name, row id) to the event dict for that row. Event rows
+        # are never updated once written, so entries never need invalidating.
+        self._event_cache = LruCache(EVENT_CACHE_SIZE)
+
+        self._insert_batcher = _InteractionBatcher(
+            self._db_pool, hs.get_clock(), INSERT_BATCH_WINDOW
+        )
+
     def cursor_to_dict(self, cursor):
         """Converts a SQL cursor into an list of dicts.
 
@@ -48,6 +248,25 @@ class SQLBaseStore(object):
             return decoder(cursor)
         return self._db_pool.runInteraction(interaction)
 
+    def _get_event_dict(self, table, entry):
+        """Converts a row into an event dict, reusing an earlier conversion
+        of the same row if one is cached.
+
+        Args:
+            table : The Table the row was read from.
+            entry : The decoded row, which must have an `id` and `as_event`.
+        Returns:
+            dict: The event dict. The caller is free to modify it.
+        """
+        key = (table.table_name, entry.id)
+        event = self._event_cache.get(key)
+        if event is None:
+            event = entry.as_event(self.event_factory).get_dict()
+            self._event_cache.set(key, event)
+
+        # The nested content must be copied too, since callers may change it.
+        return copy.deepcopy(event)
+
     # "Simple" SQL API methods that operate on a single table with no JOINs,
     # no complex WHERE clauses, just a dict of values for columns.
 
@@ -57,17 +276,56 @@ class SQLBaseStore(object):
         Args:
             table : string giving the table name
             values : dict of new column names and values for them
+        Returns:
+            Deferred: Resolves with the row id of the new row.
         """
+        return self._db_pool.runInteraction(
+            self._simple_insert_txn, table, values
+        )
+
+    @defer.inlineCallbacks
+    def _simple_insert_stream_batched(self, id_gen, table, values,
+                                      after_insert=None):
+        """Executes an INSERT query on a table whose ids are stream positions,
+        committing it along with any other inserts made at around the same
+        time. The id is allocated by the given generator.
+
+        Args:
+            id_gen (StreamIdGenerator): The generator for the table.
+            table : string giving the table name
+            values : dict of new column names and values for them
+            after_insert (function): If given, called with the txn and the
+                values inserted, including the new id, after the row has been
+                inserted, to make other changes in the same transaction.
+        Returns:
+            Deferred: Resolves with the row id of the new row.
+        """
+        stream_id = yield id_gen.get_next()
+
+        values = dict(values)
+        values["id"] = stream_id
+
+        def insert_txn(txn):
+            self._simple_insert_txn(txn, table, values)
+            if after_insert:
+                after_insert(txn, values)
+
+        try:
+            yield self._insert_batcher.run_interaction(insert_txn)
+        finally:
+            id_gen.finish(stream_id)
+
+        defer.returnValue(stream_id)
+
+    def _simple_insert_txn(self, txn, table, values):
         sql = "INSERT INTO %s (%s) VALUES(%s)" % (
             table,
             ", ".join(k for k in values),
             ", ".join("?" for k in values)
         )
 
-        def func(txn):
-            txn.execute(sql, values.values())
-            return txn.lastrowid
-        return self._db_pool.runInteraction(func)
+        txn.execute(sql, values.values())
+        return txn.lastrowid
 
     def _simple_select_one(self, table, keyvalues, retcols,
                            allow_none=False):
@@ -1,23 +1,31 @@
 # -*- coding: utf-8 -*-
-from ._base import SQLBaseStore, Table
+from ._base import SQLBaseStore, StreamIdGenerator, Table
 from synapse.api.events.room import FeedbackEvent
+from synapse.util.jsonutil import decode_json
 
 import collections
-import json
 
 
 class FeedbackStore(SQLBaseStore):
 
+    def __init__(self, hs):
+        super(FeedbackStore, self).__init__(hs)
+        self._feedback_id_gen = StreamIdGenerator(
+            self, FeedbackTable.table_name
+        )
+
     def store_feedback(self, room_id, msg_id, msg_sender_id,
                        fb_sender_id, fb_type, content):
-        return self._simple_insert(FeedbackTable.table_name, dict(
-            room_id=room_id,
-            msg_id=msg_id,
-            msg_sender_id=msg_sender_id,
-            fb_sender_id=fb_sender_id,
-            fb_type=fb_type,
-            content=content,
-        ))
+        return self._simple_insert_stream_batched(
+            self._feedback_id_gen, FeedbackTable.table_name, dict(
+                room_id=room_id,
+                msg_id=msg_id,
+                msg_sender_id=msg_sender_id,
+                fb_sender_id=fb_sender_id,
+                fb_type=fb_type,
+                content=content,
+            )
+        )
 
     def get_feedback(self, room_id=None, msg_id=None, msg_sender_id=None,
                      fb_sender_id=None, fb_type=None):
@@ -31,7 +39,7 @@ class FeedbackStore(SQLBaseStore):
         )
 
     def get_max_feedback_id(self):
-        return self._simple_max_id(FeedbackTable.table_name)
+        return self._feedback_id_gen.get_max_token()
 
 
 class FeedbackTable(Table):
@@ -57,5 +65,5 @@ class FeedbackTable(Table):
                 msg_sender_id=self.msg_sender_id,
                 user_id=self.fb_sender_id,
                 feedback_type=self.feedback_type,
-                content=json.loads(self.content),
+                content=decode_json(self.content),
             )
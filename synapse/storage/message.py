@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -*-
-from ._base import SQLBaseStore, Table
+from ._base import SQLBaseStore, StreamIdGenerator, Table
 from synapse.api.events.room import MessageEvent
+from synapse.util.jsonutil import decode_json
 
 import collections
-import json
 
 
 class MessageStore(SQLBaseStore):
 
+    def __init__(self, hs):
+        super(MessageStore, self).__init__(hs)
+        self._message_id_gen = StreamIdGenerator(
+            self, MessagesTable.table_name
+        )
+
     def get_message(self, user_id, room_id, msg_id):
         """Get a message from the store.
 
@@ -33,15 +39,17 @@ class MessageStore(SQLBaseStore):
             msg_id (str): The unique ID for this user/room combo.
             content (str): The content of the message (JSON)
         """
-        return self._simple_insert(MessagesTable.table_name, dict(
-            user_id=user_id,
-            room_id=room_id,
-            msg_id=msg_id,
-            content=content,
-        ))
+        return self._simple_insert_stream_batched(
+            self._message_id_gen, MessagesTable.table_name, dict(
+                user_id=user_id,
+                room_id=room_id,
+                msg_id=msg_id,
+                content=content,
+            )
+        )
 
     def get_max_message_id(self):
-        return self._simple_max_id(MessagesTable.table_name)
+        return self._message_id_gen.get_max_token()
 
 
 class MessagesTable(Table):
@@ -63,5 +71,5 @@ class MessagesTable(Table):
                 room_id=self.room_id,
                 user_id=self.user_id,
                 msg_id=self.msg_id,
-                content=json.loads(self.content),
+                content=decode_json(self.content),
             )
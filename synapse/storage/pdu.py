@@ -1,6 +1,9 @@
+from twisted.internet import defer
+
 from ._base import SQLBaseStore, Table, JoinHelper
 
 from synapse.util.logutils import log_function
+from synapse.util.lrucache import LruCache
 
 from collections import namedtuple
 
@@ -13,6 +16,19 @@ class PduStore(SQLBaseStore):
     """A collection of queries for handling PDUs.
     """
 
+    def __init__(self, hs):
+        super(PduStore, self).__init__(hs)
+
+        # Maps context to a dict of (pdu_id, origin) -> depth for each of the
+        # context's forward extremities. A context is loaded from the database
+        # the first time it is asked for, and from then on is kept up to date
+        # as PDUs are persisted.
+        #
+        # This is only ever written to from within database interactions, and
+        # each context's dict is replaced rather than modified, so it is safe
+        # to read from the reactor thread.
+        self._forward_extremities = {}
+
     def get_pdu(self, pdu_id, origin):
         """Given a pdu_id and origin, get a PDU.
 
@@ -66,48 +82,20 @@ class PduStore(SQLBaseStore):
 
         return results
 
-    def get_current_state_for_context(self, context):
-        """Get a list of PDUs that represent the current state for a given
-        context
-
-        Args:
-            context (str)
-
-        Returns:
-            list: A list of PduTuples
-        """
-
-        return self._db_pool.runInteraction(
-            self._get_current_state_for_context,
-            context
-        )
-
-    def _get_current_state_for_context(self, txn, context):
-        query = (
-            "SELECT pdu_id, origin FROM %s WHERE context = ?"
-            % CurrentStateTable.table_name
-        )
-
-        logger.debug("get_current_state %s, Args=%s", query, context)
-        txn.execute(query, (context,))
-
-        res = txn.fetchall()
-
-        logger.debug("get_current_state %d results", len(res))
-
-        return self._get_pdu_tuples(txn, res)
-
     def persist_pdu(self, prev_pdus, **cols):
-        """Inserts a (non-state) PDU into the database.
+        """Inserts a (non-state) PDU into the database, along with its edges,
+        and updates the context's extremities and minimum depth.
 
         Args:
             txn,
             prev_pdus (list)
             **cols: The columns to insert into the PdusTable.
         """
-        return self._db_pool.runInteraction(
+        d = self._db_pool.runInteraction(
             self._persist_pdu, prev_pdus, cols
         )
+        d.addErrback(self._invalidate_forward_extremities, cols["context"])
+        return d
 
     def _persist_pdu(self, txn, prev_pdus, cols):
         entry = PdusTable.EntryType(
@@ -118,9 +106,11 @@ class PduStore(SQLBaseStore):
 
         self._handle_prev_pdus(
             txn, entry.outlier, entry.pdu_id, entry.origin,
-            prev_pdus, entry.context
+            prev_pdus, entry.context, entry.depth
         )
 
+        self._update_min_depth_for_context(txn, entry.context, entry.depth)
+
     def mark_pdu_as_processed(self, pdu_id, pdu_origin):
         """Mark a received PDU as processed.
 
@@ -135,23 +125,50 @@ class PduStore(SQLBaseStore):
         )
 
     def _mark_as_processed(self, txn, pdu_id, pdu_origin):
-        txn.execute("UPDATE %s SET have_processed = 1" % PdusTable.table_name)
+        txn.execute(
+            "UPDATE %s SET have_processed = 1 "
+            "WHERE pdu_id = ? AND origin = ?" % PdusTable.table_name,
+            (pdu_id, pdu_origin)
+        )
 
-    def get_all_pdus_from_context(self, context):
-        """Get a list of all PDUs for a given context."""
+    def get_pdus_from_context_after(self, context, position, limit):
+        """Get a batch of the PDUs in a given context, in the order we stored
+        them, so that every PDU in a context can be worked through without
+        loading them all at once.
+
+        Args:
+            context (str)
+            position (int): Where the previous batch ended, or 0 to start from
+                the beginning.
+            limit (int): The most PDUs to return.
+
+        Returns:
+            Deferred: Results in a 2-tuple of the position to fetch the next
+            batch from and a list of PduTuples. There are no more PDUs once
+            fewer than `limit` are returned.
+        """
         return self._db_pool.runInteraction(
-            self._get_all_pdus_from_context, context,
+            self._get_pdus_from_context_after, context, position, limit
         )
 
-    def _get_all_pdus_from_context(self, txn, context):
+    def _get_pdus_from_context_after(self, txn, context, position, limit):
         query = (
-            "SELECT pdu_id, origin FROM %s "
-            "WHERE context = ?"
+            "SELECT rowid, pdu_id, origin FROM %s "
+            "WHERE context = ? AND rowid > ? "
+            "ORDER BY rowid ASC LIMIT ?"
         ) % PdusTable.table_name
 
-        txn.execute(query, (context,))
+        txn.execute(query, (context, position, limit))
+        rows = txn.fetchall()
+
+        if rows:
+            position = rows[-1][0]
+
+        pdus = self._get_pdu_tuples(
+            txn, [(pdu_id, origin) for _, pdu_id, origin in rows]
+        )
 
-        return self._get_pdu_tuples(txn, txn.fetchall())
+        return position, pdus
 
     def get_pagination(self, context, pdu_list, limit):
         """Get a list of Pdus for a given topic that occured before (and
@@ -172,8 +189,8 @@ class PduStore(SQLBaseStore):
 
     def _get_paginate(self, txn, context, pdu_list, limit):
         logger.debug(
-            "paginate: %s, %s, %s",
-            context, repr(pdu_list), limit
+            "paginate: %s, %r, %s",
+            context, pdu_list, limit
         )
 
         # We seed the pdu_results with the things from the pdu_list.
@@ -277,7 +294,16 @@ class PduStore(SQLBaseStore):
         Args:
             txn
             context
+
+        Returns:
+            list: A list of (pdu_id, origin, depth) tuples.
         """
+        extremities = self._forward_extremities.get(context)
+        if extremities is not None:
+            return defer.succeed(
+                [(i, o, d) for (i, o), d in extremities.items()]
+            )
+
         return self._db_pool.runInteraction(
             self._get_latest_pdus_in_context, context
         )
@@ -302,8 +328,20 @@ class PduStore(SQLBaseStore):
 
         results = txn.fetchall()
 
+        self._forward_extremities[context] = {
+            (row[0], row[1]): row[2] for row in results
+        }
+
         return [(row[0], row[1], row[2]) for row in results]
 
+    def _invalidate_forward_extremities(self, failure, context):
+        """Forgets the cached forward extremities of a context after a failed
+        interaction, since they may have been updated for a transaction that
+        was then rolled back.
+        """
+        self._forward_extremities.pop(context, None)
+        return failure
+
     def get_oldest_pdus_in_context(self, context):
         """Get a list of Pdus that we paginated beyond yet (and haven't seen).
         This list is used when we want to paginate backwards and is the list we
@@ -406,10 +444,9 @@ class PduStore(SQLBaseStore):
         # FINE THEN. It's probably old.
         return False
 
-    @staticmethod
     @log_function
-    def _handle_prev_pdus(txn, outlier, pdu_id, origin, prev_pdus,
-                          context):
+    def _handle_prev_pdus(self, txn, outlier, pdu_id, origin, prev_pdus,
+                          context, depth):
         txn.executemany(
             PduEdgesTable.insert_statement(),
             [(pdu_id, origin, p[0], p[1], context) for p in prev_pdus]
@@ -441,37 +478,80 @@ class PduStore(SQLBaseStore):
             logger.debug("query: %s", query)
 
             txn.execute(query, (pdu_id, origin, context, pdu_id, origin))
-
-            # Insert all the prev_pdus as a backwards thing, they'll get
-            # deleted in a second if they're incorrect anyway.
-            txn.executemany(
-                PduBackwardExtremitiesTable.insert_statement(),
-                [(i, o, context) for i, o in prev_pdus]
-            )
-
-            # Also delete from the backwards extremities table all ones that
-            # reference pdus that we have already seen
+            is_forward_extremity = txn.rowcount > 0
+
+            extremities = self._forward_extremities.get(context)
+            if extremities is not None:
+                extremities = dict(extremities)
+                for prev_pdu in prev_pdus:
+                    extremities.pop(tuple(prev_pdu), None)
+                if is_forward_extremity:
+                    extremities[(pdu_id, origin)] = depth
+                self._forward_extremities[context] = extremities
+
+            # Insert as backwards extremities those prev_pdus that we haven't
+            # seen (other than as outliers).
             query = (
-                "DELETE FROM %(pdu_back)s WHERE EXISTS ("
-                "SELECT 1 FROM %(pdus)s AS pdus "
-                "WHERE "
-                "%(pdu_back)s.pdu_id = pdus.pdu_id "
-                "AND %(pdu_back)s.origin = pdus.origin "
-                "AND not pdus.outlier "
+                "INSERT INTO %(back)s (pdu_id, origin, context) "
+                "SELECT ?, ?, ? WHERE NOT EXISTS ("
+                "SELECT 1 FROM %(pdus)s WHERE "
+                "pdu_id = ? AND origin = ? AND NOT outlier"
                 ")"
             ) % {
-                "pdu_back": PduBackwardExtremitiesTable.table_name,
+                "back": PduBackwardExtremitiesTable.table_name,
                 "pdus": PdusTable.table_name,
             }
-            txn.execute(query)
+            txn.executemany(
+                query,
+                [(i, o, context, i, o) for i, o in prev_pdus]
+            )
+
+            # Now that we've seen this pdu it is no longer a backwards
+            # extremity. These are the only rows whose status can have changed,
+            # so there is no need to look at the rest of the table.
+            query = (
+                "DELETE FROM %s "
+                "WHERE pdu_id = ? AND origin = ? AND context = ?"
+                % PduBackwardExtremitiesTable.table_name
+            )
+            txn.execute(query, (pdu_id, origin, context))
+
+
+# The number of (context, pdu_type, state_key) entries to cache the current
+# state of.
+CURRENT_STATE_CACHE_SIZE = 50000
+
+# Marks a cache miss, as None is a valid cached value.
+_NOT_CACHED = object()
 
 
 class StatePduStore(SQLBaseStore):
     """A collection of queries for handling state PDUs.
     """
 
+    def __init__(self, hs):
+        super(StatePduStore, self).__init__(hs)
+
+        # Maps (context, pdu_type, state_key) to the PduEntry of the current
+        # state, or None if there isn't any. Entries are filled in when read
+        # and dropped when the current state changes.
+        #
+        # This is only ever used from within database interactions, so needs
+        # no locking.
+        self._current_state_cache = LruCache(CURRENT_STATE_CACHE_SIZE)
+
+        # Maps context to the list of PduTuples returned by
+        # `get_current_state_for_context`. Entries are dropped when the
+        # context's current state changes.
+        #
+        # This is only ever written to from within database interactions, and
+        # the lists are never modified, so it is safe to read from the reactor
+        # thread.
+        self._context_states = {}
+
     def persist_state(self, prev_pdus, **cols):
-        """Inserts a state PDU into the database
+        """Inserts a state PDU into the database, along with its edges, and
+        updates the context's extremities and minimum depth.
 
         Args:
             txn,
@@ -479,9 +559,15 @@ class StatePduStore(SQLBaseStore):
             **cols: The columns to insert into the PdusTable and StatePdusTable
         """
 
-        return self._db_pool.runInteraction(
+        d = self._db_pool.runInteraction(
             self._persist_state, prev_pdus, cols
         )
+        d.addErrback(self._invalidate_forward_extremities, cols["context"])
+        d.addErrback(
+            self._on_current_state_failure,
+            cols["context"], cols.get("pdu_type"), cols.get("state_key")
+        )
+        return d
 
     def _persist_state(self, txn, prev_pdus, cols):
         pdu_entry = PdusTable.EntryType(
@@ -491,16 +577,27 @@ class StatePduStore(SQLBaseStore):
             **{k: cols.get(k, None) for k in StatePdusTable.fields}
         )
 
-        logger.debug("Inserting pdu: %s", repr(pdu_entry))
-        logger.debug("Inserting state: %s", repr(state_entry))
+        logger.debug("Inserting pdu: %r", pdu_entry)
+        logger.debug("Inserting state: %r", state_entry)
 
         txn.execute(PdusTable.insert_statement(), pdu_entry)
         txn.execute(StatePdusTable.insert_statement(), state_entry)
 
+        self._index_state_chain(txn, pdu_entry.pdu_id, pdu_entry.origin)
+
+        # We may have replaced the row of a pdu that is in the current state.
+        self._invalidate_current_state(
+            txn, pdu_entry.context, state_entry.pdu_type, state_entry.state_key
+        )
+
         self._handle_prev_pdus(
             txn,
             pdu_entry.outlier, pdu_entry.pdu_id, pdu_entry.origin, prev_pdus,
-            pdu_entry.context
+            pdu_entry.context, pdu_entry.depth
+        )
+
+        self._update_min_depth_for_context(
+            txn, pdu_entry.context, pdu_entry.depth
         )
 
     def get_unresolved_state_tree(self, new_state_pdu):
@@ -524,6 +621,13 @@ class StatePduStore(SQLBaseStore):
             logger.debug("get_unresolved_state_tree No current state.")
             return return_value
 
+        branches = self._get_state_branches(txn, new_pdu, current)
+        if branches:
+            new_branch, current_branch = branches
+            return_value.new_branch.extend(new_branch[1:])
+            return_value.current_branch.extend(current_branch)
+            return return_value
+
         return_value.current_branch.append(current)
 
         enum_branches = self._enumerate_state_branches(
@@ -540,10 +644,14 @@ class StatePduStore(SQLBaseStore):
 
     def update_current_state(self, pdu_id, origin, context, pdu_type,
                              state_key):
-        return self._db_pool.runInteraction(
+        d = self._db_pool.runInteraction(
             self._update_current_state,
             pdu_id, origin, context, pdu_type, state_key
         )
+        d.addErrback(
+            self._on_current_state_failure, context, pdu_type, state_key
+        )
+        return d
 
     def _update_current_state(self, txn, pdu_id, origin, context, pdu_type,
                               state_key):
@@ -565,6 +673,159 @@ class StatePduStore(SQLBaseStore):
 
         txn.execute(query, query_args)
 
+        self._invalidate_current_state(txn, context, pdu_type, state_key)
+
+    def _invalidate_current_state(self, txn, context, pdu_type, state_key):
+        self._current_state_cache.pop((context, pdu_type, state_key))
+        self._context_states.pop(context, None)
+
+    def _on_current_state_failure(self, failure, context, pdu_type,
+                                  state_key):
+        """Errback for interactions that change the current state. The
+        interaction may have updated the caches before failing, so we clear
+        them (from the database thread, as that is where they are used).
+        """
+        d = self._db_pool.runInteraction(
+            self._invalidate_current_state, context, pdu_type, state_key
+        )
+        d.addBoth(lambda _: failure)
+        return d
+
+    def get_current_state_for_context(self, context):
+        """Get a list of PDUs that represent the current state for a given
+        context
+
+        Args:
+            context (str)
+
+        Returns:
+            list: A list of PduTuples
+        """
+        if context in self._context_states:
+            return defer.succeed(self._context_states[context])
+
+        return self._db_pool.runInteraction(
+            self._get_current_state_for_context,
+            context
+        )
+
+    def _get_current_state_for_context(self, txn, context):
+        query = (
+            "SELECT pdu_id, origin FROM %s WHERE context = ?"
+            % CurrentStateTable.table_name
+        )
+
+        logger.debug("get_current_state %s, Args=%s", query, context)
+        txn.execute(query, (context,))
+
+        res = txn.fetchall()
+
+        logger.debug("get_current_state %d results", len(res))
+
+        results = self._get_pdu_tuples(txn, res)
+        self._context_states[context] = results
+
+        return results
+
+    def get_state_ancestors(self, pdu_id, origin, min_depth, limit):
+        """Get a state pdu along with its chain of previous state pdus, back
+        to the given depth.
+
+        Args:
+            pdu_id (str)
+            origin (str)
+            min_depth (int): Stop at the first ancestor with a lower depth
+                than this.
+            limit (int): The maximum number of pdus to return.
+
+        Returns:
+            list: A list of PduTuples, newest first. The chain stops early if
+            we don't have one of the pdus in it.
+        """
+        return self._db_pool.runInteraction(
+            self._get_state_ancestors, pdu_id, origin, min_depth, limit
+        )
+
+    def _get_state_ancestors(self, txn, pdu_id, origin, min_depth, limit):
+        position = self._get_state_chain_position(txn, pdu_id, origin)
+        if position:
+            pdu_ids = self._get_indexed_state_ancestors(
+                txn, position, min_depth, limit
+            )
+        else:
+            pdu_ids = self._walk_state_ancestors(
+                txn, pdu_id, origin, min_depth, limit
+            )
+
+        return self._get_pdu_tuples(txn, pdu_ids)
+
+    def _get_indexed_state_ancestors(self, txn, position, min_depth, limit):
+        """Uses the state chain index to get the (pdu_id, origin) of an
+        indexed state pdu and its ancestors, newest first. This takes one
+        query per chain the ancestors pass through.
+        """
+        query = (
+            "SELECT c.pdu_id, c.origin, p.depth FROM %(chain)s AS c "
+            "INNER JOIN %(pdus)s AS p "
+            "ON c.pdu_id = p.pdu_id AND c.origin = p.origin "
+            "WHERE c.chain_id = ? AND c.chain_depth <= ? "
+            "ORDER BY c.chain_depth DESC LIMIT ?"
+        ) % {
+            "chain": StateChainPdusTable.table_name,
+            "pdus": PdusTable.table_name,
+        }
+
+        pdu_ids = []
+        chain_id, depth = position
+        while True:
+            txn.execute(query, (chain_id, depth, limit - len(pdu_ids)))
+            for row in txn.fetchall():
+                # We always return the pdu that was asked for.
+                if pdu_ids and int(row[2]) < min_depth:
+                    return pdu_ids
+                pdu_ids.append((row[0], row[1]))
+
+            parent = self._get_state_chain_parent(txn, chain_id)
+            if not parent or len(pdu_ids) >= limit:
+                return pdu_ids
+            chain_id, depth = parent
+
+    def _walk_state_ancestors(self, txn, pdu_id, origin, min_depth, limit):
+        """Follows the prev_state links of a state pdu which isn't in the
+        state chain index, one pdu at a time.
+
+        Returns:
+            list: The (pdu_id, origin) of the pdu and its ancestors, newest
+            first.
+        """
+        query = (
+            "SELECT s.prev_state_id, s.prev_state_origin, p.depth "
+            "FROM %(state)s AS s "
+            "INNER JOIN %(pdus)s AS p "
+            "ON s.pdu_id = p.pdu_id AND s.origin = p.origin "
+            "WHERE s.pdu_id = ? AND s.origin = ?"
+        ) % {
+            "state": StatePdusTable.table_name,
+            "pdus": PdusTable.table_name,
+        }
+
+        pdu_ids = []
+        key = (pdu_id, origin)
+        while key and len(pdu_ids) < limit:
+            txn.execute(query, key)
+            row = txn.fetchone()
+            if not row:
+                break
+
+            # We always return the pdu that was asked for.
+            if pdu_ids and int(row[2]) < min_depth:
+                break
+
+            pdu_ids.append(key)
+            key = (row[0], row[1]) if row[0] else None
+
+        return pdu_ids
+
     def get_current_state(self, context, pdu_type, state_key):
         """For a given context, pdu_type, state_key 3-tuple, return what is
         currently considered the current state.
@@ -592,6 +853,11 @@ class StatePduStore(SQLBaseStore):
             context, pdu_type, state_key
         )
 
+        key = (context, pdu_type, state_key)
+        result = self._current_state_cache.get(key, _NOT_CACHED)
+        if result is not _NOT_CACHED:
+            return result
+
         fields = _pdu_state_joiner.get_fields(
             PdusTable="p", StatePdusTable="s")
 
@@ -617,6 +883,7 @@ class StatePduStore(SQLBaseStore):
         row = txn.fetchone()
 
         result = PduEntry(*row) if row else None
+        self._current_state_cache.set(key, result)
 
         if not result:
             logger.debug("_get_current_interaction not found")
@@ -665,6 +932,10 @@ class StatePduStore(SQLBaseStore):
                 and new_pdu.prev_state_origin == current.origin):
             return None
 
+        if self._get_state_branches(txn, new_pdu, current):
+            # Both chains are fully indexed, so we have every pdu in them.
+            return None
+
         enum_branches = self._enumerate_state_branches(txn, new_pdu, current)
         for branch, prev_state, state in enum_branches:
             if not state:
@@ -685,9 +956,14 @@ class StatePduStore(SQLBaseStore):
         Returns:
             bool: True if the new_pdu clobbered the current state, False if not
         """
-        return self._db_pool.runInteraction(
+        d = self._db_pool.runInteraction(
             self._handle_new_state, new_pdu
         )
+        d.addErrback(
+            self._on_current_state_failure,
+            new_pdu.context, new_pdu.pdu_type, new_pdu.state_key
+        )
+        return d
 
     def _handle_new_state(self, txn, new_pdu):
         logger.debug(
@@ -716,9 +992,16 @@ class StatePduStore(SQLBaseStore):
             max_new = int(new_pdu.power_level)
             max_current = int(current.power_level)
 
-            enum_branches = self._enumerate_state_branches(
-                txn, new_pdu, current
-            )
+            branches = self._get_state_branches(txn, new_pdu, current)
+            if branches:
+                enum_branches = self._walk_state_branches(
+                    [new_pdu] + branches[0][1:], branches[1]
+                )
+            else:
+                enum_branches = self._enumerate_state_branches(
+                    txn, new_pdu, current
+                )
+
             for branch, prev_state, state in enum_branches:
                 if not state:
                     raise RuntimeError(
@@ -751,6 +1034,10 @@ class StatePduStore(SQLBaseStore):
                     *(new_pdu.__dict__[k] for k in CurrentStateTable.fields)
                 )
             )
+
+            self._invalidate_current_state(
+                txn, new_pdu.context, new_pdu.pdu_type, new_pdu.state_key
+            )
         else:
             logger.debug("handle_new_state not current")
 
@@ -758,6 +1045,267 @@ class StatePduStore(SQLBaseStore):
 
         return is_current
 
+    def _index_state_chain(self, txn, pdu_id, origin):
+        """Adds a newly stored state pdu to the state chain index, if all of
+        its ancestors are known. Any of its ancestors or descendants that were
+        waiting for it are indexed too.
+        """
+        # Walk back until we reach an indexed ancestor or the root.
+        unindexed = []
+        position = None
+        key = (pdu_id, origin)
+        while key:
+            position = self._get_state_chain_position(txn, *key)
+            if position:
+                break
+
+            txn.execute(
+                "SELECT prev_state_id, prev_state_origin FROM %s "
+                "WHERE pdu_id = ? AND origin = ?"
+                % StatePdusTable.table_name,
+                key
+            )
+            row = txn.fetchone()
+            if not row:
+                # We're missing an ancestor, so can't index this pdu yet.
+                return
+
+            unindexed.append(key)
+            key = (row[0], row[1]) if row[0] else None
+
+        for key in reversed(unindexed):
+            position = self._add_state_chain_pdu(txn, key, position)
+
+        # Now index any descendants that arrived before this pdu did.
+        front = [((pdu_id, origin), position)]
+        while front:
+            parent_key, parent_position = front.pop()
+            txn.execute(
+                "SELECT s.pdu_id, s.origin FROM %(state)s AS s "
+                "LEFT JOIN %(chain)s AS c "
+                "ON s.pdu_id = c.pdu_id AND s.origin = c.origin "
+                "WHERE s.prev_state_id = ? AND s.prev_state_origin = ? "
+                "AND c.chain_id IS NULL" % {
+                    "state": StatePdusTable.table_name,
+                    "chain": StateChainPdusTable.table_name,
+                },
+                parent_key
+            )
+            for child in txn.fetchall():
+                child = (child[0], child[1])
+                child_position = self._add_state_chain_pdu(
+                    txn, child, parent_position
+                )
+                front.append((child, child_position))
+
+    def _add_state_chain_pdu(self, txn, key, prev_position):
+        """Adds a state pdu to the index, after its prev_state.
+
+        Args:
+            key (tuple): The (pdu_id, origin) of the pdu.
+            prev_position (tuple): The (chain_id, chain_depth) of the pdu's
+                prev_state, or None if it doesn't have one.
+        Returns:
+            tuple: The (chain_id, chain_depth) of the pdu.
+        """
+        if prev_position:
+            chain_id, depth = prev_position
+            depth += 1
+
+            txn.execute(
+                "SELECT 1 FROM %s WHERE chain_id = ? AND chain_depth = ?"
+                % StateChainPdusTable.table_name,
+                (chain_id, depth)
+            )
+            if txn.fetchone():
+                # The chain already continues past our prev_state, so this is
+                # a fork.
+                chain_id = self._new_state_chain(txn, prev_position)
+        else:
+            chain_id = self._new_state_chain(txn, None)
+            depth = 0
+
+        txn.execute(
+            "INSERT INTO %s (pdu_id, origin, chain_id, chain_depth) "
+            "VALUES (?, ?, ?, ?)" % StateChainPdusTable.table_name,
+            (key[0], key[1], chain_id, depth)
+        )
+
+        return (chain_id, depth)
+
+    def _new_state_chain(self, txn, parent_position):
+        parent_id, parent_depth = parent_position or (None, None)
+        txn.execute(
+            "INSERT INTO %s (parent_id, parent_depth) VALUES (?, ?)"
+            % StateChainsTable.table_name,
+            (parent_id, parent_depth)
+        )
+        return txn.lastrowid
+
+    def _get_state_chain_position(self, txn, pdu_id, origin):
+        """Returns:
+            tuple: The (chain_id, chain_depth) of the state pdu, or None if it
+            isn't indexed.
+        """
+        txn.execute(
+            "SELECT chain_id, chain_depth FROM %s "
+            "WHERE pdu_id = ? AND origin = ?"
+            % StateChainPdusTable.table_name,
+            (pdu_id, origin)
+        )
+        row = txn.fetchone()
+        return (row[0], row[1]) if row else None
+
+    def _get_state_chain_parent(self, txn, chain_id):
+        """Returns:
+            tuple: The (chain_id, chain_depth) that the chain forked from, or
+            None if the chain starts at a root.
+        """
+        txn.execute(
+            "SELECT parent_id, parent_depth FROM %s WHERE id = ?"
+            % StateChainsTable.table_name,
+            (chain_id,)
+        )
+        row = txn.fetchone()
+        return (row[0], row[1]) if row and row[0] is not None else None
+
+    def _find_common_state_ancestor(self, txn, position_a, position_b):
+        """Finds the nearest common ancestor of two indexed state pdus. This
+        takes one query for each fork between the pdus and the ancestor.
+
+        Args:
+            position_a (tuple): The (chain_id, chain_depth) of one pdu.
+            position_b (tuple): The (chain_id, chain_depth) of the other.
+        Returns:
+            tuple: The (chain_id, chain_depth) of the common ancestor, or None
+            if the pdus have different roots.
+        """
+        chain_a, depth_a = position_a
+        chain_b, depth_b = position_b
+        parent_a = self._get_state_chain_parent(txn, chain_a)
+        parent_b = self._get_state_chain_parent(txn, chain_b)
+
+        while chain_a != chain_b:
+            # A chain can only be an ancestor of chains that start deeper than
+            # it does, so we move up from whichever starts deepest.
+            start_a = parent_a[1] + 1 if parent_a else 0
+            start_b = parent_b[1] + 1 if parent_b else 0
+
+            if start_a >= start_b:
+                if not parent_a:
+                    return None
+                chain_a, depth_a = parent_a
+                parent_a = self._get_state_chain_parent(txn, chain_a)
+            else:
+                if not parent_b:
+                    return None
+                chain_b, depth_b = parent_b
+                parent_b = self._get_state_chain_parent(txn, chain_b)
+
+        return (chain_a, min(depth_a, depth_b))
+
+    def _get_state_chain_branch(self, txn, position, ancestor):
+        """Gets the state pdus from the one at `position` back to (and
+        including) `ancestor`, newest first. This takes one query per chain
+        the branch passes through.
+
+        Returns:
+            list: A list of PduEntry
+        """
+        chain_id, depth = position
+        ancestor_chain_id, ancestor_depth = ancestor
+
+        query = (
+            "SELECT %(fields)s FROM %(chain)s AS c "
+            "INNER JOIN %(pdus)s AS p "
+            "ON c.pdu_id = p.pdu_id AND c.origin = p.origin "
+            "LEFT JOIN %(state)s AS s "
+            "ON c.pdu_id = s.pdu_id AND c.origin = s.origin "
+            "WHERE c.chain_id = ? AND c.chain_depth > ? "
+            "AND c.chain_depth <= ? "
+            "ORDER BY c.chain_depth DESC"
+        ) % {
+            "fields": _pdu_state_joiner.get_fields(
+                PdusTable="p", StatePdusTable="s"),
+            "chain": StateChainPdusTable.table_name,
+            "pdus": PdusTable.table_name,
+            "state": StatePdusTable.table_name,
+        }
+
+        branch = []
+        while chain_id != ancestor_chain_id:
+            parent_chain_id, parent_depth = self._get_state_chain_parent(
+                txn, chain_id
+            )
+            txn.execute(query, (chain_id, parent_depth, depth))
+            branch.extend(PduEntry(*row) for row in txn.fetchall())
+            chain_id, depth = parent_chain_id, parent_depth
+
+        txn.execute(query, (chain_id, ancestor_depth - 1, depth))
+        branch.extend(PduEntry(*row) for row in txn.fetchall())
+
+        return branch
+
+    def _get_state_branches(self, txn, pdu_a, pdu_b):
+        """Uses the state chain index to get the branches from two state pdus
+        back to their common ancestor.
+
+        Returns:
+            tuple: A 2-tuple of lists of PduEntry, one for each of the given
+            pdus, running from that pdu back to the common ancestor inclusive.
+            Returns None if either pdu is not indexed (e.g. because we are
+            missing some of its ancestors), or they have no common ancestor.
+        """
+        position_a = self._get_state_chain_position(
+            txn, pdu_a.pdu_id, pdu_a.origin
+        )
+        position_b = self._get_state_chain_position(
+            txn, pdu_b.pdu_id, pdu_b.origin
+        )
+        if not position_a or not position_b:
+            return None
+
+        ancestor = self._find_common_state_ancestor(
+            txn, position_a, position_b
+        )
+        if not ancestor:
+            return None
+
+        branch_a = self._get_state_chain_branch(txn, position_a, ancestor)
+        branch_b = self._get_state_chain_branch(txn, position_b, ancestor)
+
+        # Sanity check that we found every pdu in the branches.
+        if len(branch_a) != position_a[1] - ancestor[1] + 1:
+            return None
+        if len(branch_b) != position_b[1] - ancestor[1] + 1:
+            return None
+
+        return (branch_a, branch_b)
+
+    @staticmethod
+    def _walk_state_branches(branch_a, branch_b):
+        """Steps through two branches returned by `_get_state_branches` in
+        the same order as `_enumerate_state_branches` would, yielding the same
+        values.
+        """
+        idx_a = 0
+        idx_b = 0
+        while idx_a < len(branch_a) - 1 or idx_b < len(branch_b) - 1:
+            do_branch_a = idx_a < len(branch_a) - 1
+            do_branch_b = idx_b < len(branch_b) - 1
+
+            if do_branch_a and do_branch_b:
+                do_branch_a = (
+                    int(branch_a[idx_a].depth) > int(branch_b[idx_b].depth)
+                )
+
+            if do_branch_a:
+                idx_a += 1
+                yield (0, branch_a[idx_a - 1], branch_a[idx_a])
+            else:
+                idx_b += 1
+                yield (1, branch_b[idx_b - 1], branch_b[idx_b])
+
     @classmethod
     @log_function
     def _enumerate_state_branches(cls, txn, pdu_a, pdu_b):
@@ -944,6 +1492,31 @@ class StatePdusTable(Table):
     EntryType = namedtuple("StatePdusEntry", fields)
 
 
+class StateChainsTable(Table):
+    table_name = "state_chains"
+
+    fields = [
+        "id",
+        "parent_id",
+        "parent_depth",
+    ]
+
+    EntryType = namedtuple("StateChainsEntry", fields)
+
+
+class StateChainPdusTable(Table):
+    table_name = "state_chain_pdus"
+
+    fields = [
+        "pdu_id",
+        "origin",
+        "chain_id",
+        "chain_depth",
+    ]
+
+    EntryType = namedtuple("StateChainPdusEntry", fields)
+
+
 class CurrentStateTable(Table):
     table_name = "current_state"
 
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 from ._base import SQLBaseStore
 
+import logging
+
+logger = logging.getLogger(__name__)
+
 
 class PresenceStore(SQLBaseStore):
     def create_presence(self, user_localpart):
@@ -24,14 +28,38 @@ class PresenceStore(SQLBaseStore):
             retcols=["state", "status_msg"],
         )
 
-    def set_presence_state(self, user_localpart, new_state):
-        return self._simple_update_one(
-            table="presence",
-            keyvalues={"user_id": user_localpart},
-            updatevalues={"state": new_state["state"],
-                          "status_msg": new_state["status_msg"]},
-            retcols=["state"],
-        )
+    def set_presence_states(self, states):
+        """Stores the presence state of many users in one transaction. Users
+        who don't have a presence row yet are given one.
+
+        Args:
+            states (dict): Maps user localparts to their new state.
+        """
+        rows = [
+            (state["state"], state["status_msg"], user_localpart)
+            for user_localpart, state in states.items()
+        ]
+
+        def func(txn):
+            txn.executemany(
+                "UPDATE presence SET state = ?, status_msg = ? "
+                "WHERE user_id = ?",
+                rows
+            )
+            if txn.rowcount >= len(rows):
+                return
+
+            txn.executemany(
+                "INSERT INTO presence (state, status_msg, user_id) "
+                "SELECT ?, ?, ? WHERE NOT EXISTS ("
+                "SELECT 1 FROM presence WHERE user_id = ?)",
+                [row + (row[2],) for row in rows]
+            )
+            logger.warn(
+                "Created presence rows for %d users who had none",
+                txn.rowcount
+            )
+        return self._db_pool.runInteraction(func)
 
     def allow_presence_visible(self, observed_localpart, observer_userid):
         return self._simple_insert(
@@ -3,20 +3,44 @@ from twisted.internet import defer
 
 from sqlite3 import IntegrityError
 
+from synapse.api.constants import Membership
 from synapse.api.errors import StoreError
 from synapse.api.events.room import RoomTopicEvent
 
 from ._base import SQLBaseStore, Table
+from synapse.util.jsonutil import decode_json, encode_canonical_json
 
 import collections
-import json
+import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+# The public room directory. `rooms` is a list of dicts for the public rooms,
+# in order of room ID, and `room_ids` lists just their IDs, in the same order.
+RoomDirectory = collections.namedtuple(
+    "RoomDirectory", ["etag", "rooms", "room_ids"]
+)
+
+
 class RoomStore(SQLBaseStore):
 
+    def __init__(self, hs):
+        super(RoomStore, self).__init__(hs)
+
+        # The public room directory, as a RoomDirectory, or None if it needs
+        # to be loaded again.
+        self._room_directory = None
+
+        # Incremented whenever the room directory changes, so that a load
+        # which raced with a change doesn't get cached.
+        self._room_directory_sequence = 0
+
+        # Whether the room_directory table has been filled in for rooms
+        # created before it existed.
+        self._room_directory_backfilled = False
+
     @defer.inlineCallbacks
     def store_room(self, room_id, room_creator_user_id, is_public):
         """Stores a room.
@@ -30,23 +54,44 @@ class RoomStore(SQLBaseStore):
             StoreError if the room could not be stored.
         """
         try:
-            yield self._simple_insert(RoomsTable.table_name, dict(
-                room_id=room_id,
-                creator=room_creator_user_id,
-                is_public=is_public
-            ))
+            yield self._db_pool.runInteraction(
+                self._store_room_txn, room_id, room_creator_user_id, is_public
+            )
         except IntegrityError:
             raise StoreError(409, "Room ID in use.")
         except Exception as e:
             logger.error("store_room with room_id=%s failed: %s", room_id, e)
             raise StoreError(500, "Problem creating room.")
 
+        self._on_room_directory_changed()
+
+    def _store_room_txn(self, txn, room_id, room_creator_user_id, is_public):
+        self._simple_insert_txn(txn, RoomsTable.table_name, dict(
+            room_id=room_id,
+            creator=room_creator_user_id,
+            is_public=is_public
+        ))
+        self._simple_insert_txn(txn, RoomDirectoryTable.table_name, dict(
+            room_id=room_id,
+            is_public=is_public
+        ))
+
     def store_room_config(self, room_id, visibility):
-        return self._simple_update_one(
-            table=RoomsTable.table_name,
-            keyvalues={"room_id": room_id},
-            updatevalues={"is_public": visibility}
+        d = self._db_pool.runInteraction(
+            self._store_room_config_txn, room_id, visibility == "public"
         )
+        return d.addCallback(self._on_room_directory_changed)
+
+    def _store_room_config_txn(self, txn, room_id, is_public):
+        txn.execute(
+            "UPDATE %s SET is_public = ? WHERE room_id = ?"
+            % RoomsTable.table_name,
+            (is_public, room_id)
+        )
+        if txn.rowcount == 0:
+            raise StoreError(404, "No row found")
+
+        self._update_room_directory_txn(txn, room_id, is_public=is_public)
 
     def get_room(self, room_id):
         """Retrieve a room.
@@ -61,47 +106,161 @@ class RoomStore(SQLBaseStore):
             RoomsTable.decode_single_result, query, room_id,
         )
 
-    @defer.inlineCallbacks
-    def get_rooms(self, is_public, with_topics):
-        """Retrieve a list of all public rooms.
+    def get_room_directory(self):
+        """Retrieve the public rooms.
+
+        This is served from memory, and only loaded from the room_directory
+        table again after it changes.
 
-        Args:
-            is_public (bool): True if the rooms returned should be public.
-            with_topics (bool): True to include the current topic for the room
-            in the response.
         Returns:
-            A list of room dicts containing at least a "room_id" key, and a
-            "topic" key if one is set and with_topic=True.
+            Deferred: Resolves to a RoomDirectory. Each room dict has a
+            "room_id" and "num_joined_members" key, and a "topic" key if one
+            is set.
+        """
+        if self._room_directory is not None:
+            return defer.succeed(self._room_directory)
+
+        sequence = self._room_directory_sequence
+
+        def cache(rooms):
+            self._room_directory_backfilled = True
+
+            directory = RoomDirectory(
+                etag='"%s"' % (
+                    hashlib.sha1(encode_canonical_json(rooms)).hexdigest(),
+                ),
+                rooms=rooms,
+                room_ids=[room["room_id"] for room in rooms],
+            )
+
+            if sequence == self._room_directory_sequence:
+                self._room_directory = directory
+
+            return directory
+
+        d = self._db_pool.runInteraction(
+            self._get_room_directory_txn, self._room_directory_backfilled
+        )
+        return d.addCallback(cache)
+
+    def _get_room_directory_txn(self, txn, backfilled):
+        if not backfilled:
+            self._backfill_room_directory_txn(txn)
+
+        txn.execute(
+            "SELECT room_id, topic, member_count FROM %s "
+            "WHERE is_public = 1 ORDER BY room_id"
+            % RoomDirectoryTable.table_name
+        )
+
+        rooms = []
+        for room_id, topic, member_count in txn.fetchall():
+            room = {"room_id": room_id, "num_joined_members": member_count}
+            if topic is not None:
+                room["topic"] = topic
+            rooms.append(room)
+
+        return rooms
+
+    def _backfill_room_directory_txn(self, txn):
+        txn.execute(
+            "SELECT room_id, is_public FROM %(rooms)s WHERE room_id NOT IN "
+            "(SELECT room_id FROM %(directory)s)" % {
+                "rooms": RoomsTable.table_name,
+                "directory": RoomDirectoryTable.table_name,
+            }
+        )
+
+        for room_id, is_public in txn.fetchall():
+            self._simple_insert_txn(txn, RoomDirectoryTable.table_name, dict(
+                room_id=room_id,
+                is_public=is_public
+            ))
+
+            txn.execute(
+                "SELECT content FROM room_data WHERE room_id = ? AND type = ? "
+                "ORDER BY id DESC LIMIT 1",
+                (room_id, RoomTopicEvent.TYPE)
+            )
+            row = txn.fetchone()
+            if row:
+                self._update_room_topic_txn(txn, room_id, row[0])
+
+            self._count_room_members_txn(txn, room_id)
+
+    def _update_room_directory_txn(self, txn, room_id, **values):
+        txn.execute(
+            "UPDATE %s SET %s WHERE room_id = ?" % (
+                RoomDirectoryTable.table_name,
+                ", ".join("%s = ?" % (k,) for k in values),
+            ),
+            values.values() + [room_id]
+        )
+
+    def _update_room_topic_txn(self, txn, room_id, content):
+        """Sets the topic of a room in the directory.
+
+        Args:
+            txn
+            room_id (str)
+            content (str): The JSON content of the topic event.
         """
-        room_data_type = RoomTopicEvent.TYPE
-        public = 1 if is_public else 0
+        try:
+            topic = decode_json(content)["topic"]
+        except:
+            topic = None  # no topic set
 
-        latest_topic = ("SELECT max(room_data.id) FROM room_data WHERE "
-                        + "room_data.type = ? GROUP BY room_id")
+        self._update_room_directory_txn(txn, room_id, topic=topic)
 
-        query = ("SELECT rooms.*, room_data.content FROM rooms LEFT JOIN "
-                 + "room_data ON rooms.room_id = room_data.room_id WHERE "
-                 + "(room_data.id IN (" + latest_topic + ") "
-                 + "OR room_data.id IS NULL) AND rooms.is_public = ?")
+    def _update_room_member_count_txn(self, txn, values):
+        """Updates the joined member count of a room in the directory after a
+        membership row has been inserted, by comparing it with the member's
+        previous membership.
 
-        res = yield self._execute(
-            self.cursor_to_dict, query, room_data_type, public
+        Args:
+            txn
+            values (dict): The values of the new room_memberships row,
+                including its id.
+        """
+        txn.execute(
+            "SELECT membership FROM room_memberships "
+            "WHERE user_id = ? AND room_id = ? AND id < ? "
+            "ORDER BY id DESC LIMIT 1",
+            (values["user_id"], values["room_id"], values["id"])
         )
+        row = txn.fetchone()
 
-        # return only the keys the specification expects
-        ret_keys = ["room_id", "topic"]
+        was_joined = bool(row) and row[0] == Membership.JOIN
+        is_joined = values["membership"] == Membership.JOIN
+        if was_joined == is_joined:
+            return
 
-        # extract topic from the json (icky) FIXME
-        for i, room_row in enumerate(res):
-            try:
-                content_json = json.loads(room_row["content"])
-                room_row["topic"] = content_json["topic"]
-            except:
-                pass  # no topic set
-            # filter the dict based on ret_keys
-            res[i] = {k: v for k, v in room_row.iteritems() if k in ret_keys}
+        txn.execute(
+            "UPDATE %s SET member_count = member_count + ? WHERE room_id = ?"
+            % RoomDirectoryTable.table_name,
+            (1 if is_joined else -1, values["room_id"])
+        )
 
-        defer.returnValue(res)
+    def _count_room_members_txn(self, txn, room_id):
+        """Recounts the joined members of a room in the directory."""
+        txn.execute(
+            "UPDATE %(directory)s SET member_count = ("
+            "SELECT COUNT(*) FROM room_memberships WHERE id IN ("
+            "SELECT MAX(id) FROM room_memberships WHERE room_id = ? "
+            "GROUP BY user_id) AND membership = ?"
+            ") WHERE room_id = ?" % {
+                "directory": RoomDirectoryTable.table_name,
+            },
+            (room_id, Membership.JOIN, room_id)
+        )
+
+    def _on_room_directory_changed(self, result=None):
+        """Drops the in memory room directory after a change has been
+        committed. Passes `result` through, so can be used as a callback.
+        """
+        self._room_directory = None
+        self._room_directory_sequence += 1
+        return result
 
 
 class RoomsTable(Table):
@@ -114,3 +273,16 @@ class RoomsTable(Table):
     ]
 
     EntryType = collections.namedtuple("RoomEntry", fields)
+
+
+class RoomDirectoryTable(Table):
+    table_name = "room_directory"
+
+    fields = [
+        "room_id",
+        "is_public",
+        "topic",
+        "member_count"
+    ]
+
+    EntryType = collections.namedtuple("RoomDirectoryEntry", fields)
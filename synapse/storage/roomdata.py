@@ -1,14 +1,43 @@
 # -*- coding: utf-8 -*-
-from ._base import SQLBaseStore, Table
+from ._base import SQLBaseStore, StreamIdGenerator, Table
+from synapse.api.events.room import RoomTopicEvent
+from synapse.util.jsonutil import decode_json
+from synapse.util.lrucache import LruCache
+
+from twisted.internet import defer
 
 import collections
-import json
+
+
+ROOM_DATA_CACHE_SIZE = 10000
+
+# Returned by the cache for keys it doesn't hold, as None is cached for keys
+# with no data.
+_NOT_CACHED = object()
 
 
 class RoomDataStore(SQLBaseStore):
 
     """Provides various CRUD operations for Room Events. """
 
+    def __init__(self, hs):
+        super(RoomDataStore, self).__init__(hs)
+        self._room_data_id_gen = StreamIdGenerator(
+            self, RoomDataTable.table_name
+        )
+
+        # Maps (room_id, type, state_key) to the current RoomDataEntry, or
+        # None if there isn't one.
+        self.room_data_cache = LruCache(ROOM_DATA_CACHE_SIZE)
+
+        # Incremented whenever room data is stored, so that a lookup which
+        # raced with a change doesn't get cached.
+        self._room_data_sequence = 0
+
+        # Whether the current_room_data table has been filled in for data
+        # stored before it existed.
+        self._current_room_data_backfilled = False
+
     def get_room_data(self, room_id, etype, state_key=""):
         """Retrieve the data stored under this type and state_key.
 
@@ -19,15 +48,58 @@ class RoomDataStore(SQLBaseStore):
         Returns:
             namedtuple: Or None if nothing exists at this path.
         """
-        query = RoomDataTable.select_statement(
-            "room_id = ? AND type = ? AND state_key = ? "
-            "ORDER BY id DESC LIMIT 1"
+        key = (room_id, etype, state_key)
+        entry = self.room_data_cache.get(key, _NOT_CACHED)
+        if entry is not _NOT_CACHED:
+            return defer.succeed(entry)
+
+        sequence = self._room_data_sequence
+
+        def cache(entry):
+            self._current_room_data_backfilled = True
+            if sequence == self._room_data_sequence:
+                self.room_data_cache.set(key, entry)
+            return entry
+
+        d = self._db_pool.runInteraction(
+            self._get_room_data_txn, room_id, etype, state_key,
+            self._current_room_data_backfilled
         )
-        return self._execute(
-            RoomDataTable.decode_single_result,
-            query, room_id, etype, state_key,
+        return d.addCallback(cache)
+
+    def _get_room_data_txn(self, txn, room_id, etype, state_key, backfilled):
+        if not backfilled:
+            txn.execute(
+                "INSERT OR IGNORE INTO %(current)s "
+                "(room_id, type, state_key, id, content) "
+                "SELECT room_id, type, state_key, id, content FROM %(data)s "
+                "WHERE id IN (SELECT MAX(id) FROM %(data)s "
+                "GROUP BY room_id, type, state_key)" % {
+                    "current": CurrentRoomDataTable.table_name,
+                    "data": RoomDataTable.table_name,
+                }
+            )
+
+        query = CurrentRoomDataTable.select_statement(
+            "room_id = ? AND type = ? AND state_key = ?"
+        )
+        txn.execute(query, (room_id, etype, state_key))
+        return CurrentRoomDataTable.decode_single_result(txn.fetchall())
+
+    def _update_current_room_data_txn(self, txn, values):
+        txn.execute(
+            CurrentRoomDataTable.insert_statement(),
+            [values[field] for field in CurrentRoomDataTable.fields]
         )
 
+    def _on_room_data_changed(self, result, room_id, etype, state_key):
+        """Drops cached room data after a change has been committed. Passes
+        `result` through, so can be used as a callback.
+        """
+        self.room_data_cache.pop((room_id, etype, state_key))
+        self._room_data_sequence += 1
+        return result
+
     def store_room_data(self, room_id, etype, state_key="", content=None):
         """Stores room specific data.
 
@@ -39,15 +111,31 @@ class RoomDataStore(SQLBaseStore):
         Returns:
             The store ID for this data.
         """
-        return self._simple_insert(RoomDataTable.table_name, dict(
-            etype=etype,
+        values = dict(
+            type=etype,
             state_key=state_key,
             room_id=room_id,
             content=content,
-        ))
+        )
+
+        def after_insert(txn, values):
+            self._update_current_room_data_txn(txn, values)
+
+            # Topics are also shown in the room directory.
+            if etype == RoomTopicEvent.TYPE:
+                self._update_room_topic_txn(txn, room_id, content)
+
+        d = self._simple_insert_stream_batched(
+            self._room_data_id_gen, RoomDataTable.table_name, values,
+            after_insert=after_insert
+        )
+        d.addCallback(self._on_room_data_changed, room_id, etype, state_key)
+        if etype == RoomTopicEvent.TYPE:
+            d.addCallback(self._on_room_directory_changed)
+        return d
 
     def get_max_room_data_id(self):
-        return self._simple_max_id(RoomDataTable.table_name)
+        return self._room_data_id_gen.get_max_token()
 
 
 class RoomDataTable(Table):
@@ -67,5 +155,19 @@ class RoomDataTable(Table):
             return event_factory.create_event(
                 etype=self.type,
                 room_id=self.room_id,
-                content=json.loads(self.content),
+                content=decode_json(self.content),
             )
+
+
+class CurrentRoomDataTable(Table):
+    table_name = "current_room_data"
+
+    fields = [
+        "id",
+        "room_id",
+        "type",
+        "state_key",
+        "content"
+    ]
+
+    EntryType = RoomDataTable.EntryType
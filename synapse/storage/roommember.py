@@ -5,11 +5,11 @@ from synapse.types import UserID
 from synapse.api.constants import Membership
 from synapse.api.events.room import RoomMemberEvent
 
-from ._base import SQLBaseStore, Table
+from ._base import SQLBaseStore, StreamIdGenerator, Table
+from synapse.util.jsonutil import decode_json, encode_json
 
 
 import collections
-import json
 import logging
 
 logger = logging.getLogger(__name__)
@@ -17,6 +17,12 @@ logger = logging.getLogger(__name__)
 
 class RoomMemberStore(SQLBaseStore):
 
+    def __init__(self, hs):
+        super(RoomMemberStore, self).__init__(hs)
+        self._room_member_id_gen = StreamIdGenerator(
+            self, RoomMemberTable.table_name
+        )
+
     def get_room_member(self, user_id, room_id):
         """Retrieve the current state of a room member.
 
@@ -44,14 +50,18 @@ class RoomMemberStore(SQLBaseStore):
             state.
             content (dict): The content of the membership (JSON).
         """
-        content_json = json.dumps(content)
-        return self._simple_insert(RoomMemberTable.table_name, dict(
-            user_id=user_id,
-            sender=sender,
-            room_id=room_id,
-            membership=membership,
-            content=content_json,
-        ))
+        content_json = encode_json(content)
+        d = self._simple_insert_stream_batched(
+            self._room_member_id_gen, RoomMemberTable.table_name, dict(
+                user_id=user_id,
+                sender=sender,
+                room_id=room_id,
+                membership=membership,
+                content=content_json,
+            ),
+            after_insert=self._update_room_member_count_txn
+        )
+        return d.addCallback(self._on_room_directory_changed)
 
     @defer.inlineCallbacks
     def get_room_members(self, room_id, membership=None):
@@ -131,7 +141,7 @@ class RoomMemberStore(SQLBaseStore):
         defer.returnValue(hosts)
 
     def get_max_room_member_id(self):
-        return self._simple_max_id(RoomMemberTable.table_name)
+        return self._room_member_id_gen.get_max_token()
 
 
 class RoomMemberTable(Table):
@@ -154,5 +164,5 @@ class RoomMemberTable(Table):
                 room_id=self.room_id,
                 target_user_id=self.user_id,
                 user_id=self.sender,
-                content=json.loads(self.content),
+                content=decode_json(self.content),
             )
@@ -4,6 +4,15 @@ CREATE TABLE IF NOT EXISTS rooms(
     creator TEXT
 );
 
+-- A summary of each room for the room directory, kept up to date as rooms,
+-- their topics and their members change.
+CREATE TABLE IF NOT EXISTS room_directory(
+    room_id TEXT PRIMARY KEY NOT NULL,
+    is_public INTEGER,
+    topic TEXT,
+    member_count INTEGER DEFAULT 0 NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS room_memberships(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id TEXT NOT NULL, -- no foreign key to users table, it could be an id belonging to another home server
@@ -13,6 +22,10 @@ CREATE TABLE IF NOT EXISTS room_memberships(
     content TEXT NOT NULL
 );
 
+CREATE INDEX IF NOT EXISTS room_memberships_user_room ON room_memberships(
+    user_id, room_id
+);
+
 CREATE TABLE IF NOT EXISTS messages(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     user_id TEXT, 
@@ -21,6 +34,8 @@ CREATE TABLE IF NOT EXISTS messages(
     content TEXT
 );
 
+CREATE INDEX IF NOT EXISTS messages_room_id ON messages(room_id);
+
 CREATE TABLE IF NOT EXISTS feedback(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     content TEXT,
@@ -38,3 +53,13 @@ CREATE TABLE IF NOT EXISTS room_data(
     state_key TEXT NOT NULL,
     content TEXT
 );
+
+-- The latest row in room_data for each room, type and state key.
+CREATE TABLE IF NOT EXISTS current_room_data(
+    room_id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    state_key TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    content TEXT,
+    PRIMARY KEY(room_id, type, state_key)
+);
@@ -28,6 +28,25 @@ CREATE TABLE IF NOT EXISTS state_pdus(
     CONSTRAINT prev_pdu_id_origin UNIQUE (prev_state_id, prev_state_origin)
 );
 
+-- Splits the tree formed by the prev_state links of state pdus into chains,
+-- so that common ancestors and whole branches can be found without following
+-- the links one pdu at a time. A chain is a run of state pdus each of which is
+-- the prev_state of the next; a fork starts a new chain.
+CREATE TABLE IF NOT EXISTS state_chains(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    parent_id INTEGER, -- The chain this one forked from, or NULL
+    parent_depth INTEGER -- The chain_depth in the parent where it forked
+);
+
+CREATE TABLE IF NOT EXISTS state_chain_pdus(
+    pdu_id TEXT,
+    origin TEXT,
+    chain_id INTEGER,
+    chain_depth INTEGER, -- The number of prev_state links back to the root
+    CONSTRAINT pdu_id_origin UNIQUE (pdu_id, origin),
+    CONSTRAINT chain_position UNIQUE (chain_id, chain_depth)
+);
+
 CREATE TABLE IF NOT EXISTS current_state(
     pdu_id TEXT,
     origin TEXT,
@@ -80,6 +99,7 @@ CREATE INDEX IF NOT EXISTS context_depth_context ON context_depth(context);
 
 
 CREATE INDEX IF NOT EXISTS pdu_id ON pdus(pdu_id, origin);
+CREATE INDEX IF NOT EXISTS pdu_context ON pdus(context);
 
 CREATE INDEX IF NOT EXISTS dests_id ON pdu_destinations (pdu_id, origin);
 -- CREATE INDEX IF NOT EXISTS dests ON pdu_destinations (destination);
@@ -88,5 +108,6 @@ CREATE INDEX IF NOT EXISTS pdu_extrem_context ON pdu_forward_extremities(context
 CREATE INDEX IF NOT EXISTS pdu_extrem_id ON pdu_forward_extremities(pdu_id, origin);
 
 CREATE INDEX IF NOT EXISTS pdu_edges_id ON pdu_edges(pdu_id, origin);
+CREATE INDEX IF NOT EXISTS pdu_edges_prev_id ON pdu_edges(prev_pdu_id, prev_origin);
 
 CREATE INDEX IF NOT EXISTS pdu_b_extrem_context ON pdu_backward_extremities(context);
@@ -5,8 +5,8 @@ from .message import MessagesTable
 from .feedback import FeedbackTable
 from .roomdata import RoomDataTable
 from .roommember import RoomMemberTable
+from synapse.util.jsonutil import decode_json
 
-import json
 import logging
 
 logger = logging.getLogger(__name__)
@@ -38,6 +38,40 @@ class StreamStore(SQLBaseStore):
                 user_id, from_key, to_key, room_id, limit
             )
 
+    def get_message_streams_for_rooms(self, user_id, from_key, to_key,
+                                      room_ids, limit=0, with_feedback=False):
+        """Get the messages for this user between the given keys in each of
+        the given rooms, all in a single interaction.
+
+        Args:
+            user_id (str): The user who is requesting messages.
+            from_key (int): The ID to start returning results from (exclusive).
+            to_key (int): The ID to stop returning results (exclusive).
+            room_ids (list): The rooms to get messages for.
+            limit (int): The most messages to return for each room.
+            with_feedback (bool): Whether to include compressed feedback.
+        Returns:
+            A dict mapping each room ID to a tuple of rows (list of
+            namedtuples), new_id(int), as returned by `get_message_stream`.
+        """
+        return self._db_pool.runInteraction(
+            self._get_message_rows_for_rooms,
+            user_id, from_key, to_key, room_ids, limit, with_feedback
+        )
+
+    def _get_message_rows_for_rooms(self, txn, user_id, from_pkey, to_pkey,
+                                    room_ids, limit, with_feedback):
+        if with_feedback:
+            get_rows = self._get_message_rows_with_feedback
+        else:
+            get_rows = self._get_message_rows
+
+        # Each of these is an indexed top-N query on a single room.
+        return {
+            room_id: get_rows(txn, user_id, from_pkey, to_pkey, room_id, limit)
+            for room_id in room_ids
+        }
+
     def _get_message_rows(self, txn, user_id, from_pkey, to_pkey, room_id,
                           limit):
         # work out which rooms this user is joined in on and join them with
@@ -104,13 +138,18 @@ class StreamStore(SQLBaseStore):
         events = []
         for entry in entries:
             # TODO we should spec the cursor > event mapping somewhere else.
+            msg = self._get_event_dict(
+                MessagesTable,
+                MessagesTable.EntryType(
+                    **{k: entry[k] for k in MessagesTable.fields}
+                )
+            )
             event = {}
-            straight_mappings = ["msg_id", "user_id", "room_id"]
+            straight_mappings = ["msg_id", "user_id", "room_id", "content"]
             for key in straight_mappings:
-                event[key] = entry[key]
-            event["content"] = json.loads(entry["content"])
+                event[key] = msg[key]
             if entry["compressed_fb"]:
-                event["feedback"] = json.loads(entry["compressed_fb"])
+                event["feedback"] = decode_json(entry["compressed_fb"])
             events.append(event)
 
         latest_pkey = from_pkey if len(entries) == 0 else entries[-1]["id"]
@@ -262,7 +301,7 @@ class StreamStore(SQLBaseStore):
             last_pkey = data_entries[-1].id
 
         events = [
-            entry.as_event(self.event_factory).get_dict()
+            self._get_event_dict(table, entry)
             for entry in data_entries
         ]
 
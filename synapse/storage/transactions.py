@@ -43,34 +43,34 @@ class TransactionStore(SQLBaseStore):
         else:
             return None
 
-    def set_received_txn_response(self, transaction_id, origin, code,
-                                  response_dict):
+    def set_received_txn_response(self, transaction_id, origin, ts, code,
+                                  response_json):
         """Persist the response we returened for an incoming transaction, and
         should return for subsequent transactions with the same transaction_id
         and origin.
 
         Args:
-            txn
             transaction_id (str)
             origin (str)
+            ts (int)
             code (int)
             response_json (str)
         """
 
         return self._db_pool.runInteraction(
             self._set_received_txn_response,
-            transaction_id, origin, code, response_dict
+            transaction_id, origin, ts, code, response_json
         )
 
-    def _set_received_txn_response(self, txn, transaction_id, origin, code,
+    def _set_received_txn_response(self, txn, transaction_id, origin, ts, code,
                                    response_json):
         query = (
-            "UPDATE %s "
-            "SET response_code = ?, response_json = ? "
-            "WHERE transaction_id = ? AND origin = ?"
+            "INSERT OR REPLACE INTO %s "
+            "(transaction_id, origin, ts, response_code, response_json) "
+            "VALUES (?, ?, ?, ?, ?)"
         ) % ReceivedTransactionsTable.table_name
 
-        txn.execute(query, (code, response_json, transaction_id, origin))
+        txn.execute(query, (transaction_id, origin, ts, code, response_json))
 
     def prep_send_transaction(self, transaction_id, destination, ts, pdu_list):
         """Persists an outgoing transaction and calculates the values for the
@@ -128,7 +128,7 @@ class TransactionStore(SQLBaseStore):
             for pdu in pdu_list
         ]
 
-        logger.debug("Inserting: %s", repr(values))
+        logger.debug("Inserting: %r", values)
 
         query = TransactionsToPduTable.insert_statement()
         txn.executemany(query, values)
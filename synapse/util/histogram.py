@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+
+
+class Histogram(object):
+    """Counts how many of a series of values fall into each of a fixed set of
+    buckets, along with their total and maximum.
+
+    Attributes:
+        buckets (list): The upper bound of each bucket, in ascending order.
+            Values larger than the last bound are counted in a final overflow
+            bucket.
+        counts (list): The number of values in each bucket, with one more
+            entry than `buckets` for the overflow bucket.
+        count (int): The number of values added.
+        total: The sum of the values added.
+        max: The largest value added, or None if there have been none.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def add(self, value):
+        """Adds a value to the histogram.
+
+        Args:
+            value: The value to add.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def get_dict(self):
+        """Returns:
+            dict: A summary of the histogram, mapping each bucket's upper
+            bound (or "inf" for the overflow bucket) to its count, along with
+            the count, total and max.
+        """
+        bounds = [str(b) for b in self.buckets] + ["inf"]
+        return {
+            "buckets": dict(zip(bounds, self.counts)),
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+        }
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""A single place through which all JSON encoding and decoding goes.
+
+If `simplejson` (which ships C speedups) is installed it is used to encode,
+otherwise we fall back to the stdlib `json` module. Both are configured so
+that the bytes produced are identical to those of
+`syutil.jsonutil.encode_canonical_json` and friends.
+
+Decoding always uses the stdlib module, which is C accelerated in python 2.7.
+`simplejson` is not used to decode because it returns `str` rather than
+`unicode` for ASCII strings, which would break the type checks done on event
+content.
+"""
+
+import collections
+import json
+
+try:
+    import simplejson
+    _encoder = simplejson
+    # simplejson would otherwise encode namedtuples as JSON objects rather
+    # than arrays, which differs from the stdlib.
+    _encoder_args = {"namedtuple_as_object": False}
+    backend_name = "simplejson"
+except ImportError:
+    _encoder = json
+    _encoder_args = {}
+    backend_name = "json"
+
+
+def encode_canonical_json(json_object):
+    """Encodes the given object as compact, key-sorted UTF-8 JSON.
+
+    Args:
+        json_object: The object to encode.
+    Returns:
+        bytes: The encoded JSON.
+    """
+    return _encoder.dumps(
+        json_object,
+        ensure_ascii=False,
+        separators=(',', ':'),
+        sort_keys=True,
+        **_encoder_args
+    ).encode("UTF-8")
+
+
+def encode_pretty_printed_json(json_object):
+    """Encodes the given object as indented, key-sorted UTF-8 JSON, for
+    showing to humans.
+
+    Args:
+        json_object: The object to encode.
+    Returns:
+        bytes: The encoded JSON.
+    """
+    return _encoder.dumps(
+        json_object,
+        sort_keys=True,
+        indent=4,
+        separators=(',', ': '),
+        **_encoder_args
+    ).encode("UTF-8")
+
+
+def encode_json(json_object):
+    """Encodes the given object using the default JSON formatting, as used
+    for the JSON we keep in the database.
+
+    Args:
+        json_object: The object to encode.
+    Returns:
+        str: The encoded JSON.
+    """
+    return _encoder.dumps(json_object, **_encoder_args)
+
+
+def decode_json(json_string):
+    """Decodes a JSON document.
+
+    Args:
+        json_string (str): The JSON to decode.
+    Returns:
+        The decoded object. Strings are always returned as `unicode`.
+    Raises:
+        ValueError if the JSON is invalid.
+    """
+    return json.loads(json_string)
+
+
+def decode_json_with_list_iter(json_string, list_key):
+    """Decodes a JSON object, handing out the items of the list stored under
+    `list_key` one at a time through an iterator.
+
+    Each item is released as it is taken, so that for large documents (such
+    as federation transactions with many PDUs) the items which have already
+    been processed can be freed while the rest are worked through.
+
+    Args:
+        json_string (str): The JSON to decode. It must be an object.
+        list_key (str): The key of the list to iterate over.
+    Returns:
+        A 2-tuple of the decoded object (without `list_key`) and an iterator
+        over the items of the list. The iterator is empty if the key was not
+        present.
+    Raises:
+        ValueError if the JSON is invalid.
+    """
+    obj = json.loads(json_string)
+    if not isinstance(obj, dict):
+        raise ValueError("Expected a JSON object")
+
+    pending = collections.deque()
+    if isinstance(obj.get(list_key), list):
+        pending.extend(obj.pop(list_key))
+
+    def items():
+        while pending:
+            yield pending.popleft()
+
+    return obj, items()
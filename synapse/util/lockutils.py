@@ -2,20 +2,34 @@
 
 from twisted.internet import defer
 
+from synapse.util import Clock
+from synapse.util.histogram import Histogram
+
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
+# The upper bounds, in milliseconds, of the buckets used to record how long
+# locks are waited for and held.
+LOCK_TIME_BUCKETS = [1, 10, 100, 1000, 10000]
+
+# How long, in milliseconds, a lock can be held for before we warn about it.
+WARN_HOLD_TIME = 1000
+
+
 class Lock(object):
 
-    def __init__(self, deferred):
+    def __init__(self, deferred, on_release=None):
         self._deferred = deferred
+        self._on_release = on_release
         self.released = False
 
     def release(self):
         self.released = True
+        if self._on_release:
+            self._on_release()
         self._deferred.callback(None)
 
     def __del__(self):
@@ -31,11 +45,38 @@ class Lock(object):
 
 
 class LockManager(object):
-    """ Utility class that allows us to lock based on a `key` """
+    """ Utility class that allows us to lock based on a `key`
+
+    Keeps statistics on how the locks are used, and warns about any lock that
+    is held for longer than `warn_hold_time`.
+
+    Attributes:
+        acquired (int): The number of times a lock has been acquired.
+        contended (int): How many of those had to wait for another holder.
+        wait_times (Histogram): How long, in milliseconds, each acquisition
+            waited.
+        hold_times (Histogram): How long, in milliseconds, each lock was held.
+    """
+
+    def __init__(self, name="lock", clock=None, warn_hold_time=WARN_HOLD_TIME):
+        """
+        Args:
+            name (str): What kind of keys are being locked, for logging.
+            clock (synapse.util.Clock): Used to time the locks.
+            warn_hold_time (int): How long, in milliseconds, a lock can be
+                held for before we log a warning.
+        """
+        self.name = name
+        self.clock = clock or Clock()
+        self.warn_hold_time = warn_hold_time
 
-    def __init__(self):
         self._lock_deferreds = {}
 
+        self.acquired = 0
+        self.contended = 0
+        self.wait_times = Histogram(LOCK_TIME_BUCKETS)
+        self.hold_times = Histogram(LOCK_TIME_BUCKETS)
+
     @defer.inlineCallbacks
     def lock(self, key):
         """ Allows us to block until it is our turn.
@@ -48,7 +89,27 @@ class LockManager(object):
         old_deferred = self._lock_deferreds.get(key)
         self._lock_deferreds[key] = new_deferred
 
+        requested_at = self.clock.time_msec()
+
         if old_deferred:
+            self.contended += 1
             yield old_deferred
 
-        defer.returnValue(Lock(new_deferred))
+        acquired_at = self.clock.time_msec()
+        self.acquired += 1
+        self.wait_times.add(acquired_at - requested_at)
+
+        def on_release():
+            held_for = self.clock.time_msec() - acquired_at
+            self.hold_times.add(held_for)
+
+            if held_for > self.warn_hold_time:
+                logger.warn(
+                    "%s %r was held for %dms", self.name, key, held_for
+                )
+
+            # Forget the key if nobody else is waiting for it.
+            if self._lock_deferreds.get(key) is new_deferred:
+                del self._lock_deferreds[key]
+
+        defer.returnValue(Lock(new_deferred, on_release))
@@ -2,22 +2,174 @@
 
 from inspect import getcallargs
 
+import functools
 import logging
+import sys
+import types
+
+
+# Maps module name prefixes to whether calls to `log_function` decorated
+# functions in those modules should be logged. The longest matching prefix
+# wins, and modules with no matching prefix are logged.
+_function_logging_rules = {}
+
+# Maps the names of all modules which have `log_function` decorated functions
+# to a list of (function, logging wrapper) pairs for them.
+_function_logging_modules = {}
+
+# The names of the modules whose decorated functions are currently not logged.
+_function_logging_disabled = set()
+
+
+def _is_function_logging_enabled(module_name):
+    match = None
+    for prefix in _function_logging_rules:
+        if module_name == prefix or module_name.startswith(prefix + "."):
+            if match is None or len(prefix) > len(match):
+                match = prefix
+
+    if match is None:
+        return True
+    return _function_logging_rules[match]
+
+
+def _make_cell(value):
+    return (lambda: value).func_closure[0]
+
+
+def _rebind(obj, replacements, seen):
+    """ Returns a copy of `obj` which uses the functions in `replacements`
+    wherever `obj` is, or closes over, one of the keys. Returns None if `obj`
+    doesn't use any of them. `seen` caches the results for functions that
+    have already been looked at.
+    """
+    if isinstance(obj, (staticmethod, classmethod)):
+        func = _rebind(obj.__func__, replacements, seen)
+        if func is None:
+            return None
+        return type(obj)(func)
+
+    if not isinstance(obj, types.FunctionType):
+        return None
+    if obj in replacements:
+        return replacements[obj]
+    if obj in seen:
+        return seen[obj]
+
+    seen[obj] = None
+
+    # Functions wrapped by other decorators (e.g. `defer.inlineCallbacks`)
+    # hold on to the function they wrap in their closure.
+    changed = False
+    cells = []
+    for cell in obj.func_closure or ():
+        try:
+            new = _rebind(cell.cell_contents, replacements, seen)
+        except ValueError:
+            # Cell is empty
+            new = None
+
+        if new is None:
+            cells.append(cell)
+        else:
+            cells.append(_make_cell(new))
+            changed = True
+
+    if not changed:
+        return None
+
+    new_obj = types.FunctionType(
+        obj.func_code, obj.func_globals, obj.func_name, obj.func_defaults,
+        tuple(cells)
+    )
+    new_obj.__doc__ = obj.__doc__
+    new_obj.__dict__.update(obj.__dict__)
+    seen[obj] = new_obj
+    return new_obj
+
+
+def _rebind_module(module_name, replacements):
+    """ Swaps the decorated functions in a module's namespace, and in the
+    namespaces of the classes defined in it, according to `replacements`.
+    """
+    module = sys.modules.get(module_name)
+    if module is None:
+        return
+
+    namespaces = [module]
+    for value in vars(module).values():
+        if isinstance(value, (type, types.ClassType)) and (
+            value.__module__ == module_name
+        ):
+            namespaces.append(value)
+
+    # Don't look inside the functions we are swapping in.
+    seen = dict((f, None) for f in replacements.values())
+    for namespace in namespaces:
+        for key, value in vars(namespace).items():
+            new = _rebind(value, replacements, seen)
+            if new is not None:
+                setattr(namespace, key, new)
+
+
+def set_function_logging(module_name, enabled):
+    """ Turns the logging done by `log_function` on or off for a module and
+    all of its submodules. This can be called at any time, and also applies to
+    modules that are imported later.
+
+    Decorated functions in modules for which logging is off are not wrapped at
+    all, so this swaps the wrapped and unwrapped functions in the affected
+    modules and their classes. References that were taken before the switch,
+    such as bound methods already handed out as callbacks, are not updated.
+
+    Args:
+        module_name (str): The module or package name, e.g. "synapse.storage"
+        enabled (bool): Whether calls should be logged.
+    """
+    _function_logging_rules[module_name] = enabled
+
+    for name, functions in _function_logging_modules.items():
+        if _is_function_logging_enabled(name):
+            if name not in _function_logging_disabled:
+                continue
+            _function_logging_disabled.discard(name)
+            replacements = dict(functions)
+        else:
+            if name in _function_logging_disabled:
+                continue
+            _function_logging_disabled.add(name)
+            replacements = dict((w, f) for f, w in functions)
+
+        _rebind_module(name, replacements)
 
 
 def log_function(f):
     """ Function decorator that logs every call to that function.
+
+    Calls are logged at DEBUG level to the logger of the module the function
+    is defined in, and only while function logging is enabled for that module
+    (see `set_function_logging`).
+
+    If function logging is off for the module when the function is decorated,
+    or python is run with optimisations turned on (-O), this returns the
+    function unchanged, so there is no overhead at all.
     """
+    if not __debug__:
+        return f
+
+    name = f.__module__
+    logger = logging.getLogger(name)
+    level = logging.DEBUG
+
     func_name = f.__name__
     lineno = f.func_code.co_firstlineno
     pathname = f.func_code.co_filename
 
+    @functools.wraps(f)
     def wrapped(*args, **kwargs):
-        name = f.__module__
-        logger = logging.getLogger(name)
-        level = logging.DEBUG
-
-        if logger.isEnabledFor(level):
+        if name not in _function_logging_disabled and (
+            logger.isEnabledFor(level)
+        ):
             bound_args = getcallargs(f, *args, **kwargs)
 
             def format(value):
@@ -49,4 +201,10 @@ def log_function(f):
 
         return f(*args, **kwargs)
 
+    _function_logging_modules.setdefault(name, []).append((f, wrapped))
+
+    if not _is_function_logging_enabled(name):
+        _function_logging_disabled.add(name)
+        return f
+
     return wrapped
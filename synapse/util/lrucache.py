@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+import collections
+
+
+class LruCache(object):
+    """A size-bounded mapping which evicts the least recently used entry once
+    it is full. Entries can optionally also expire after a given age.
+
+    Keeps count of cache hits and misses so that callers can judge how
+    effective the cache is.
+    """
+
+    def __init__(self, max_size, max_age=None, clock=None):
+        """
+        Args:
+            max_size (int): The maximum number of entries to hold.
+            max_age (float): If given, the number of seconds after which an
+                entry is treated as missing. Requires `clock`.
+            clock (synapse.util.Clock): Used to find out how old entries are.
+        """
+        self.max_size = max_size
+        self.max_age = max_age
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+
+        # Maps keys to 2-tuples of (value, time added). Entries are kept in
+        # order of use, least recently used first.
+        self._cache = collections.OrderedDict()
+
+    def _now(self):
+        if self.max_age is None:
+            return None
+        return self.clock.time()
+
+    def get(self, key, default=None):
+        """Retrieve an entry, marking it as the most recently used.
+
+        Args:
+            key: The key to look up.
+            default: What to return if the key is not cached.
+        Returns:
+            The cached value, or `default`.
+        """
+        try:
+            value, added = self._cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if self.max_age is not None and added + self.max_age <= self._now():
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._cache[key] = (value, added)
+        return value
+
+    def set(self, key, value):
+        """Add or replace an entry, evicting the oldest entries if necessary.
+
+        Args:
+            key: The key to store the value under.
+            value: The value to store.
+        """
+        self._cache.pop(key, None)
+        self._cache[key] = (value, self._now())
+
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove an entry from the cache.
+
+        Args:
+            key: The key to remove.
+            default: What to return if the key is not cached.
+        Returns:
+            The removed value, or `default`.
+        """
+        try:
+            return self._cache.pop(key)[0]
+        except KeyError:
+            return default
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        self._cache.clear()
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def __len__(self):
+        return len(self._cache)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+from synapse.api.errors import LimitExceededError
+from synapse.util.histogram import Histogram
+
+import bcrypt
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+# The upper bounds, in milliseconds, of the buckets used to record how long
+# hashing requests wait for a thread.
+WAIT_TIME_BUCKETS = [1, 5, 10, 50, 100, 500, 1000, 5000]
+
+
+class PasswordHasher(object):
+    """Hashes and checks passwords with bcrypt on a dedicated pool of threads,
+    so that the deliberately slow hashing doesn't block the reactor.
+
+    At most `threads` passwords are hashed at once, and at most `queue_size`
+    more wait for a free thread. Further requests are rejected with a
+    LimitExceededError rather than being queued indefinitely.
+
+    Attributes:
+        wait_times (Histogram): How long, in milliseconds, requests waited
+            for a thread.
+        rejected (int): The number of requests rejected because the queue was
+            full.
+    """
+
+    def __init__(self, clock, threads=4, queue_size=50):
+        """
+        Args:
+            clock (synapse.util.Clock)
+            threads (int): The number of threads to hash on.
+            queue_size (int): The number of requests which may wait for a
+                thread before new ones are rejected.
+        """
+        self.clock = clock
+        self.threads = threads
+        self.queue_size = queue_size
+
+        self.wait_times = Histogram(WAIT_TIME_BUCKETS)
+        self.rejected = 0
+
+        # The number of requests which are either waiting for or running on a
+        # thread.
+        self._pending = 0
+
+        # The pool is only started when first needed.
+        self._pool = None
+
+    def hash(self, password):
+        """Hashes a password with a new salt.
+
+        Args:
+            password (str): The password to hash.
+        Returns:
+            Deferred: Resolves to the hash.
+        Raises:
+            LimitExceededError if too many requests are already waiting.
+        """
+        return self._run(
+            lambda: bcrypt.hashpw(password, bcrypt.gensalt())
+        )
+
+    def check(self, password, stored_hash):
+        """Checks a password against a hash.
+
+        Args:
+            password (str): The password to check.
+            stored_hash (str): The hash to check against.
+        Returns:
+            Deferred: Resolves to whether the password matches.
+        Raises:
+            LimitExceededError if too many requests are already waiting.
+        """
+        return self._run(
+            lambda: bcrypt.checkpw(password, stored_hash)
+        )
+
+    def stop(self):
+        """Stops the thread pool, waiting for running requests to finish."""
+        if self._pool is not None:
+            self._pool.stop()
+            self._pool = None
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ThreadPool(
+                minthreads=0, maxthreads=self.threads, name="password-hasher"
+            )
+            self._pool.start()
+            reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+        return self._pool
+
+    def _run(self, f):
+        """Runs `f` on the thread pool, unless the queue is full.
+
+        Returns:
+            Deferred: Resolves to the result of `f`.
+        """
+        if self._pending >= self.threads + self.queue_size:
+            self.rejected += 1
+            logger.warn(
+                "Rejecting password hashing request: %d already pending",
+                self._pending
+            )
+            raise LimitExceededError()
+
+        self._pending += 1
+        queued = self.clock.time_msec()
+
+        def run():
+            # Runs on the pool thread. The histogram is only updated from the
+            # reactor thread, so just hand back when we started.
+            return (self.clock.time_msec(), f())
+
+        def on_done(res):
+            started, result = res
+            self.wait_times.add(started - queued)
+            return result
+
+        def on_finished(res):
+            self._pending -= 1
+            return res
+
+        d = deferToThreadPool(reactor, self._get_pool(), run)
+        d.addCallback(on_done)
+        d.addBoth(on_finished)
+        return d
@@ -11,6 +11,7 @@ from ..utils import MockHttpServer
 from synapse.server import HomeServer
 from synapse.federation import initialize_http_replication
 from synapse.federation.units import Pdu
+from synapse.federation.replication import EduCoalescer
 from synapse.storage.pdu import PduTuple, PduEntry
 
 
@@ -37,12 +38,29 @@ def make_pdu(prev_pdus=[], **kwargs):
 class MockClock(object):
     now = 1000
 
+    def __init__(self):
+        self.timers = []
+
     def time(self):
         return self.now
 
     def time_msec(self):
         return self.time() * 1000
 
+    def call_later(self, delay, callback):
+        timer = [delay, callback]
+        self.timers.append(timer)
+        return timer
+
+    def cancel_call_later(self, timer):
+        self.timers.remove(timer)
+
+    def advance(self):
+        """Runs all the pending timers."""
+        timers, self.timers = self.timers, []
+        for _, callback in timers:
+            callback()
+
 
 class FederationTestCase(unittest.TestCase):
     def setUp(self):
@@ -53,8 +71,8 @@ class FederationTestCase(unittest.TestCase):
         self.mock_persistence = Mock(spec=[
             "get_current_state_for_context",
             "get_pdu",
+            "get_state_ancestors",
             "persist_pdu",
-            "update_min_depth_for_context",
             "prep_send_transaction",
             "delivered_txn",
             "get_received_txn_response",
@@ -142,6 +160,58 @@ class FederationTestCase(unittest.TestCase):
         self.assertEquals(1, len(response["pdus"]))
         self.assertEquals("m.text", response["pdus"][0]["pdu_type"])
 
+    @defer.inlineCallbacks
+    def test_get_state_ancestors(self):
+        self.mock_persistence.get_state_ancestors.return_value = (
+            defer.succeed([
+                make_pdu(
+                    pdu_id="abc123def456",
+                    origin="red",
+                    context="my-context",
+                    pdu_type="m.topic",
+                    ts=123456789001,
+                    depth=3,
+                    is_state=True,
+                    content_json='{"topic":"The topic"}',
+                    state_key="",
+                    power_level=1000,
+                    prev_state_id="older",
+                    prev_state_origin="red",
+                ),
+                make_pdu(
+                    pdu_id="older",
+                    origin="red",
+                    context="my-context",
+                    pdu_type="m.topic",
+                    ts=123456789000,
+                    depth=2,
+                    is_state=True,
+                    content_json='{"topic":"An old topic"}',
+                    state_key="",
+                    power_level=1000,
+                ),
+            ])
+        )
+
+        (code, response) = yield self.mock_http_server.trigger("GET",
+                "/state_ancestors/red/abc123def456/?min_depth=2", None)
+        self.assertEquals(200, code)
+        self.assertEquals(
+            ["abc123def456", "older"],
+            [p["pdu_id"] for p in response["pdus"]]
+        )
+
+        self.mock_persistence.get_state_ancestors.assert_called_with(
+            "abc123def456", "red", 2, 1000
+        )
+
+    @defer.inlineCallbacks
+    def test_get_state_ancestors_bad_min_depth(self):
+        (code, response) = yield self.mock_http_server.trigger("GET",
+                "/state_ancestors/red/abc123def456/?min_depth=two", None)
+        self.assertEquals(400, code)
+        self.assertFalse(self.mock_persistence.get_state_ancestors.called)
+
     @defer.inlineCallbacks
     def test_send_pdu(self):
         self.mock_http_client.put_json.return_value = defer.succeed(
@@ -183,6 +253,42 @@ class FederationTestCase(unittest.TestCase):
                 }
         )
 
+    @defer.inlineCallbacks
+    def test_send_pdu_after(self):
+        self.mock_http_client.put_json.return_value = defer.succeed(
+                (200, "OK")
+        )
+
+        def make_pdu(pdu_id):
+            return Pdu(
+                    pdu_id=pdu_id,
+                    origin="red",
+                    destinations=["remote"],
+                    context="my-context",
+                    ts=123456789002,
+                    pdu_type="m.test",
+                    content={"testing": "content here"},
+                    depth=1,
+            )
+
+        stored = defer.Deferred()
+        yield self.federation.send_pdu(make_pdu("a"), send_after=stored)
+
+        # Not sent until the event has been stored.
+        self.assertFalse(self.mock_http_client.put_json.called)
+
+        stored.callback(5)
+        self.assertEquals(1, self.mock_http_client.put_json.call_count)
+        self.assertEquals(5, (yield stored))
+
+        failed = defer.Deferred()
+        yield self.federation.send_pdu(make_pdu("b"), send_after=failed)
+
+        # Nor at all if storing it failed.
+        failed.errback(Exception("Disk full"))
+        yield self.assertFailure(failed, Exception)
+        self.assertEquals(1, self.mock_http_client.put_json.call_count)
+
     @defer.inlineCallbacks
     def test_send_edu(self):
         self.mock_http_client.put_json.return_value = defer.succeed(
@@ -238,3 +344,217 @@ class FederationTestCase(unittest.TestCase):
         recv_observer.assert_called_with(
                 "remote", {"testing": "reply here"}
         )
+
+    @defer.inlineCallbacks
+    def test_recv_too_large(self):
+        self.federation.transport_layer.max_body_size = 10
+
+        (code, response) = yield self.mock_http_server.trigger(
+                "PUT", "/send/1001000/",
+                """{
+                    "origin": "remote",
+                    "ts": 1001000,
+                    "pdus": []
+                }""")
+
+        self.assertEquals(413, code)
+        self.assertFalse(
+            self.mock_persistence.get_received_txn_response.called
+        )
+
+    @defer.inlineCallbacks
+    def test_recv_duplicate(self):
+        body = """{
+            "origin": "remote",
+            "ts": 1001000,
+            "pdus": []
+        }"""
+
+        first = yield self.mock_http_server.trigger(
+            "PUT", "/send/1001000/", body
+        )
+        second = yield self.mock_http_server.trigger(
+            "PUT", "/send/1001000/", body
+        )
+
+        self.assertEquals((200, {"pdus": []}), first)
+        self.assertEquals(first, second)
+        self.assertEquals(
+            1, self.mock_persistence.get_received_txn_response.call_count
+        )
+        set_response = self.mock_persistence.set_received_txn_response
+        set_response.assert_called_once_with(
+            "1001000", "remote", 1001000, 200, '{"pdus": []}'
+        )
+        self.assertEquals(
+            1, self.federation.transaction_actions.response_cache.hits
+        )
+
+    @defer.inlineCallbacks
+    def test_recv_duplicate_in_flight(self):
+        body = """{
+            "origin": "remote",
+            "ts": 1001000,
+            "pdus": []
+        }"""
+
+        lookup = defer.Deferred()
+        self.mock_persistence.get_received_txn_response.return_value = lookup
+
+        first = self.mock_http_server.trigger("PUT", "/send/1001000/", body)
+        second = self.mock_http_server.trigger("PUT", "/send/1001000/", body)
+
+        lookup.callback(None)
+
+        self.assertEquals((200, {"pdus": []}), (yield first))
+        self.assertEquals((200, {"pdus": []}), (yield second))
+        self.assertEquals(
+            1, self.mock_persistence.get_received_txn_response.call_count
+        )
+        self.assertEquals(
+            1, self.mock_persistence.set_received_txn_response.call_count
+        )
+
+
+class PushCoalescer(EduCoalescer):
+    def start(self, content):
+        if "push" not in content:
+            return None
+        return list(content["push"])
+
+    def merge(self, pushes, content):
+        if "push" not in content:
+            return False
+        pushes.extend(content["push"])
+        return True
+
+    def finish(self, pushes):
+        return {"push": pushes}
+
+
+class EduCoalescingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_http_client = Mock(spec=[
+            "put_json",
+        ])
+        self.mock_http_client.put_json.side_effect = (
+                lambda *args, **kwargs: defer.succeed((200, "OK"))
+        )
+        self.mock_persistence = Mock(spec=[
+            "prep_send_transaction",
+            "delivered_txn",
+        ])
+        self.clock = MockClock()
+        hs = HomeServer("test",
+                http_server=MockHttpServer(),
+                http_client=self.mock_http_client,
+                db_pool=None,
+                datastore=self.mock_persistence,
+                clock=self.clock,
+        )
+        self.federation = initialize_http_replication(hs)
+        self.federation.register_edu_coalescer("m.test", PushCoalescer())
+
+    def sent_edus(self):
+        return [
+            c[1]["data"]["edus"]
+            for c in self.mock_http_client.put_json.call_args_list
+        ]
+
+    def test_held_back_and_merged(self):
+        self.federation.send_edu("remote", "m.test", {"push": [1]})
+        self.federation.send_edu("remote", "m.test", {"push": [2]})
+        self.federation.send_edu("other", "m.test", {"push": [3]})
+
+        self.assertFalse(self.mock_http_client.put_json.called)
+
+        self.clock.advance()
+
+        self.assertEquals([
+            [{
+                "origin": "test",
+                "destination": "remote",
+                "edu_type": "m.test",
+                "content": {"push": [1, 2]},
+            }],
+            [{
+                "origin": "test",
+                "destination": "other",
+                "edu_type": "m.test",
+                "content": {"push": [3]},
+            }],
+        ], self.sent_edus())
+        self.assertEquals(
+            1, self.federation._transaction_queue.coalesced_edus
+        )
+
+    def test_not_merged(self):
+        self.federation.send_edu("remote", "m.test", {"push": [1]})
+        self.federation.send_edu("remote", "m.test", {"poll": [2]})
+
+        self.clock.advance()
+
+        self.assertEquals([[
+            {
+                "origin": "test",
+                "destination": "remote",
+                "edu_type": "m.test",
+                "content": {"push": [1]},
+            },
+            {
+                "origin": "test",
+                "destination": "remote",
+                "edu_type": "m.test",
+                "content": {"poll": [2]},
+            },
+        ]], self.sent_edus())
+
+    def test_not_merged_past_later_edus(self):
+        self.federation.send_edu("remote", "m.test", {"push": [1]})
+        self.federation.send_edu("remote", "m.test", {"poll": [2]})
+        self.federation.send_edu("remote", "m.test", {"push": [3]})
+        self.federation.send_edu("remote", "m.test", {"push": [4]})
+
+        self.clock.advance()
+
+        self.assertEquals([[
+            {
+                "origin": "test",
+                "destination": "remote",
+                "edu_type": "m.test",
+                "content": {"push": [1]},
+            },
+            {
+                "origin": "test",
+                "destination": "remote",
+                "edu_type": "m.test",
+                "content": {"poll": [2]},
+            },
+            {
+                "origin": "test",
+                "destination": "remote",
+                "edu_type": "m.test",
+                "content": {"push": [3, 4]},
+            },
+        ]], self.sent_edus())
+
+    def test_other_types_not_held_back(self):
+        self.federation.send_edu("remote", "m.test", {"push": [1]})
+        self.federation.send_edu("remote", "m.other", {"testing": 2})
+
+        # The held back EDU rides along with the other one.
+        self.assertEquals([[
+            {
+                "origin": "test",
+                "destination": "remote",
+                "edu_type": "m.test",
+                "content": {"push": [1]},
+            },
+            {
+                "origin": "test",
+                "destination": "remote",
+                "edu_type": "m.other",
+                "content": {"testing": 2},
+            },
+        ]], self.sent_edus())
+        self.assertEquals([], self.clock.timers)
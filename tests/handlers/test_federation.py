@@ -105,3 +105,25 @@ class FederationTestCase(unittest.TestCase):
 
         mem_handler = self.handlers.room_member_handler
         self.assertEquals(0, mem_handler.change_membership.call_count)
+
+    @defer.inlineCallbacks
+    def test_member(self):
+        event = self.hs.get_event_factory().create_event(
+            etype=RoomMemberEvent.TYPE,
+            user_id="@bob:red",
+            target_user_id="@bob:red",
+            room_id="foo",
+            membership=Membership.JOIN,
+            content={"membership": Membership.JOIN},
+        )
+
+        self.datastore.persist_event.return_value = defer.succeed("ASD")
+
+        yield self.handlers.federation_handler.on_receive(event, True)
+
+        self.datastore.persist_event.assert_called_once_with(event)
+
+        mem_handler = self.handlers.room_member_handler
+        mem_handler.on_membership_changed.assert_called_once_with(
+            "foo", self.hs.parse_userid("@bob:red"), Membership.JOIN
+        )
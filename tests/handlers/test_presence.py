@@ -9,7 +9,9 @@ import logging
 from synapse.server import HomeServer
 from synapse.api.constants import PresenceState
 from synapse.api.errors import SynapseError
-from synapse.handlers.presence import PresenceHandler, UserPresenceCache
+from synapse.handlers.presence import (
+    PresenceHandler, UserPresenceCache, PresenceEduCoalescer
+)
 
 
 OFFLINE = PresenceState.OFFLINE
@@ -27,6 +29,9 @@ class MockReplication(object):
     def register_edu_handler(self, edu_type, handler):
         self.edu_handlers[edu_type] = handler
 
+    def register_edu_coalescer(self, edu_type, coalescer):
+        pass
+
     def received_edu(self, origin, edu_type, content):
         self.edu_handlers[edu_type](origin, content)
 
@@ -44,13 +49,17 @@ class PresenceStateTestCase(unittest.TestCase):
                 db_pool=None,
                 datastore=Mock(spec=[
                     "get_presence_state",
-                    "set_presence_state",
+                    "set_presence_states",
                     "add_presence_list_pending",
                     "set_presence_list_accepted",
                 ]),
                 handlers=None,
                 http_server=Mock(),
                 http_client=None,
+                replication_layer=MockReplication(),
+                clock=Mock(spec=[
+                    "call_later", "cancel_call_later",
+                ]),
             )
         hs.handlers = JustPresenceHandlers(hs)
 
@@ -71,10 +80,10 @@ class PresenceStateTestCase(unittest.TestCase):
         self.handler = hs.get_handlers().presence_handler
 
         hs.handlers.room_member_handler = Mock(spec=[
-            "get_rooms_for_user",
+            "fetch_co_member_distributions_into",
         ])
-        hs.handlers.room_member_handler.get_rooms_for_user = (
-                lambda u: defer.succeed([]))
+        hs.handlers.room_member_handler.fetch_co_member_distributions_into = (
+                lambda u, **kwargs: defer.succeed(None))
 
         self.mock_start = Mock()
         self.mock_stop = Mock()
@@ -130,15 +139,13 @@ class PresenceStateTestCase(unittest.TestCase):
 
     @defer.inlineCallbacks
     def test_set_my_state(self):
-        mocked_set = self.datastore.set_presence_state
-        mocked_set.return_value = defer.succeed({"state": OFFLINE})
+        mocked_set = self.datastore.set_presence_states
+        mocked_set.return_value = defer.succeed(None)
 
         yield self.handler.set_state(
                 target_user=self.u_apple, auth_user=self.u_apple,
                 state={"state": BUSY, "status_msg": "Away"})
 
-        mocked_set.assert_called_with("apple",
-                {"state": 1, "status_msg": "Away"})
         self.mock_start.assert_called_with(self.u_apple,
                 state={"state": 1, "status_msg": "Away"})
 
@@ -148,6 +155,164 @@ class PresenceStateTestCase(unittest.TestCase):
 
         self.mock_stop.assert_called_with(self.u_apple)
 
+        # The state is only written once flushed, and then only the latest.
+        self.assertFalse(mocked_set.called)
+
+        yield self.handler.flush_presence()
+
+        mocked_set.assert_called_once_with({
+            "apple": {"state": OFFLINE, "status_msg": None},
+        })
+
+    @defer.inlineCallbacks
+    def test_get_unflushed_state(self):
+        yield self.handler.set_state(
+                target_user=self.u_apple, auth_user=self.u_apple,
+                state={"state": BUSY, "status_msg": "Away"})
+
+        state = yield self.handler.get_state(
+            target_user=self.u_apple, auth_user=self.u_apple
+        )
+
+        self.assertEquals({"state": BUSY, "status_msg": "Away"}, state)
+        self.assertFalse(self.datastore.get_presence_state.called)
+
+    @defer.inlineCallbacks
+    def test_flush_failure_retried(self):
+        self.datastore.set_presence_states.return_value = defer.fail(
+            Exception("Database is locked")
+        )
+
+        yield self.handler.set_state(
+                target_user=self.u_apple, auth_user=self.u_apple,
+                state={"state": BUSY, "status_msg": "Away"})
+        yield self.handler.flush_presence()
+
+        self.datastore.set_presence_states.return_value = defer.succeed(None)
+        yield self.handler.flush_presence()
+
+        self.datastore.set_presence_states.assert_called_with({
+            "apple": {"state": BUSY, "status_msg": "Away"},
+        })
+
+
+class PresenceChangeLogTestCase(unittest.TestCase):
+    """ Tests the log of presence cache changes. """
+
+    def setUp(self):
+        hs = HomeServer("test",
+                db_pool=None,
+                datastore=Mock(spec=[]),
+                handlers=None,
+                http_server=Mock(),
+                http_client=None,
+                replication_layer=MockReplication(),
+            )
+        hs.handlers = JustPresenceHandlers(hs)
+
+        self.handler = hs.get_handlers().presence_handler
+
+        self.u_apple = hs.parse_userid("@apple:test")
+        self.u_banana = hs.parse_userid("@banana:test")
+        self.u_clementine = hs.parse_userid("@clementine:test")
+
+    def change(self, user, state):
+        statuscache = self.handler._get_or_make_usercache(user)
+        self.handler._update_usercache(user, statuscache, {"state": state})
+
+    def changed_users(self, from_key, to_key, limit=0):
+        return [
+            user for user, _ in
+            self.handler.get_changes(from_key, to_key, limit)
+        ]
+
+    def test_get_changes(self):
+        self.change(self.u_apple, ONLINE)
+        self.change(self.u_banana, ONLINE)
+        self.change(self.u_clementine, ONLINE)
+
+        self.assertEquals(
+            [self.u_apple, self.u_banana, self.u_clementine],
+            self.changed_users(0, 3)
+        )
+        self.assertEquals([self.u_banana], self.changed_users(1, 2))
+        self.assertEquals([], self.changed_users(3, 4))
+
+    def test_superseded(self):
+        self.change(self.u_apple, ONLINE)
+        self.change(self.u_banana, ONLINE)
+        self.change(self.u_apple, BUSY)
+
+        self.assertEquals(
+            [self.u_banana, self.u_apple], self.changed_users(0, 3)
+        )
+
+        # Apple's latest change is outside the range, so the earlier one is
+        # not reported either.
+        self.assertEquals([self.u_banana], self.changed_users(0, 2))
+
+    def test_limit(self):
+        self.change(self.u_apple, ONLINE)
+        self.change(self.u_banana, ONLINE)
+        self.change(self.u_clementine, ONLINE)
+
+        self.assertEquals(
+            [self.u_apple, self.u_banana], self.changed_users(0, 3, limit=2)
+        )
+
+    def test_compaction(self):
+        for _ in range(2000):
+            self.change(self.u_apple, ONLINE)
+        self.change(self.u_banana, ONLINE)
+
+        self.assertTrue(
+            len(self.handler._user_cachemap_change_serials) <= 1000
+        )
+        self.assertEquals(
+            [self.u_apple, self.u_banana], self.changed_users(0, 2001)
+        )
+
+
+class PresenceEduCoalescerTestCase(unittest.TestCase):
+    """ Tests merging m.presence EDUs. """
+
+    def setUp(self):
+        self.coalescer = PresenceEduCoalescer()
+
+    def test_merge(self):
+        pushes = self.coalescer.start({"push": [
+            {"user_id": "@apple:test", "state": ONLINE,
+             "status_msg": "Here"},
+            {"user_id": "@banana:test", "state": ONLINE},
+        ]})
+
+        self.assertTrue(self.coalescer.merge(pushes, {"push": [
+            {"user_id": "@apple:test", "state": BUSY},
+            {"user_id": "@clementine:test", "state": ONLINE},
+        ]}))
+
+        self.assertEquals({"push": [
+            {"user_id": "@apple:test", "state": BUSY},
+            {"user_id": "@banana:test", "state": ONLINE},
+            {"user_id": "@clementine:test", "state": ONLINE},
+        ]}, self.coalescer.finish(pushes))
+
+    def test_polls_not_merged(self):
+        pushes = self.coalescer.start(
+            {"push": [{"user_id": "@apple:test", "state": ONLINE}]}
+        )
+        self.assertFalse(self.coalescer.merge(
+            pushes, {"poll": ["@potato:remote"]}
+        ))
+        self.assertEquals(
+            {"push": [{"user_id": "@apple:test", "state": ONLINE}]},
+            self.coalescer.finish(pushes)
+        )
+
+        self.assertIsNone(self.coalescer.start(
+            {"unpoll": ["@potato:remote"]}
+        ))
+
 
 class PresenceInvitesTestCase(unittest.TestCase):
     """ Tests presence management. """
@@ -375,12 +540,15 @@ class PresencePushTestCase(unittest.TestCase):
         hs = HomeServer("test",
                 db_pool=None,
                 datastore=Mock(spec=[
-                    "set_presence_state",
+                    "set_presence_states",
                 ]),
                 handlers=None,
                 http_server=Mock(),
                 http_client=None,
                 replication_layer=self.replication,
+                clock=Mock(spec=[
+                    "call_later", "cancel_call_later",
+                ]),
             )
         hs.handlers = JustPresenceHandlers(hs)
 
@@ -395,6 +563,8 @@ class PresencePushTestCase(unittest.TestCase):
         hs.handlers.room_member_handler = Mock(spec=[
             "get_rooms_for_user",
             "get_room_members",
+            "fetch_room_distributions_into",
+            "fetch_co_member_distributions_into",
         ])
         self.room_member_handler = hs.handlers.room_member_handler
 
@@ -432,6 +602,17 @@ class PresencePushTestCase(unittest.TestCase):
         self.room_member_handler.fetch_room_distributions_into = (
                 fetch_room_distributions_into)
 
+        @defer.inlineCallbacks
+        def fetch_co_member_distributions_into(user, localusers=None,
+                remotedomains=None):
+            room_ids = yield get_rooms_for_user(user)
+            for room_id in room_ids:
+                yield fetch_room_distributions_into(room_id,
+                    localusers=localusers, remotedomains=remotedomains,
+                    ignore_user=user)
+        self.room_member_handler.fetch_co_member_distributions_into = (
+                fetch_co_member_distributions_into)
+
         def get_presence_list(user_localpart, accepted=None):
             if user_localpart == "apple":
                 return defer.succeed([
@@ -466,8 +647,6 @@ class PresencePushTestCase(unittest.TestCase):
     def test_push_local(self):
         self.room_members = [self.u_apple, self.u_elderberry]
 
-        self.datastore.set_presence_state.return_value = defer.succeed(
-                {"state": ONLINE})
 
         # TODO(paul): Gut-wrenching
         self.handler._user_cachemap[self.u_apple] = UserPresenceCache()
@@ -523,8 +702,6 @@ class PresencePushTestCase(unittest.TestCase):
     def test_push_remote(self):
         self.room_members = [self.u_apple, self.u_onion]
 
-        self.datastore.set_presence_state.return_value = defer.succeed(
-                {"state": ONLINE})
 
         # TODO(paul): Gut-wrenching
         self.handler._user_cachemap[self.u_apple] = UserPresenceCache()
@@ -586,6 +763,28 @@ class PresencePushTestCase(unittest.TestCase):
 
         self.assertEquals({"state": ONLINE}, state)
 
+    @defer.inlineCallbacks
+    def test_recv_remote_multiple(self):
+        self.room_members = [self.u_banana, self.u_potato]
+
+        # Nobody here is interested in onion, but that mustn't stop potato's
+        # push from being delivered.
+        yield self.replication.received_edu(
+                "remote", "m.presence", {
+                    "push": [
+                        {"user_id": "@onion:farm",
+                         "state": 2},
+                        {"user_id": "@potato:remote",
+                         "state": 2},
+                    ],
+                }
+        )
+
+        self.mock_update_client.assert_called_once_with(
+                observer_user=self.u_banana,
+                observed_user=self.u_potato,
+                statuscache=ANY)
+
     @defer.inlineCallbacks
     def test_join_room_local(self):
         self.room_members = [self.u_apple, self.u_banana]
@@ -696,6 +895,9 @@ class PresencePollingTestCase(unittest.TestCase):
                 http_server=Mock(),
                 http_client=None,
                 replication_layer=self.replication,
+                clock=Mock(spec=[
+                    "call_later", "cancel_call_later",
+                ]),
             )
         hs.handlers = JustPresenceHandlers(hs)
 
@@ -708,12 +910,13 @@ class PresencePollingTestCase(unittest.TestCase):
         self.handler.push_update_to_clients = self.mock_update_client
 
         hs.handlers.room_member_handler = Mock(spec=[
-            "get_rooms_for_user",
+            "fetch_co_member_distributions_into",
         ])
         # For this test no users are ever in rooms
-        def get_rooms_for_user(user):
-            return defer.succeed([])
-        hs.handlers.room_member_handler.get_rooms_for_user = get_rooms_for_user
+        def fetch_co_member_distributions_into(user, **kwargs):
+            return defer.succeed(None)
+        hs.handlers.room_member_handler.fetch_co_member_distributions_into = (
+                fetch_co_member_distributions_into)
 
         # Mocked database state
         # Local users always start offline
@@ -730,11 +933,11 @@ class PresencePollingTestCase(unittest.TestCase):
             )
         self.datastore.get_presence_state = get_presence_state
 
-        def set_presence_state(user_localpart, new_state):
-            was = self.current_user_state[user_localpart]
-            self.current_user_state[user_localpart] = new_state["state"]
-            return defer.succeed({"state": was})
-        self.datastore.set_presence_state = set_presence_state
+        def set_presence_states(states):
+            for user_localpart, new_state in states.items():
+                self.current_user_state[user_localpart] = new_state["state"]
+            return defer.succeed(None)
+        self.datastore.set_presence_states = set_presence_states
 
         def get_presence_list(user_localpart, accepted):
             return defer.succeed([
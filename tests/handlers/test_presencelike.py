@@ -29,6 +29,9 @@ class MockReplication(object):
     def register_edu_handler(self, edu_type, handler):
         self.edu_handlers[edu_type] = handler
 
+    def register_edu_coalescer(self, edu_type, coalescer):
+        pass
+
     def received_edu(self, origin, edu_type, content):
         self.edu_handlers[edu_type](origin, content)
 
@@ -45,7 +48,7 @@ class PresenceProfilelikeDataTestCase(unittest.TestCase):
         hs = HomeServer("test",
                 db_pool=None,
                 datastore=Mock(spec=[
-                    "set_presence_state",
+                    "set_presence_states",
 
                     "set_profile_displayname",
                 ]),
@@ -53,6 +56,9 @@ class PresenceProfilelikeDataTestCase(unittest.TestCase):
                 http_server=Mock(),
                 http_client=None,
                 replication_layer=MockReplication(),
+                clock=Mock(spec=[
+                    "call_later", "cancel_call_later",
+                ]),
             )
         hs.handlers = PresenceAndProfileHandlers(hs)
 
@@ -91,10 +97,10 @@ class PresenceProfilelikeDataTestCase(unittest.TestCase):
                 self.mock_update_client)
 
         hs.handlers.room_member_handler = Mock(spec=[
-            "get_rooms_for_user",
+            "fetch_co_member_distributions_into",
         ])
-        hs.handlers.room_member_handler.get_rooms_for_user = (
-                lambda u: defer.succeed([]))
+        hs.handlers.room_member_handler.fetch_co_member_distributions_into = (
+                lambda u, **kwargs: defer.succeed(None))
 
         # Some local users to test with
         self.u_apple = hs.parse_userid("@apple:test")
@@ -106,15 +112,18 @@ class PresenceProfilelikeDataTestCase(unittest.TestCase):
 
     @defer.inlineCallbacks
     def test_set_my_state(self):
-        mocked_set = self.datastore.set_presence_state
-        mocked_set.return_value = defer.succeed({"state": OFFLINE})
+        mocked_set = self.datastore.set_presence_states
+        mocked_set.return_value = defer.succeed(None)
 
         yield self.handlers.presence_handler.set_state(
                 target_user=self.u_apple, auth_user=self.u_apple,
                 state={"state": BUSY, "status_msg": "Away"})
+        yield self.handlers.presence_handler.flush_presence()
 
-        mocked_set.assert_called_with("apple",
-                {"state": 1, "status_msg": "Away"})
+        # Only the presence state is stored, not the profile data.
+        mocked_set.assert_called_with({
+            "apple": {"state": 1, "status_msg": "Away"},
+        })
         self.mock_start.assert_called_with(self.u_apple,
                 state={"state": 1, "status_msg": "Away",
                        "displayname": "Frank",
@@ -122,8 +131,6 @@ class PresenceProfilelikeDataTestCase(unittest.TestCase):
 
     @defer.inlineCallbacks
     def test_push_local(self):
-        self.datastore.set_presence_state.return_value = defer.succeed(
-                {"state": ONLINE})
 
         # TODO(paul): Gut-wrenching
         from synapse.handlers.presence import UserPresenceCache
@@ -186,8 +193,6 @@ class PresenceProfilelikeDataTestCase(unittest.TestCase):
 
     @defer.inlineCallbacks
     def test_push_remote(self):
-        self.datastore.set_presence_state.return_value = defer.succeed(
-                {"state": ONLINE})
 
         # TODO(paul): Gut-wrenching
         from synapse.handlers.presence import UserPresenceCache
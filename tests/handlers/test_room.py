@@ -4,12 +4,16 @@ from twisted.internet import defer
 from twisted.trial import unittest
 
 from synapse.api.events.room import (
-    InviteJoinEvent, RoomMemberEvent, RoomConfigEvent
+    InviteJoinEvent, RoomMemberEvent, RoomConfigEvent, MessageEvent
 )
 from synapse.api.constants import Membership
-from synapse.handlers.room import RoomMemberHandler, RoomCreationHandler
+from synapse.api.streams import PaginationConfig
+from synapse.handlers.room import (
+    MessageHandler, RoomMemberHandler, RoomCreationHandler, RoomListHandler
+)
 from synapse.handlers.profile import ProfileHandler
 from synapse.server import HomeServer
+from synapse.storage.room import RoomDirectory
 
 from mock import Mock, NonCallableMock
 
@@ -361,3 +365,310 @@ class RoomCreationTest(unittest.TestCase):
         self.assertEquals(room_id, config_event.room_id)
         self.assertEquals(user_id, config_event.user_id)
         self.assertEquals(config, config_event.content)
+
+
+class SendMessageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        hs = HomeServer(
+            "red",
+            db_pool=None,
+            datastore=NonCallableMock(spec_set=[
+                "persist_event",
+                "get_joined_hosts_for_room",
+            ]),
+            http_server=NonCallableMock(),
+            http_client=NonCallableMock(spec_set=[]),
+            notifier=NonCallableMock(spec_set=["on_new_room_event"]),
+            auth=NonCallableMock(spec_set=["check"]),
+            federation=NonCallableMock(spec_set=["handle_new_event"]),
+        )
+
+        self.datastore = hs.get_datastore()
+        self.notifier = hs.get_notifier()
+        self.event_factory = hs.get_event_factory()
+        self.federation = hs.get_federation()
+        self.message_handler = MessageHandler(hs)
+
+        hs.get_auth().check.return_value = defer.succeed(True)
+        hs.get_federation().handle_new_event.side_effect = (
+            lambda event, send_after: defer.succeed(None)
+        )
+        self.datastore.get_joined_hosts_for_room.side_effect = (
+            lambda room_id: defer.succeed(["red"])
+        )
+
+    def make_message(self, msg_id):
+        return self.event_factory.create_event(
+            etype=MessageEvent.TYPE,
+            user_id="@alice:red",
+            room_id="!a:red",
+            msg_id=msg_id,
+            content={"msgtype": u"m.text", "body": u"Hi"},
+        )
+
+    @defer.inlineCallbacks
+    def test_lock_not_held_while_persisting(self):
+        persisted = [defer.Deferred(), defer.Deferred()]
+        self.datastore.persist_event.side_effect = persisted
+
+        first = self.make_message("1")
+        second = self.make_message("2")
+
+        sent = [
+            self.message_handler.send_message(first, stamp_event=False),
+            self.message_handler.send_message(second, stamp_event=False),
+        ]
+
+        # Both writes are queued before the first has been committed, so
+        # they can share a batch.
+        self.assertEquals(2, self.datastore.persist_event.call_count)
+        self.assertFalse(self.notifier.on_new_room_event.called)
+
+        # The PDUs are only sent once their events have been stored.
+        self.federation.handle_new_event.assert_any_call(
+            first, send_after=persisted[0]
+        )
+
+        persisted[0].callback(5)
+        persisted[1].callback(6)
+
+        yield defer.DeferredList(sent)
+
+        self.assertEquals(
+            [((first, 5), {}), ((second, 6), {})],
+            self.notifier.on_new_room_event.call_args_list
+        )
+
+
+class SnapshotAllRoomsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        hs = HomeServer(
+            "red",
+            db_pool=None,
+            datastore=NonCallableMock(spec_set=[
+                "get_rooms_for_user_where_membership_is",
+                "get_max_message_id",
+                "get_message_streams_for_rooms",
+            ]),
+            http_server=NonCallableMock(),
+            http_client=NonCallableMock(spec_set=[]),
+            auth=NonCallableMock(spec_set=["check_joined_room"]),
+        )
+
+        self.datastore = hs.get_datastore()
+        self.auth = hs.get_auth()
+        self.message_handler = MessageHandler(hs)
+
+    @defer.inlineCallbacks
+    def test_snapshot(self):
+        self.datastore.get_rooms_for_user_where_membership_is.return_value = (
+            defer.succeed([
+                {"room_id": "!a:red", "membership": Membership.JOIN},
+                {"room_id": "!b:red", "membership": Membership.INVITE},
+                {"room_id": "!c:red", "membership": Membership.JOIN},
+            ])
+        )
+        self.datastore.get_max_message_id.return_value = defer.succeed(9)
+        self.datastore.get_message_streams_for_rooms.return_value = (
+            defer.succeed({
+                "!a:red": (["msg1", "msg2"], 3),
+                "!c:red": ([], 10),
+            })
+        )
+
+        room_list = yield self.message_handler.snapshot_all_rooms(
+            user_id="@alice:red",
+            pagin_config=PaginationConfig(
+                from_tok="END", to_tok="START", limit=5
+            ),
+        )
+
+        self.assertEquals([
+            {
+                "room_id": "!a:red",
+                "membership": Membership.JOIN,
+                "messages": {
+                    "chunk": ["msg1", "msg2"], "start": "10", "end": "3"
+                },
+            },
+            {"room_id": "!b:red", "membership": Membership.INVITE},
+            {
+                "room_id": "!c:red",
+                "membership": Membership.JOIN,
+                "messages": {"chunk": [], "start": "10", "end": "10"},
+            },
+        ], room_list)
+
+        # All the joined rooms are fetched in one go, and the membership we
+        # already have is trusted.
+        self.datastore.get_message_streams_for_rooms.assert_called_once_with(
+            user_id="@alice:red",
+            from_key=10,
+            to_key=0,
+            room_ids=["!a:red", "!c:red"],
+            limit=5,
+            with_feedback=False,
+        )
+        self.assertEquals(1, self.datastore.get_max_message_id.call_count)
+        self.assertFalse(self.auth.check_joined_room.called)
+
+
+class RoomListTestCase(unittest.TestCase):
+
+    def setUp(self):
+        hs = HomeServer(
+            "red",
+            db_pool=None,
+            datastore=NonCallableMock(spec_set=["get_room_directory"]),
+            http_server=NonCallableMock(),
+            http_client=NonCallableMock(spec_set=[]),
+        )
+
+        rooms = [
+            {"room_id": "!%d:red" % (i,), "num_joined_members": 1}
+            for i in range(5)
+        ]
+        self.datastore = hs.get_datastore()
+        directory = RoomDirectory(
+            etag='"abc"',
+            rooms=rooms,
+            room_ids=[room["room_id"] for room in rooms],
+        )
+        self.datastore.get_room_directory.side_effect = (
+            lambda: defer.succeed(directory)
+        )
+        self.rooms = rooms
+        self.room_list_handler = RoomListHandler(hs)
+
+    @defer.inlineCallbacks
+    def test_all_rooms(self):
+        etag, result = yield self.room_list_handler.get_public_room_list()
+
+        self.assertEquals('"abc"', etag)
+        self.assertEquals(
+            {"start": "START", "end": "END", "chunk": self.rooms}, result
+        )
+
+    @defer.inlineCallbacks
+    def test_paging(self):
+        etag, result = yield self.room_list_handler.get_public_room_list(
+            PaginationConfig(from_tok="START", limit=2)
+        )
+        self.assertEquals(self.rooms[0:2], result["chunk"])
+        self.assertEquals("!1:red", result["end"])
+
+        etag, result = yield self.room_list_handler.get_public_room_list(
+            PaginationConfig(from_tok=result["end"], limit=2)
+        )
+        self.assertEquals(self.rooms[2:4], result["chunk"])
+        self.assertEquals("!3:red", result["end"])
+
+        etag, result = yield self.room_list_handler.get_public_room_list(
+            PaginationConfig(from_tok=result["end"], limit=2)
+        )
+        self.assertEquals(self.rooms[4:], result["chunk"])
+        self.assertEquals("END", result["end"])
+
+
+class JoinedMembersIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        hs = HomeServer(
+            "red",
+            db_pool=None,
+            datastore=NonCallableMock(spec_set=[
+                "get_room_members",
+                "get_rooms_for_user_where_membership_is",
+            ]),
+            http_server=NonCallableMock(),
+            http_client=NonCallableMock(spec_set=[]),
+        )
+
+        self.datastore = hs.get_datastore()
+        self.room_member_handler = RoomMemberHandler(hs)
+
+        self.u_apple = hs.parse_userid("@apple:red")
+        self.u_banana = hs.parse_userid("@banana:red")
+        self.u_potato = hs.parse_userid("@potato:remote")
+
+        self.datastore.get_rooms_for_user_where_membership_is.side_effect = (
+            lambda user_id, membership_list: defer.succeed([
+                {"room_id": "!a:red"}, {"room_id": "!b:red"},
+            ])
+        )
+
+        members = {
+            "!a:red": [self.u_apple, self.u_banana],
+            "!b:red": [self.u_apple, self.u_potato],
+        }
+        self.datastore.get_room_members.side_effect = (
+            lambda room_id, membership: defer.succeed([
+                Mock(user_id=u.to_string()) for u in members[room_id]
+            ])
+        )
+
+    @defer.inlineCallbacks
+    def fetch_co_members(self, user):
+        localusers = set()
+        remotedomains = set()
+        yield self.room_member_handler.fetch_co_member_distributions_into(
+            user, localusers=localusers, remotedomains=remotedomains
+        )
+        defer.returnValue((localusers, remotedomains))
+
+    @defer.inlineCallbacks
+    def test_co_members(self):
+        localusers, remotedomains = yield self.fetch_co_members(self.u_apple)
+
+        self.assertEquals(set([self.u_banana]), localusers)
+        self.assertEquals(set(["remote"]), remotedomains)
+
+    @defer.inlineCallbacks
+    def test_cached(self):
+        yield self.fetch_co_members(self.u_apple)
+        yield self.fetch_co_members(self.u_apple)
+
+        self.assertEquals(
+            1, self.datastore.get_rooms_for_user_where_membership_is.call_count
+        )
+        self.assertEquals(2, self.datastore.get_room_members.call_count)
+
+    @defer.inlineCallbacks
+    def test_membership_changes(self):
+        yield self.fetch_co_members(self.u_apple)
+
+        self.room_member_handler.on_membership_changed(
+            "!a:red", self.u_banana, Membership.LEAVE
+        )
+        self.room_member_handler.on_membership_changed(
+            "!a:red", self.u_potato, Membership.JOIN
+        )
+        self.room_member_handler.on_membership_changed(
+            "!b:red", self.u_apple, Membership.LEAVE
+        )
+
+        localusers, remotedomains = yield self.fetch_co_members(self.u_apple)
+
+        self.assertEquals(set(), localusers)
+        self.assertEquals(set(["remote"]), remotedomains)
+        self.assertEquals(2, self.datastore.get_room_members.call_count)
+
+    @defer.inlineCallbacks
+    def test_racing_load_not_cached(self):
+        d = defer.Deferred()
+        self.datastore.get_room_members.side_effect = (
+            lambda room_id, membership: d
+        )
+
+        load = self.room_member_handler.get_joined_members("!a:red")
+
+        # The membership changes while the room is being loaded.
+        self.room_member_handler.on_membership_changed(
+            "!a:red", self.u_banana, Membership.LEAVE
+        )
+        d.callback([Mock(user_id="@banana:red")])
+        yield load
+
+        self.assertNotIn("!a:red", self.room_member_handler._joined_members)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+
+from synapse.http.router import PathRouter, literal_prefix
+
+import re
+
+
+class LiteralPrefixTestCase(unittest.TestCase):
+
+    def test_prefix(self):
+        self.assertEquals("/send/", literal_prefix("^/send/([^/]*)/$"))
+        self.assertEquals("/events", literal_prefix("/events$"))
+
+    def test_quantifier(self):
+        self.assertEquals("/room", literal_prefix("^/rooms?/"))
+        self.assertEquals("/room", literal_prefix("^/rooms{0,1}/"))
+
+    def test_alternation(self):
+        self.assertEquals("", literal_prefix("^/a/|^/b/"))
+
+
+class PathRouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.router = PathRouter()
+
+    def _match(self, method, path):
+        matched = self.router.match(method, path)
+        if not matched:
+            return None
+        route, m = matched
+        return route.callback, m.groups()
+
+    def test_match(self):
+        self.router.add("GET", re.compile("^/send/([^/]*)/$"), "send")
+        self.router.add("GET", re.compile("^/pdu/([^/]*)/([^/]*)/$"), "pdu")
+
+        self.assertEquals(("send", ("abc",)), self._match("GET", "/send/abc/"))
+        self.assertEquals(
+            ("pdu", ("a", "b")), self._match("GET", "/pdu/a/b/")
+        )
+
+        self.assertEquals(None, self._match("GET", "/send"))
+        self.assertEquals(None, self._match("GET", "/other/abc/"))
+        self.assertEquals(None, self._match("PUT", "/send/abc/"))
+
+    def test_registration_order(self):
+        # The less specific regex was registered first, so must win even
+        # though the other has a longer literal prefix.
+        self.router.add("GET", re.compile("^/rooms/(.*)$"), "any")
+        self.router.add("GET", re.compile("^/rooms/abc/members$"), "members")
+
+        self.assertEquals(
+            ("any", ("abc/members",)),
+            self._match("GET", "/rooms/abc/members")
+        )
+
+    def test_no_prefix(self):
+        self.router.add("GET", re.compile("^/a/(b)$"), "a")
+        self.router.add("GET", re.compile("(.*)"), "catch_all")
+        self.router.add("GET", re.compile("^/a/b$", re.IGNORECASE), "ignore")
+
+        self.assertEquals(("a", ("b",)), self._match("GET", "/a/b"))
+        self.assertEquals(("catch_all", ("/c",)), self._match("GET", "/c"))
+
+    def test_routes(self):
+        first = self.router.add("GET", re.compile("^/a/b/$"), "first")
+        second = self.router.add("PUT", re.compile("^/$"), "second")
+        third = self.router.add("GET", re.compile("^/a/$"), "third")
+
+        self.assertEquals(
+            [("GET", first), ("PUT", second), ("GET", third)],
+            self.router.routes()
+        )
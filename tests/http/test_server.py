@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from synapse.http.server import JsonStreamResponse
+from synapse.util.jsonutil import encode_canonical_json
+
+from mock import Mock
+
+
+class JsonStreamResponseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.request = Mock()
+        self.written = []
+        self.request.write.side_effect = self.written.append
+
+    def _send(self, response):
+        response.send(self.request, 200)
+
+        self.request.setResponseCode.assert_called_with(200)
+
+        self.assertTrue(self.request.registerProducer.called)
+        producer, streaming = self.request.registerProducer.call_args[0]
+        self.assertFalse(streaming)
+
+        return producer
+
+    def _produce(self, producer, max_calls=1000):
+        for _ in range(max_calls):
+            if self.request.finish.called:
+                break
+            producer.resumeProducing()
+
+        return "".join(self.written)
+
+    def test_list(self):
+        items = [{"a": i} for i in range(250)]
+
+        producer = self._send(JsonStreamResponse(iter(items)))
+        body = self._produce(producer)
+
+        self.assertEquals(encode_canonical_json(items), body)
+        self.request.unregisterProducer.assert_called_with()
+
+        # The items are sent in more than one chunk.
+        self.assertTrue(len(self.written) > 1)
+
+    def test_empty(self):
+        producer = self._send(JsonStreamResponse([]))
+        self.assertEquals("[]", self._produce(producer))
+
+    def test_object(self):
+        items = [{"b": i, "c": u"☃"} for i in range(3)]
+        json_object = {"a": 1, "z": {"y": 2}}
+
+        producer = self._send(
+            JsonStreamResponse(items, json_object=json_object, list_key="m")
+        )
+        body = self._produce(producer)
+
+        expected = dict(json_object)
+        expected["m"] = items
+        self.assertEquals(encode_canonical_json(expected), body)
+
+    def test_deferred_batches(self):
+        batches = [defer.Deferred(), defer.Deferred()]
+
+        producer = self._send(JsonStreamResponse(iter(batches)))
+
+        producer.resumeProducing()
+        # Only the start of the list can be written until the first batch
+        # arrives.
+        self.assertEquals("[", "".join(self.written))
+
+        # Asking again while we wait shouldn't consume any more batches.
+        producer.resumeProducing()
+        self.assertFalse(batches[1].called)
+
+        batches[0].callback([1, 2])
+        self.assertEquals("[1,2", "".join(self.written))
+
+        batches[1].callback([3])
+        self.assertTrue(self.request.finish.called)
+        self.assertEquals("[1,2,3]", "".join(self.written))
+
+    def test_failed_batch(self):
+        d = defer.Deferred()
+
+        producer = self._send(JsonStreamResponse(iter([[1], d])))
+        producer.resumeProducing()
+
+        d.errback(Exception("Failed"))
+
+        self.assertFalse(self.request.finish.called)
+        self.assertTrue(self.request.loseConnection.called)
+
+    def test_unencodable_item(self):
+        producer = self._send(
+            JsonStreamResponse(iter([1, object(), 3]))
+        )
+        producer.resumeProducing()
+
+        self.assertFalse(self.request.finish.called)
+        self.assertTrue(self.request.loseConnection.called)
+
+    def test_stop_producing(self):
+        producer = self._send(
+            JsonStreamResponse(iter(range(1000)))
+        )
+        producer.resumeProducing()
+        written = len(self.written)
+
+        producer.stopProducing()
+        producer.resumeProducing()
+
+        self.assertEquals(written, len(self.written))
+        self.assertFalse(self.request.finish.called)
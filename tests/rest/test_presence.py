@@ -171,7 +171,7 @@ class PresenceEventStreamTestCase(unittest.TestCase):
             http_client=None,
             http_server=self.mock_server,
             datastore=Mock(spec=[
-                "set_presence_state",
+                "set_presence_states",
                 "get_presence_list",
             ]),
             clock=Mock(spec=[
@@ -191,10 +191,10 @@ class PresenceEventStreamTestCase(unittest.TestCase):
         hs.register_servlets()
 
         hs.handlers.room_member_handler = Mock(spec=[
-            "get_rooms_for_user",
+            "fetch_co_member_distributions_into",
         ])
-        hs.handlers.room_member_handler.get_rooms_for_user = (
-                lambda u: defer.succeed([]))
+        hs.handlers.room_member_handler.fetch_co_member_distributions_into = (
+                lambda u, **kwargs: defer.succeed(None))
 
         self.mock_datastore = hs.get_datastore()
         self.presence = hs.get_handlers().presence_handler
@@ -204,8 +204,6 @@ class PresenceEventStreamTestCase(unittest.TestCase):
 
     @defer.inlineCallbacks
     def test_shortpoll(self):
-        self.mock_datastore.set_presence_state.return_value = defer.succeed(
-                {"state": ONLINE})
         self.mock_datastore.get_presence_list.return_value = defer.succeed(
                 [])
 
@@ -223,8 +221,6 @@ class PresenceEventStreamTestCase(unittest.TestCase):
              "content": {"user_id": "@apple:test", "state": 2}},
         ]}, response)
 
-        self.mock_datastore.set_presence_state.return_value = defer.succeed(
-                {"state": ONLINE})
         self.mock_datastore.get_presence_list.return_value = defer.succeed(
                 [])
 
@@ -8,7 +8,9 @@ from mock import Mock, call
 from collections import OrderedDict
 
 from synapse.server import HomeServer
-from synapse.storage._base import SQLBaseStore
+from synapse.storage._base import (
+    SQLBaseStore, StreamIdGenerator, _InteractionBatcher
+)
 
 
 class SQLBaseStoreTestCase(unittest.TestCase):
@@ -189,3 +191,147 @@ class SQLBaseStoreTestCase(unittest.TestCase):
                 "DELETE FROM tablename WHERE keycol = ?",
                 ["Go away"]
         )
+
+    def test_event_dict_cached(self):
+        table = Mock(table_name="tablename")
+        entry = Mock(id=5)
+        entry.as_event.return_value.get_dict.return_value = {
+            "content": {"body": "Hi"}
+        }
+        self.datastore.event_factory = Mock()
+
+        first = self.datastore._get_event_dict(table, entry)
+        first["feedback"] = []
+        first["content"]["body"] = "Changed"
+        second = self.datastore._get_event_dict(table, entry)
+
+        self.assertEquals({"content": {"body": "Hi"}}, second)
+        self.assertEquals(1, entry.as_event.call_count)
+
+
+class InteractionBatcherTestCase(unittest.TestCase):
+    """ Test that _InteractionBatcher commits interactions in batches. """
+
+    def setUp(self):
+        self.db_pool = Mock(spec=["runInteraction"])
+        self.mock_txn = Mock()
+        self.pending = []
+
+        # Hold on to interactions until the test lets them complete.
+        def runInteraction(func, *args):
+            d = defer.Deferred()
+            self.pending.append((d, func, args))
+            return d
+        self.db_pool.runInteraction.side_effect = runInteraction
+
+        self.clock = Mock(spec=["call_later"])
+
+        self.batcher = _InteractionBatcher(self.db_pool, self.clock, 0.005)
+
+    def complete_pending(self):
+        pending, self.pending = self.pending, []
+        for d, func, args in pending:
+            try:
+                d.callback(func(self.mock_txn, *args))
+            except Exception:
+                d.errback()
+
+    def test_batches(self):
+        func = Mock(side_effect=[1, 2])
+        d1 = self.batcher.run_interaction(func, "a")
+        d2 = self.batcher.run_interaction(func, "b")
+
+        self.assertEquals(1, self.clock.call_later.call_count)
+        self.assertFalse(self.db_pool.runInteraction.called)
+
+        # Fire the timer
+        self.clock.call_later.call_args[0][1]()
+        self.assertEquals(1, self.db_pool.runInteraction.call_count)
+
+        self.complete_pending()
+
+        self.assertEquals(1, self.successResultOf(d1))
+        self.assertEquals(2, self.successResultOf(d2))
+        func.assert_has_calls([
+            call(self.mock_txn, "a"), call(self.mock_txn, "b")
+        ])
+        self.assertEquals(1, self.batcher.batches)
+        self.assertEquals(2, self.batcher.interactions)
+
+    def test_queued_while_in_flight(self):
+        func = Mock(return_value=None)
+        self.batcher.run_interaction(func, "a")
+        self.clock.call_later.call_args[0][1]()
+
+        # These arrive while the first batch is being committed, so should
+        # go in the next batch as soon as it is done.
+        d2 = self.batcher.run_interaction(func, "b")
+        d3 = self.batcher.run_interaction(func, "c")
+        self.assertEquals(1, self.clock.call_later.call_count)
+
+        self.complete_pending()
+        self.assertEquals(2, self.db_pool.runInteraction.call_count)
+
+        self.complete_pending()
+        self.successResultOf(d2)
+        self.successResultOf(d3)
+        self.assertEquals(2, self.batcher.batches)
+
+    def test_failed_batch_retried_individually(self):
+        def func(txn, value):
+            if value == "bad":
+                raise Exception("Constraint failed")
+            return value
+
+        d1 = self.batcher.run_interaction(func, "good")
+        d2 = self.batcher.run_interaction(func, "bad")
+        self.clock.call_later.call_args[0][1]()
+
+        self.complete_pending()
+        self.complete_pending()
+
+        self.assertEquals("good", self.successResultOf(d1))
+        self.failureResultOf(d2)
+
+
+class StreamIdGeneratorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = Mock(spec=["_simple_max_id"])
+        self.max_id = defer.Deferred()
+        self.store._simple_max_id.return_value = self.max_id
+
+        self.id_gen = StreamIdGenerator(self.store, "messages")
+
+    def test_loads_once(self):
+        d1 = self.id_gen.get_max_token()
+        d2 = self.id_gen.get_next()
+        self.assertNoResult(d1)
+
+        self.max_id.callback(5)
+
+        self.assertEquals(5, self.successResultOf(d1))
+        self.assertEquals(6, self.successResultOf(d2))
+
+        self.id_gen.finish(6)
+        self.assertEquals(6, self.successResultOf(self.id_gen.get_max_token()))
+        self.assertEquals(7, self.successResultOf(self.id_gen.get_next()))
+
+        self.store._simple_max_id.assert_called_once_with("messages")
+
+    def test_unfinished_ids(self):
+        self.max_id.callback(5)
+
+        first = self.successResultOf(self.id_gen.get_next())
+        second = self.successResultOf(self.id_gen.get_next())
+
+        # Neither row has been written yet.
+        self.assertEquals(5, self.successResultOf(self.id_gen.get_max_token()))
+
+        # The later row being written mustn't move the token past the
+        # earlier one, which still isn't.
+        self.id_gen.finish(second)
+        self.assertEquals(5, self.successResultOf(self.id_gen.get_max_token()))
+
+        self.id_gen.finish(first)
+        self.assertEquals(7, self.successResultOf(self.id_gen.get_max_token()))
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.server import HomeServer
+from synapse.storage.pdu import PduStore, StatePduStore
+
+from .utils import make_mock_store
+
+from collections import namedtuple
+
+
+class ForwardExtremitiesTestCase(unittest.TestCase):
+    """ Test the in-memory cache of forward extremities in PduStore. """
+
+    def setUp(self):
+        self.datastore, self.db_pool, self.mock_txn = make_mock_store(
+            PduStore
+        )
+        self.mock_txn.fetchone.return_value = None
+
+    @defer.inlineCallbacks
+    def test_loads_then_caches(self):
+        self.mock_txn.fetchall.return_value = [("a", "remote", 3)]
+
+        results = yield self.datastore.get_latest_pdus_in_context("context")
+        self.assertEquals([("a", "remote", 3)], results)
+
+        self.mock_txn.execute.reset_mock()
+
+        results = yield self.datastore.get_latest_pdus_in_context("context")
+        self.assertEquals([("a", "remote", 3)], results)
+        self.assertFalse(self.mock_txn.execute.called)
+
+    @defer.inlineCallbacks
+    def test_updated_on_persist(self):
+        self.mock_txn.fetchall.return_value = [("a", "remote", 3)]
+        yield self.datastore.get_latest_pdus_in_context("context")
+
+        self.mock_txn.rowcount = 1
+        yield self.datastore.persist_pdu(
+            [("a", "remote")],
+            pdu_id="b", origin="test", context="context", depth=4,
+            outlier=False,
+        )
+
+        results = yield self.datastore.get_latest_pdus_in_context("context")
+        self.assertEquals([("b", "test", 4)], results)
+
+    @defer.inlineCallbacks
+    def test_invalidated_on_failure(self):
+        self.mock_txn.fetchall.return_value = [("a", "remote", 3)]
+        yield self.datastore.get_latest_pdus_in_context("context")
+
+        self.mock_txn.executemany.side_effect = Exception("Disk full")
+        d = self.datastore.persist_pdu(
+            [("a", "remote")],
+            pdu_id="b", origin="test", context="context", depth=4,
+            outlier=False,
+        )
+        yield self.assertFailure(d, Exception)
+
+        self.mock_txn.executemany.side_effect = None
+        self.mock_txn.execute.reset_mock()
+
+        yield self.datastore.get_latest_pdus_in_context("context")
+        self.assertTrue(self.mock_txn.execute.called)
+
+
+class BackwardExtremitiesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.datastore, self.db_pool, self.mock_txn = make_mock_store(
+            PduStore
+        )
+        self.mock_txn.fetchone.return_value = None
+
+    @defer.inlineCallbacks
+    def test_only_touches_new_pdus(self):
+        yield self.datastore.persist_pdu(
+            [("a", "remote")],
+            pdu_id="b", origin="test", context="context", depth=4,
+            outlier=False,
+        )
+
+        self.mock_txn.executemany.assert_any_call(
+            "INSERT INTO pdu_backward_extremities (pdu_id, origin, context) "
+            "SELECT ?, ?, ? WHERE NOT EXISTS ("
+            "SELECT 1 FROM pdus WHERE "
+            "pdu_id = ? AND origin = ? AND NOT outlier)",
+            [("a", "remote", "context", "a", "remote")]
+        )
+        self.mock_txn.execute.assert_any_call(
+            "DELETE FROM pdu_backward_extremities "
+            "WHERE pdu_id = ? AND origin = ? AND context = ?",
+            ("b", "test", "context")
+        )
+
+
+class StateChainTestCase(unittest.TestCase):
+    """ Test the use of the state chain index by StatePduStore. """
+
+    def setUp(self):
+        hs = HomeServer("test",
+                db_pool=Mock(spec=["runInteraction"]))
+
+        self.datastore = StatePduStore(hs)
+
+        # Chain 1 is the root, chain 2 forks from it at depth 1 and chain 3
+        # forks from chain 2 at depth 4.
+        self.chain_parents = {1: None, 2: (1, 1), 3: (2, 4)}
+        self.datastore._get_state_chain_parent = (
+            lambda txn, chain_id: self.chain_parents[chain_id]
+        )
+
+    def test_common_ancestor_same_chain(self):
+        ancestor = self.datastore._find_common_state_ancestor(
+            None, (1, 5), (1, 3)
+        )
+        self.assertEquals((1, 3), ancestor)
+
+    def test_common_ancestor_across_forks(self):
+        ancestor = self.datastore._find_common_state_ancestor(
+            None, (3, 7), (1, 6)
+        )
+        self.assertEquals((1, 1), ancestor)
+
+        ancestor = self.datastore._find_common_state_ancestor(
+            None, (2, 3), (3, 5)
+        )
+        self.assertEquals((2, 3), ancestor)
+
+    def test_common_ancestor_different_roots(self):
+        self.chain_parents[4] = None
+
+        ancestor = self.datastore._find_common_state_ancestor(
+            None, (4, 2), (3, 5)
+        )
+        self.assertIsNone(ancestor)
+
+    def test_indexed_state_ancestors(self):
+        txn = Mock()
+        # The pdus on each chain, as (pdu_id, origin, depth), back from the
+        # position asked for.
+        txn.fetchall.side_effect = [
+            [("g", "red", 7), ("f", "red", 6), ("e", "red", 5)],
+            [("d", "red", 4), ("c", "red", 3), ("b", "red", 2)],
+            [("a", "red", 1)],
+        ]
+
+        ancestors = self.datastore._get_indexed_state_ancestors(
+            txn, (3, 7), min_depth=3, limit=10
+        )
+
+        self.assertEquals(
+            [("g", "red"), ("f", "red"), ("e", "red"), ("d", "red"),
+             ("c", "red")],
+            ancestors
+        )
+        # One query per chain, each starting from where the one after it
+        # forked.
+        self.assertEquals(
+            [(3, 7, 10), (2, 4, 7)],
+            [c[0][1] for c in txn.execute.call_args_list]
+        )
+
+    def test_indexed_state_ancestors_limit(self):
+        txn = Mock()
+        txn.fetchall.side_effect = [
+            [("g", "red", 7), ("f", "red", 6), ("e", "red", 5)],
+        ]
+
+        ancestors = self.datastore._get_indexed_state_ancestors(
+            txn, (3, 7), min_depth=0, limit=3
+        )
+
+        self.assertEquals(
+            [("g", "red"), ("f", "red"), ("e", "red")], ancestors
+        )
+        self.assertEquals(1, txn.execute.call_count)
+
+    def test_walk_matches_enumerate(self):
+        Pdu = namedtuple("Pdu", ["pdu_id", "depth"])
+        a, b, c, d, e = [Pdu(i, depth) for i, depth in enumerate(
+            [0, 1, 2, 1, 2]
+        )]
+
+        # The branches (e, d, a) and (c, b, a), in the order that
+        # _enumerate_state_branches would step through them.
+        steps = list(self.datastore._walk_state_branches(
+            [e, d, a], [c, b, a]
+        ))
+
+        self.assertEquals(
+            [(1, c, b), (0, e, d), (1, b, a), (0, d, a)],
+            steps
+        )
+
+
+class CurrentStateCacheTestCase(unittest.TestCase):
+    """ Test the caching of current state by StatePduStore. """
+
+    def setUp(self):
+        self.datastore, self.db_pool, self.mock_txn = make_mock_store(
+            StatePduStore
+        )
+
+    @defer.inlineCallbacks
+    def test_current_state_cached(self):
+        self.mock_txn.fetchone.return_value = None
+
+        result = yield self.datastore.get_current_state(
+            "context", "m.topic", ""
+        )
+        self.assertIsNone(result)
+
+        self.mock_txn.execute.reset_mock()
+
+        result = yield self.datastore.get_current_state(
+            "context", "m.topic", ""
+        )
+        self.assertIsNone(result)
+        self.assertFalse(self.mock_txn.execute.called)
+
+    @defer.inlineCallbacks
+    def test_current_state_invalidated_on_update(self):
+        self.mock_txn.fetchone.return_value = None
+        yield self.datastore.get_current_state("context", "m.topic", "")
+
+        yield self.datastore.update_current_state(
+            "a", "test", "context", "m.topic", ""
+        )
+
+        self.mock_txn.execute.reset_mock()
+
+        yield self.datastore.get_current_state("context", "m.topic", "")
+        self.assertTrue(self.mock_txn.execute.called)
+
+    @defer.inlineCallbacks
+    def test_context_state_from_memory(self):
+        self.mock_txn.fetchall.return_value = []
+        self.datastore._get_pdu_tuples = Mock(return_value=[])
+
+        first = yield self.datastore.get_current_state_for_context("context")
+
+        self.db_pool.runInteraction = Mock()
+
+        second = yield self.datastore.get_current_state_for_context("context")
+        self.assertIs(first, second)
+        self.assertFalse(self.db_pool.runInteraction.called)
+
+
+class PersistPduTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.datastore, self.db_pool, self.mock_txn = make_mock_store(
+            PduStore
+        )
+
+    @defer.inlineCallbacks
+    def test_persist_updates_min_depth(self):
+        self.mock_txn.fetchone.return_value = (10,)
+
+        yield self.datastore.persist_pdu(
+            [],
+            pdu_id="b", origin="test", context="context", depth=4,
+            outlier=False,
+        )
+
+        self.assertEquals(1, self.db_pool.runInteraction.call_count)
+        self.mock_txn.execute.assert_any_call(
+            "INSERT OR REPLACE INTO context_depth (context, min_depth) "
+            "VALUES (?,?)",
+            ("context", 4)
+        )
+
+    @defer.inlineCallbacks
+    def test_mark_as_processed(self):
+        yield self.datastore.mark_pdu_as_processed("b", "test")
+
+        self.assertEquals(1, self.mock_txn.execute.call_count)
+        self.mock_txn.execute.assert_called_with(
+            "UPDATE pdus SET have_processed = 1 "
+            "WHERE pdu_id = ? AND origin = ?",
+            ("b", "test")
+        )
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from synapse.storage.presence import PresenceStore
+
+from .utils import make_mock_store
+
+
+class SetPresenceStatesTestCase(unittest.TestCase):
+    """ Test storing the presence state of many users at once. """
+
+    def setUp(self):
+        self.datastore, self.db_pool, self.mock_txn = make_mock_store(
+            PresenceStore
+        )
+
+    @defer.inlineCallbacks
+    def test_updates(self):
+        self.mock_txn.rowcount = 1
+
+        yield self.datastore.set_presence_states({
+            "apple": {"state": 2, "status_msg": "Here"},
+        })
+
+        self.mock_txn.executemany.assert_called_once_with(
+            "UPDATE presence SET state = ?, status_msg = ? WHERE user_id = ?",
+            [(2, "Here", "apple")]
+        )
+
+    @defer.inlineCallbacks
+    def test_missing_rows_inserted(self):
+        self.mock_txn.rowcount = 0
+
+        yield self.datastore.set_presence_states({
+            "apple": {"state": 2, "status_msg": "Here"},
+        })
+
+        self.mock_txn.executemany.assert_called_with(
+            "INSERT INTO presence (state, status_msg, user_id) "
+            "SELECT ?, ?, ? WHERE NOT EXISTS ("
+            "SELECT 1 FROM presence WHERE user_id = ?)",
+            [(2, "Here", "apple", "apple")]
+        )
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.api.errors import StoreError
+from synapse.storage.registration import RegistrationStore
+
+from .utils import make_mock_store
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """ Test the caching of access token lookups in RegistrationStore. """
+
+    def setUp(self):
+        self.clock = Mock(spec=["time"])
+        self.clock.time.return_value = 1000
+
+        self.datastore, self.db_pool, self.mock_txn = make_mock_store(
+            RegistrationStore, clock=self.clock
+        )
+
+    @defer.inlineCallbacks
+    def test_cached(self):
+        self.mock_txn.fetchone.return_value = ("@user:test",)
+
+        user_id = yield self.datastore.get_user_by_token("abc")
+        self.assertEquals("@user:test", user_id)
+
+        self.mock_txn.execute.reset_mock()
+
+        user_id = yield self.datastore.get_user_by_token("abc")
+        self.assertEquals("@user:test", user_id)
+        self.assertFalse(self.mock_txn.execute.called)
+
+        self.assertEquals(1, self.datastore.token_cache.hits)
+        self.assertEquals(1, self.datastore.token_cache.misses)
+
+    @defer.inlineCallbacks
+    def test_expires(self):
+        self.mock_txn.fetchone.return_value = ("@user:test",)
+        yield self.datastore.get_user_by_token("abc")
+
+        self.clock.time.return_value = 1000 + 60 * 60
+        self.mock_txn.execute.reset_mock()
+
+        yield self.datastore.get_user_by_token("abc")
+        self.assertTrue(self.mock_txn.execute.called)
+
+    @defer.inlineCallbacks
+    def test_unknown_token_not_cached(self):
+        self.mock_txn.fetchone.return_value = None
+
+        d = self.datastore.get_user_by_token("abc")
+        yield self.assertFailure(d, StoreError)
+
+        self.assertFalse("abc" in self.datastore.token_cache)
+
+    @defer.inlineCallbacks
+    def test_invalidated_on_new_token(self):
+        self.mock_txn.fetchone.return_value = ("@user:test",)
+        yield self.datastore.get_user_by_token("abc")
+
+        self.datastore._simple_select_one = Mock(
+            return_value=defer.succeed({"id": 1})
+        )
+        yield self.datastore.add_access_token_to_user("@user:test", "abc")
+
+        self.assertFalse("abc" in self.datastore.token_cache)
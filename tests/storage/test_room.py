@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.api.constants import Membership
+from synapse.server import HomeServer
+from synapse.storage.room import RoomStore
+
+from .utils import make_mock_store
+
+
+class RoomDirectoryTestCase(unittest.TestCase):
+    """ Test the in memory public room directory in RoomStore. """
+
+    def setUp(self):
+        self.datastore, self.db_pool, self.mock_txn = make_mock_store(
+            RoomStore
+        )
+
+        # Pretend the directory has already been backfilled.
+        self.datastore._room_directory_backfilled = True
+
+        self.mock_txn.fetchall.return_value = [
+            ("!a:test", "Cheese", 3),
+            ("!b:test", None, 1),
+        ]
+
+    @defer.inlineCallbacks
+    def test_get_room_directory(self):
+        directory = yield self.datastore.get_room_directory()
+
+        self.assertEquals([
+            {"room_id": "!a:test", "topic": "Cheese", "num_joined_members": 3},
+            {"room_id": "!b:test", "num_joined_members": 1},
+        ], directory.rooms)
+        self.assertEquals(["!a:test", "!b:test"], directory.room_ids)
+        self.assertTrue(directory.etag.startswith('"'))
+
+    @defer.inlineCallbacks
+    def test_cached(self):
+        first = yield self.datastore.get_room_directory()
+        second = yield self.datastore.get_room_directory()
+
+        self.assertIs(first, second)
+        self.assertEquals(1, self.db_pool.runInteraction.call_count)
+
+    @defer.inlineCallbacks
+    def test_invalidated_by_config_change(self):
+        first = yield self.datastore.get_room_directory()
+
+        self.mock_txn.rowcount = 1
+        yield self.datastore.store_room_config("!b:test", "private")
+
+        self.mock_txn.fetchall.return_value = [
+            ("!a:test", "Cheese", 3),
+        ]
+        second = yield self.datastore.get_room_directory()
+
+        self.assertEquals(["!a:test"], second.room_ids)
+        self.assertNotEquals(first.etag, second.etag)
+
+    @defer.inlineCallbacks
+    def test_racing_load_not_cached(self):
+        d = defer.Deferred()
+        self.db_pool.runInteraction.side_effect = lambda *args: d
+
+        load = self.datastore.get_room_directory()
+
+        # The directory changes while it is being loaded.
+        self.datastore._on_room_directory_changed()
+        d.callback([{"room_id": "!a:test", "num_joined_members": 3}])
+        yield load
+
+        self.assertIsNone(self.datastore._room_directory)
+
+
+class RoomMemberCountTestCase(unittest.TestCase):
+    """ Test the upkeep of member counts in the room directory. """
+
+    def setUp(self):
+        hs = HomeServer("test",
+                db_pool=Mock(spec=["runInteraction"]))
+
+        self.datastore = RoomStore(hs)
+        self.txn = Mock()
+
+    def insert_membership(self, previous, membership):
+        self.txn.fetchone.return_value = (previous,) if previous else None
+        self.datastore._update_room_member_count_txn(self.txn, dict(
+            id=7, user_id="@alice:test", room_id="!a:test",
+            membership=membership,
+        ))
+
+    def assert_count_changed_by(self, delta):
+        self.txn.execute.assert_called_with(
+            "UPDATE room_directory SET member_count = member_count + ? "
+            "WHERE room_id = ?",
+            (delta, "!a:test")
+        )
+
+    def test_join(self):
+        self.insert_membership(None, Membership.JOIN)
+        self.assert_count_changed_by(1)
+
+        self.insert_membership(Membership.INVITE, Membership.JOIN)
+        self.assert_count_changed_by(1)
+
+    def test_leave(self):
+        self.insert_membership(Membership.JOIN, Membership.LEAVE)
+        self.assert_count_changed_by(-1)
+
+    def test_unchanged(self):
+        self.insert_membership(Membership.JOIN, Membership.JOIN)
+        self.insert_membership(Membership.INVITE, Membership.LEAVE)
+
+        # Only the lookups of the previous membership were run.
+        self.assertEquals(2, self.txn.execute.call_count)
+        self.txn.execute.assert_called_with(
+            "SELECT membership FROM room_memberships "
+            "WHERE user_id = ? AND room_id = ? AND id < ? "
+            "ORDER BY id DESC LIMIT 1",
+            ("@alice:test", "!a:test", 7)
+        )
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet import defer
+
+from synapse.storage.roomdata import RoomDataStore
+
+from .utils import make_mock_store
+
+
+class RoomDataCacheTestCase(unittest.TestCase):
+    """ Test the caching of current room data in RoomDataStore. """
+
+    def setUp(self):
+        self.datastore, self.db_pool, self.mock_txn = make_mock_store(
+            RoomDataStore
+        )
+
+        self.mock_txn.fetchall.return_value = [
+            (5, "!room:test", "m.room.topic", "", '{"topic":"Cheese"}'),
+        ]
+
+    @defer.inlineCallbacks
+    def test_cached(self):
+        entry = yield self.datastore.get_room_data(
+            "!room:test", "m.room.topic"
+        )
+        self.assertEquals(5, entry.id)
+        self.assertEquals('{"topic":"Cheese"}', entry.content)
+
+        self.mock_txn.execute.reset_mock()
+
+        cached = yield self.datastore.get_room_data(
+            "!room:test", "m.room.topic"
+        )
+        self.assertEquals(entry, cached)
+        self.assertEquals(1, self.db_pool.runInteraction.call_count)
+        self.assertFalse(self.mock_txn.execute.called)
+
+    @defer.inlineCallbacks
+    def test_missing_cached(self):
+        self.mock_txn.fetchall.return_value = []
+
+        entry = yield self.datastore.get_room_data(
+            "!room:test", "m.room.topic"
+        )
+        self.assertIsNone(entry)
+
+        entry = yield self.datastore.get_room_data(
+            "!room:test", "m.room.topic"
+        )
+        self.assertIsNone(entry)
+        self.assertEquals(1, self.db_pool.runInteraction.call_count)
+
+    @defer.inlineCallbacks
+    def test_backfills_once(self):
+        yield self.datastore.get_room_data("!room:test", "m.room.topic")
+        backfill_sql = self.mock_txn.execute.call_args_list[0][0][0]
+        self.assertIn("INSERT OR IGNORE INTO current_room_data", backfill_sql)
+
+        self.mock_txn.execute.reset_mock()
+        yield self.datastore.get_room_data("!room:test", "m.room.name")
+        self.assertEquals(1, self.mock_txn.execute.call_count)
+
+    @defer.inlineCallbacks
+    def test_invalidated_on_change(self):
+        yield self.datastore.get_room_data("!room:test", "m.room.topic")
+
+        self.datastore._on_room_data_changed(
+            None, "!room:test", "m.room.topic", ""
+        )
+
+        yield self.datastore.get_room_data("!room:test", "m.room.topic")
+        self.assertEquals(2, self.db_pool.runInteraction.call_count)
+
+    @defer.inlineCallbacks
+    def test_racing_lookup_not_cached(self):
+        d = defer.Deferred()
+        self.db_pool.runInteraction.side_effect = lambda *args: d
+
+        lookup = self.datastore.get_room_data("!room:test", "m.room.topic")
+
+        # The data changes while it is being looked up.
+        self.datastore._on_room_data_changed(
+            None, "!room:test", "m.room.topic", ""
+        )
+        d.callback(None)
+        yield lookup
+
+        self.assertNotIn(
+            ("!room:test", "m.room.topic", ""), self.datastore.room_data_cache
+        )
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import defer
+
+from mock import Mock
+
+from synapse.server import HomeServer
+
+
+def make_mock_store(store_class, **kwargs):
+    """ Creates a store whose database interactions are run synchronously
+    inline, against a mock transaction.
+
+    Args:
+        store_class: The store to create, e.g. RoomStore
+        **kwargs: Any other dependencies to give the HomeServer.
+    Returns:
+        tuple: The store, the mock database pool and the mock transaction.
+    """
+    db_pool = Mock(spec=["runInteraction"])
+    mock_txn = Mock()
+
+    def runInteraction(func, *args, **kwargs):
+        try:
+            return defer.succeed(func(mock_txn, *args, **kwargs))
+        except:
+            return defer.fail()
+    db_pool.runInteraction = Mock(side_effect=runInteraction)
+
+    hs = HomeServer("test", db_pool=db_pool, **kwargs)
+
+    return store_class(hs), db_pool, mock_txn
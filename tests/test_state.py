@@ -24,7 +24,7 @@ class StateTestCase(unittest.TestCase):
             "get_latest_pdus_in_context",
             "get_current_state",
         ])
-        self.replication = Mock(spec=["get_pdu"])
+        self.replication = Mock(spec=["get_pdu", "get_state_ancestors"])
 
         hs = Mock(spec=["get_datastore", "get_replication_layer"])
         hs.get_datastore.return_value = self.persistence
@@ -204,7 +204,11 @@ class StateTestCase(unittest.TestCase):
 
         self.persistence.get_unresolved_state_tree.side_effect = return_tree
 
-        self.replication.get_pdu.side_effect = set_return_tree
+        def get_state_ancestors(*args, **kwargs):
+            set_return_tree()
+            return defer.succeed([old_pdu_1])
+
+        self.replication.get_state_ancestors.side_effect = get_state_ancestors
 
         is_new = yield self.state.handle_new_state(new_pdu)
 
@@ -220,6 +224,53 @@ class StateTestCase(unittest.TestCase):
 
         self.assertEqual(1, self.persistence.update_current_state.call_count)
 
+        self.replication.get_state_ancestors.assert_called_once_with(
+            destination=new_pdu.origin,
+            pdu_origin=new_pdu.prev_state_origin,
+            pdu_id=new_pdu.prev_state_id,
+            min_depth=old_pdu_2.depth
+        )
+        self.assertFalse(self.replication.get_pdu.called)
+
+    @defer.inlineCallbacks
+    def test_missing_pdu_fallback(self):
+        # As above, but the remote server can't give us the state ancestors
+        # so we fall back to asking for the single pdu.
+
+        old_pdu_1 = new_fake_pdu_entry("A", "test", "mem", "x", None, 10)
+
+        old_pdu_2 = new_fake_pdu_entry("B", "test", "mem", "x", None, 10)
+        new_pdu = new_fake_pdu_entry("C", "test", "mem", "x", "A", 20)
+
+        tree_to_return = [ReturnType([new_pdu], [old_pdu_2])]
+
+        def return_tree(p):
+            return tree_to_return[0]
+
+        def set_return_tree(*args, **kwargs):
+            tree_to_return[0] = ReturnType(
+                [new_pdu, old_pdu_1], [old_pdu_2, old_pdu_1]
+            )
+
+        self.persistence.get_unresolved_state_tree.side_effect = return_tree
+
+        self.replication.get_state_ancestors.return_value = defer.fail(
+            RuntimeError("Unrecognized request")
+        )
+        self.replication.get_pdu.side_effect = set_return_tree
+
+        is_new = yield self.state.handle_new_state(new_pdu)
+
+        self.assertTrue(is_new)
+
+        self.assertEquals(
+            2, self.persistence.get_unresolved_state_tree.call_count
+        )
+
+        self.assertEqual(1, self.persistence.update_current_state.call_count)
+
+        self.assertEqual(1, self.replication.get_pdu.call_count)
+
     @defer.inlineCallbacks
     def test_new_event(self):
         event = Mock()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+
+from synapse.util.histogram import Histogram
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_add(self):
+        histogram = Histogram([10, 1, 100])
+
+        for value in [0, 1, 5, 50, 500]:
+            histogram.add(value)
+
+        self.assertEquals([2, 1, 1, 1], histogram.counts)
+        self.assertEquals(5, histogram.count)
+        self.assertEquals(556, histogram.total)
+        self.assertEquals(500, histogram.max)
+
+    def test_get_dict(self):
+        histogram = Histogram([1])
+        histogram.add(2)
+
+        self.assertEquals({
+            "buckets": {"1": 0, "inf": 1},
+            "count": 1,
+            "total": 2,
+            "max": 2,
+        }, histogram.get_dict())
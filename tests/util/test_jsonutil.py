@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+
+from synapse.util.jsonutil import (
+    encode_canonical_json, encode_pretty_printed_json, encode_json,
+    decode_json, decode_json_with_list_iter
+)
+
+import collections
+
+
+class JsonUtilTestCase(unittest.TestCase):
+
+    def test_canonical(self):
+        self.assertEquals(
+            '{"a":[1,2.5,null],"b":"\xc3\xa9","c":{"d":true}}',
+            encode_canonical_json(
+                {"c": {"d": True}, "b": u"é", "a": [1, 2.5, None]}
+            )
+        )
+
+    def test_pretty_printed(self):
+        self.assertEquals(
+            '{\n    "a": 1,\n    "b": [\n        2\n    ]\n}',
+            encode_pretty_printed_json({"b": [2], "a": 1})
+        )
+
+    def test_namedtuple_as_array(self):
+        Point = collections.namedtuple("Point", ["x", "y"])
+        self.assertEquals("[1,2]", encode_canonical_json(Point(1, 2)))
+
+    def test_round_trip(self):
+        obj = {"content": {"body": "hello", "msgtype": "m.text"}}
+        decoded = decode_json(encode_json(obj))
+
+        self.assertEquals(obj, decoded)
+        # Event content checks require strings to be unicode.
+        self.assertEquals(unicode, type(decoded["content"]["body"]))
+
+    def test_list_iter(self):
+        obj, items = decode_json_with_list_iter(
+            '{"origin": "remote", "pdus": [{"a": 1}, [2]], "ts": 3}',
+            "pdus"
+        )
+
+        self.assertEquals({"origin": "remote", "ts": 3}, obj)
+        self.assertEquals([{"a": 1}, [2]], list(items))
+
+    def test_list_iter_missing(self):
+        obj, items = decode_json_with_list_iter('{"origin": "remote"}', "pdus")
+
+        self.assertEquals({"origin": "remote"}, obj)
+        self.assertEquals([], list(items))
+
+    def test_list_iter_invalid(self):
+        for bad in ['{"pdus": [1,]}', '{"a": 1', '{"a": 1} {}', '[]']:
+            self.assertRaises(
+                ValueError, decode_json_with_list_iter, bad, "pdus"
+            )
@@ -5,6 +5,8 @@ from twisted.trial import unittest
 
 from synapse.util.lockutils import LockManager
 
+from mock import Mock, patch
+
 
 class LockManagerTestCase(unittest.TestCase):
 
@@ -91,4 +93,37 @@ class LockManagerTestCase(unittest.TestCase):
             pass
 
         with (yield self.lock_manager.lock(key)):
-            pass
\ No newline at end of file
+            pass
+
+    @defer.inlineCallbacks
+    def test_stats(self):
+        clock = Mock(spec=["time_msec"])
+        clock.time_msec.return_value = 1000
+        lock_manager = LockManager(clock=clock, warn_hold_time=500)
+
+        lock1 = yield lock_manager.lock("test")
+        deferred_lock2 = lock_manager.lock("test")
+
+        clock.time_msec.return_value = 1005
+        lock1.release()
+
+        lock2 = yield deferred_lock2
+
+        clock.time_msec.return_value = 2005
+        with patch("synapse.util.lockutils.logger") as mock_logger:
+            lock2.release()
+            self.assertTrue(mock_logger.warn.called)
+
+        self.assertEquals(2, lock_manager.acquired)
+        self.assertEquals(1, lock_manager.contended)
+        self.assertEquals(2, lock_manager.wait_times.count)
+        self.assertEquals(5, lock_manager.wait_times.max)
+        self.assertEquals(1005, lock_manager.hold_times.total)
+        self.assertEquals(1000, lock_manager.hold_times.max)
+
+    @defer.inlineCallbacks
+    def test_released_keys_forgotten(self):
+        with (yield self.lock_manager.lock("test")):
+            pass
+
+        self.assertFalse(self.lock_manager._lock_deferreds)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from mock import Mock
+
+from synapse.util.logutils import log_function, set_function_logging
+
+import logging
+
+
+@log_function
+def add(a, b=2):
+    return a + b
+
+
+class Adder(object):
+    @log_function
+    def add(self, a):
+        return a + 1
+
+    @defer.inlineCallbacks
+    @log_function
+    def add_later(self, a):
+        b = yield defer.succeed(1)
+        defer.returnValue(a + b)
+
+
+class LogFunctionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = logging.getLogger(__name__)
+        self.handler = Mock(level=logging.DEBUG)
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        set_function_logging(__name__, True)
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(logging.NOTSET)
+
+    def test_logs_call(self):
+        self.assertEquals(3, add(1))
+
+        self.assertEquals(1, self.handler.handle.call_count)
+        record = self.handler.handle.call_args[0][0]
+        self.assertEquals("add", record.args["func_name"])
+
+    def test_disabled(self):
+        set_function_logging(__name__, False)
+
+        self.assertEquals(3, add(1))
+        self.assertFalse(self.handler.handle.called)
+
+    def test_disabled_by_package(self):
+        set_function_logging("tests", False)
+        set_function_logging(__name__, True)
+
+        self.assertEquals(3, add(1))
+        self.assertEquals(1, self.handler.handle.call_count)
+
+        set_function_logging("tests", True)
+
+    def test_keeps_name(self):
+        self.assertEquals("add", add.__name__)
+
+    def test_disabled_unwraps(self):
+        wrapped = add
+
+        set_function_logging(__name__, False)
+        self.assertEquals("add", add.func_code.co_name)
+        self.assertEquals("add", Adder.add.im_func.func_code.co_name)
+
+        set_function_logging(__name__, True)
+        self.assertIs(wrapped, add)
+
+    def test_reenabled_method(self):
+        set_function_logging(__name__, False)
+        set_function_logging(__name__, True)
+
+        self.assertEquals(2, Adder().add(1))
+        self.assertEquals(1, self.handler.handle.call_count)
+
+    @defer.inlineCallbacks
+    def test_other_decorators(self):
+        set_function_logging(__name__, False)
+
+        result = yield Adder().add_later(1)
+        self.assertEquals(2, result)
+        self.assertFalse(self.handler.handle.called)
+
+        set_function_logging(__name__, True)
+
+        result = yield Adder().add_later(1)
+        self.assertEquals(2, result)
+        self.assertEquals(1, self.handler.handle.call_count)
+        record = self.handler.handle.call_args[0][0]
+        self.assertEquals("add_later", record.args["func_name"])
+
+    def test_decorated_while_disabled(self):
+        set_function_logging(__name__, False)
+
+        @log_function
+        def sub(a):
+            return a - 1
+
+        self.assertEquals("sub", sub.func_code.co_name)
+        self.assertEquals(0, sub(1))
+        self.assertFalse(self.handler.handle.called)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+
+from mock import Mock
+
+from synapse.util.lrucache import LruCache
+
+
+class LruCacheTestCase(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LruCache(10)
+        cache.set("key", "value")
+
+        self.assertEquals(cache.get("key"), "value")
+        self.assertEquals(cache.get("other"), None)
+        self.assertEquals(cache.get("other", "default"), "default")
+
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(cache.misses, 2)
+
+    def test_eviction(self):
+        cache = LruCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        # Touching "a" makes "b" the least recently used entry
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEquals(len(cache), 2)
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertTrue("c" in cache)
+
+    def test_pop(self):
+        cache = LruCache(10)
+        cache.set("key", "value")
+
+        self.assertEquals(cache.pop("key"), "value")
+        self.assertEquals(cache.pop("key"), None)
+        self.assertEquals(len(cache), 0)
+
+    def test_clear(self):
+        cache = LruCache(10)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.clear()
+
+        self.assertEquals(len(cache), 0)
+
+    def test_max_age(self):
+        clock = Mock()
+        clock.time.return_value = 1000
+
+        cache = LruCache(10, max_age=30, clock=clock)
+        cache.set("key", "value")
+
+        clock.time.return_value = 1029
+        self.assertEquals(cache.get("key"), "value")
+
+        clock.time.return_value = 1030
+        self.assertEquals(cache.get("key"), None)
+        self.assertFalse("key" in cache)
+
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(cache.misses, 1)
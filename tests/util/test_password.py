@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from synapse.api.errors import LimitExceededError
+from synapse.util import Clock
+from synapse.util.password import PasswordHasher
+
+import threading
+
+
+class PasswordHasherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.hasher = PasswordHasher(Clock(), threads=1, queue_size=1)
+
+    def tearDown(self):
+        self.hasher.stop()
+
+    @defer.inlineCallbacks
+    def test_hash_and_check(self):
+        password_hash = yield self.hasher.hash("secret")
+
+        matches = yield self.hasher.check("secret", password_hash)
+        self.assertTrue(matches)
+
+        matches = yield self.hasher.check("wrong", password_hash)
+        self.assertFalse(matches)
+
+        self.assertEquals(3, self.hasher.wait_times.count)
+
+    @defer.inlineCallbacks
+    def test_queue_full(self):
+        event = threading.Event()
+
+        running = self.hasher._run(event.wait)
+        queued = self.hasher._run(lambda: "queued")
+
+        self.assertRaises(LimitExceededError, self.hasher._run, lambda: None)
+        self.assertEquals(1, self.hasher.rejected)
+
+        event.set()
+        yield running
+        result = yield queued
+        self.assertEquals("queued", result)
+
+        # Now the queue has drained there is room again.
+        result = yield self.hasher._run(lambda: "later")
+        self.assertEquals("later", result)
@@ -245,8 +245,8 @@ class MemoryDataStore(object):
                 "Don't know how to persist type=%s" % event.type
             )
 
-    def set_presence_state(self, user_localpart, state):
-        return defer.succeed({"state": 0})
+    def set_presence_states(self, states):
+        return defer.succeed(None)
 
     def get_presence_list(self, user_localpart, accepted):
         return []